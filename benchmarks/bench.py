@@ -0,0 +1,232 @@
+"""
+Offline load and throughput benchmark for the worker, the search API and the addon.
+Everything runs locally: the scalable mock catalog, the fake Ollama server, a local
+Chroma server (`chroma run`), and the search API and addon under uvicorn, all on free
+ports with their data in a temporary directory.
+
+    python benchmarks/bench.py --titles 2000 --concurrency 16 --requests 1000
+
+Scenarios (run in this order, each one uses the data of the previous ones):
+- ingest:  catalog pages/sec, cold and then conditional (unchanged) re-ingest
+- worker:  titles/hour through enrichment and embedding
+- search:  /search latency percentiles under concurrent load
+- catalog: addon search and browse catalog latency percentiles under concurrent load
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ["ingest", "worker", "search", "catalog"]
+QUERIES = [
+    "giant shark attacks a coastal town", "spiders in an abandoned mine", "family drama in Rome",
+    "a detective and a corrupt mayor", "survival in Antarctica", "killer clown", "rogue AI on a space freighter",
+    "tender story about friendship", "wolves in the mountains", "revenge in Naples", "Big Buck Bunny",
+    "Sintel", "a young chef in Tuscany", "blood-soaked cult", "snakes in a swamp",
+]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_until_up(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=2).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    pick = lambda p: ordered[min(int(len(ordered) * p), len(ordered) - 1)] * 1000 if ordered else 0.0
+    return {"p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99)}
+
+class Stack:
+    """The local processes the benchmark runs against, stopped together."""
+
+    def __init__(self, workdir, args):
+        self.workdir = workdir
+        self.args = args
+        self.procs = []
+        self.ports = {name: free_port() for name in ("catalog", "chroma", "search", "addon")}
+        self.ports.update({f"ollama{node}": free_port() for node in range(args.nodes)})
+        self.env = {
+            **os.environ,
+            "PYTHONUNBUFFERED": "1",
+            "DB_PATH": os.path.join(workdir, "media_library.db"),
+            "VECTOR_INDEX_DIR": os.path.join(workdir, "vector_index"),
+            "OLLAMA_URLS": ",".join(f"http://127.0.0.1:{self.ports[f'ollama{node}']}" for node in range(args.nodes)),
+            "CHROMA_HOST": "127.0.0.1",
+            "CHROMA_PORT": str(self.ports["chroma"]),
+            "VIXSRC_URL": f"http://127.0.0.1:{self.ports['catalog']}/catalog/movie/vixsrc_movies",
+            "SEARCH_API_URL": f"http://127.0.0.1:{self.ports['search']}",
+            "MOCK_CATALOG_SIZE": str(args.titles),
+            "FAKE_OLLAMA_TOKEN_SECONDS": str(args.token_seconds),
+            "FAKE_OLLAMA_EMBED_SECONDS": str(args.embed_seconds),
+            "FAKE_OLLAMA_PARALLEL": str(args.parallel),
+            "OLLAMA_NUM_PARALLEL": str(args.parallel),
+            "METRICS_PORT": "0",
+            "JOB_POLL_SECONDS": "1",
+        }
+
+    def start(self, name, command, health):
+        log = open(os.path.join(self.workdir, f"{name}.log"), "w")
+        self.procs.append(subprocess.Popen(command, cwd=ROOT, env=self.env, stdout=log, stderr=subprocess.STDOUT))
+        wait_until_up(health)
+
+    def uvicorn(self, name, app, app_dir="."):
+        port = self.ports[name]
+        self.start(name, [sys.executable, "-m", "uvicorn", app, "--app-dir", app_dir, "--port", str(port),
+                          "--log-level", "warning"], f"http://127.0.0.1:{port}/docs")
+
+    def start_backends(self):
+        self.uvicorn("catalog", "mock_vixsrc:app")
+        for node in range(self.args.nodes):
+            self.uvicorn(f"ollama{node}", "fake_ollama:app", "benchmarks")
+        self.start("chroma", ["chroma", "run", "--path", os.path.join(self.workdir, "chroma"),
+                              "--port", str(self.ports["chroma"])],
+                   f"http://127.0.0.1:{self.ports['chroma']}/api/v2/heartbeat")
+        os.environ.update(self.env) # The worker runs in this process
+
+    def stop(self):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+def run_ingest(worker, conn, args):
+    pages = -(-args.titles // int(os.environ.get("MOCK_PAGE_SIZE", 100))) + 1 # + the final empty page
+    started = time.perf_counter()
+    worker.ingest_from_api(conn)
+    cold = time.perf_counter() - started
+    started = time.perf_counter()
+    worker.ingest_from_api(conn)
+    warm = time.perf_counter() - started
+    return {"titles": args.titles, "pages": pages, "pages_per_sec": pages / cold,
+            "unchanged_pages_per_sec": pages / warm}
+
+def run_worker(worker, conn, args):
+    worker.sync_task_versions(conn)
+    worker.enqueue_pending(conn)
+    started = time.perf_counter()
+    done = 0
+    while True:
+        processed = worker.run_pipeline(conn)
+        done += processed
+        if not processed and not worker.backlog_stats(conn).get("pending"):
+            break
+    elapsed = time.perf_counter() - started
+    if worker.VECTOR_INDEX != "off":
+        worker.export_vectors()
+    return {"titles": done, "seconds": elapsed, "titles_per_hour": done / elapsed * 3600 if elapsed else 0.0,
+            "backlog": worker.backlog_stats(conn)}
+
+async def load(base_url, paths, concurrency, total):
+    """Issue `total` GETs over `concurrency` connections; returns latency stats."""
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(paths[i % len(paths)])
+
+    async def client(http):
+        nonlocal errors
+        while not queue.empty():
+            path = queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                response = await http.get(path)
+                if response.status_code >= 400 or "error" in response.json():
+                    errors += 1
+            except (httpx.HTTPError, ValueError):
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as http:
+        started = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return {"requests": total, "errors": errors, "rps": total / elapsed, **percentiles(latencies)}
+
+def run_search(stack, args):
+    random.seed(args.seed)
+    queries = QUERIES + [f"random query {random.randint(0, 10**6)}" for _ in range(len(QUERIES))] # Uncached
+    paths = [f"/search?{urllib.parse.urlencode({'q': q, 'limit': 10})}" for q in queries]
+    return asyncio.run(load(f"http://127.0.0.1:{stack.ports['search']}", paths, args.concurrency, args.requests))
+
+def run_catalog(stack, args):
+    paths = [f"/catalog/movie/ai_search/{urllib.parse.urlencode({'search': q})}.json" for q in QUERIES]
+    paths += [f"/catalog/movie/ai_recent/skip={skip}.json" for skip in range(0, args.titles, 100)]
+    paths += [f"/catalog/movie/ai_genres/genre=Horror&skip={skip}.json" for skip in range(0, args.titles // 5, 100)]
+    return asyncio.run(load(f"http://127.0.0.1:{stack.ports['addon']}", paths, args.concurrency, args.requests))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--titles", type=int, default=1000, help="Titles in the mock catalog")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated subset of " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients for search/catalog")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per load scenario")
+    parser.add_argument("--token-seconds", type=float, default=0.002, help="Fake Ollama delay per generated token")
+    parser.add_argument("--embed-seconds", type=float, default=0.001, help="Fake Ollama delay per embedded text")
+    parser.add_argument("--parallel", type=int, default=2, help="Fake Ollama parallel requests")
+    parser.add_argument("--nodes", type=int, default=1, help="Fake Ollama instances (OLLAMA_URLS)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary directory (logs, DB)")
+    args = parser.parse_args()
+    scenarios = [s for s in SCENARIOS if s in args.scenarios.split(",")]
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    stack = Stack(workdir, args)
+    results = {"config": {k: v for k, v in vars(args).items() if k not in ("json", "keep")}}
+    try:
+        stack.start_backends()
+        sys.path.insert(0, ROOT)
+        import metadata_worker as worker
+        conn = worker.open_db()
+        if "ingest" in scenarios or "worker" in scenarios:
+            results["ingest"] = run_ingest(worker, conn, args)
+        if "worker" in scenarios:
+            results["worker"] = run_worker(worker, conn, args)
+        if "search" in scenarios or "catalog" in scenarios:
+            stack.env["VECTOR_BACKEND"] = os.environ.get("VECTOR_BACKEND", "chroma")
+            stack.uvicorn("search", "search_service:app")
+            stack.uvicorn("addon", "stremio_addon:app")
+        if "search" in scenarios:
+            results["search"] = run_search(stack, args)
+        if "catalog" in scenarios:
+            results["catalog"] = run_catalog(stack, args)
+    finally:
+        stack.stop()
+        if args.keep:
+            print(f"Logs and data kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for name, values in results.items():
+        print(f"{name:8} " + "  ".join(f"{k}={v:.4g}" if isinstance(v, float) else f"{k}={v}" for k, v in values.items()))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Fake Ollama server for offline benchmarks.
+Answers /api/generate and /api/embed deterministically (same input, same output) after
+a configurable delay per generated token and per embedded text, and limits concurrent
+requests like OLLAMA_NUM_PARALLEL does.
+
+    python -m uvicorn fake_ollama:app --app-dir benchmarks --port 11434
+"""
+from fastapi import FastAPI
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import time
+
+TOKEN_SECONDS = float(os.environ.get("FAKE_OLLAMA_TOKEN_SECONDS", 0.02)) # Delay per generated token
+PROMPT_SECONDS = float(os.environ.get("FAKE_OLLAMA_PROMPT_SECONDS", 0.05)) # Fixed delay per generation (prompt eval)
+EMBED_SECONDS = float(os.environ.get("FAKE_OLLAMA_EMBED_SECONDS", 0.005)) # Delay per embedded text
+PARALLEL = int(os.environ.get("FAKE_OLLAMA_PARALLEL", 2)) # Requests served at once, like OLLAMA_NUM_PARALLEL
+EMBED_DIM = int(os.environ.get("FAKE_OLLAMA_EMBED_DIM", 768))
+MODELS = ["llama3.1:8b", "nomic-embed-text"]
+
+# Words that make the fake classifier answer "Animal Horror" / report a phobia
+ANIMALS = ["shark", "spider", "snake", "wolves", "wolf", "crocodile", "piranha", "rats", "bear"]
+TRIGGERS = {"spiders": ["spider"], "snakes": ["snake"], "clowns": ["clown"], "heights": ["height", "cliff"],
+            "blood": ["blood"]}
+
+app = FastAPI(title="Fake Ollama")
+slots = asyncio.Semaphore(PARALLEL)
+
+def user_input(prompt):
+    """The text between [INST] and [/INST] in the worker's prompt format."""
+    match = re.search(r"\[INST\](.*)\[/INST\]", prompt, re.S)
+    return match.group(1) if match else prompt
+
+def classify(text):
+    lowered = text.lower()
+    is_horror = any(animal in lowered for animal in ANIMALS)
+    phobias = [name for name, words in TRIGGERS.items() if any(word in lowered for word in words)]
+    return is_horror, phobias
+
+def fake_translation(text):
+    return "Traduzione: " + text
+
+def answer(prompt, format):
+    text = user_input(prompt)
+    is_horror, phobias = classify(text)
+    if format is not None:
+        return json.dumps({"translation_it": fake_translation(text), "animal_horror": is_horror, "phobias": phobias})
+    if "Translate" in prompt:
+        return fake_translation(text)
+    if "Animal Horror" in prompt:
+        return "YES" if is_horror else "NO"
+    return ", ".join(phobias) or "NONE"
+
+def embed(text):
+    """Hashed bag-of-words vector: deterministic, and texts sharing words are close."""
+    vector = [0.0] * EMBED_DIM
+    for word in re.findall(r"\w+", text.lower()):
+        digest = hashlib.md5(word.encode()).digest()
+        index = int.from_bytes(digest[:4], "little") % EMBED_DIM
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+@app.get("/api/tags")
+async def tags():
+    return {"models": [{"name": name, "model": name} for name in MODELS]}
+
+@app.get("/api/ps")
+async def running():
+    return {"models": [{"name": name, "model": name} for name in MODELS]}
+
+@app.post("/api/generate")
+async def generate(payload: dict):
+    started = time.perf_counter()
+    response = answer(payload.get("prompt", ""), payload.get("format"))
+    tokens = len(response.split())
+    async with slots:
+        await asyncio.sleep(PROMPT_SECONDS + TOKEN_SECONDS * tokens)
+    return {
+        "model": payload.get("model"),
+        "response": response,
+        "done": True,
+        "prompt_eval_count": len(payload.get("prompt", "").split()),
+        "eval_count": tokens,
+        "eval_duration": int(TOKEN_SECONDS * tokens * 1e9),
+        "total_duration": int((time.perf_counter() - started) * 1e9),
+    }
+
+@app.post("/api/embed")
+async def embed_texts(payload: dict):
+    texts = payload.get("input", "")
+    texts = [texts] if isinstance(texts, str) else texts
+    async with slots:
+        await asyncio.sleep(EMBED_SECONDS * len(texts))
+    return {"model": payload.get("model"), "embeddings": [embed(text) for text in texts]}
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 11434)))
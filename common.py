@@ -0,0 +1,72 @@
+"""
+Helpers shared by the worker, the search API, the addon and the Ollama gate.
+- Tag and year normalization: the worker's index metadata and tag tables, the search
+  filters and the addon's catalogs must agree on them.
+- Requests to the Ollama endpoints of an ollama_pool.OllamaPool. The HTTP client is
+  passed in (the requests module, or an httpx client), so this module imports neither.
+"""
+import asyncio
+import re
+import time
+
+def genre_slug(name):
+    """Normalized genre name, as stored in movie_genres and the index metadata (genre_<slug>)."""
+    return re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+def release_year(value):
+    """First 4-digit year of a releaseInfo string ("2008", "2008-2010"), or None."""
+    match = re.match(r"\s*(\d{4})", str(value or ""))
+    return int(match.group(1)) if match else None
+
+def get_json(client, url):
+    response = client.get(url, timeout=5)
+    response.raise_for_status()
+    return response.json()
+
+async def get_json_async(client, url):
+    response = await client.get(url, timeout=5.0)
+    response.raise_for_status()
+    return response.json()
+
+def check_ollama(pool, client, interval):
+    """Health and model checks of the pool's endpoints every `interval` seconds (a thread's loop)."""
+    while True:
+        pool.check(lambda url: get_json(client, url))
+        time.sleep(interval)
+
+async def check_ollama_async(pool, client, interval):
+    """check_ollama() as a task."""
+    while True:
+        await pool.check_async(lambda url: get_json_async(client, url))
+        await asyncio.sleep(interval)
+
+def ollama_post(pool, client, path, payload, **kwargs):
+    """
+    POST to the pool endpoint chosen for payload["model"]. Errors and 5xx answers count as
+    endpoint failures; a caller that gives up (e.g. a cancelled task) counts as neither.
+    """
+    endpoint = pool.acquire(payload.get("model"))
+    ok = None
+    try:
+        response = client.post(f"{endpoint.url}{path}", json=payload, **kwargs)
+        ok = response.status_code < 500
+        return response
+    except Exception:
+        ok = False
+        raise
+    finally:
+        pool.release(endpoint, ok)
+
+async def ollama_post_async(pool, client, path, payload, **kwargs):
+    """ollama_post() with an async client."""
+    endpoint = pool.acquire(payload.get("model"))
+    ok = None
+    try:
+        response = await client.post(f"{endpoint.url}{path}", json=payload, **kwargs)
+        ok = response.status_code < 500
+        return response
+    except Exception:
+        ok = False
+        raise
+    finally:
+        pool.release(endpoint, ok)
@@ -1,97 +1,1357 @@
 import sqlite3
 import requests
 import json
+import hashlib
 import time
 import chromadb
+import numpy as np
 import os
+import queue
+import random
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import common
+import metrics
+import ollama_pool
+from common import genre_slug, release_year
 from chromadb.config import Settings
 
 # --- CONFIGURATION ---
 # Check if running in Docker, otherwise use local paths for testing
 IN_DOCKER = os.environ.get("AM_I_IN_A_DOCKER_CONTAINER", False)
 
-DB_PATH = "/data/media_library.db"
-OLLAMA_URL = "http://ollama:11434"
+DB_PATH = os.environ.get("DB_PATH", "/data/media_library.db")
+OLLAMA_URLS = ollama_pool.endpoint_urls() # OLLAMA_URLS (comma-separated) or OLLAMA_URL
+CHROMA_HOST = os.environ.get("CHROMA_HOST", "chromadb")
+CHROMA_PORT = int(os.environ.get("CHROMA_PORT", 8000))
 LLM_MODEL = "llama3.1:8b"
-EMBED_MODEL = "nomic-embed-text"
+EMBED_MODEL = os.environ.get("EMBED_MODEL", "nomic-embed-text") # Model of the first collection; later models come with `rebuild`
+INDEX_NAME = "movie_descriptions" # The first Chroma collection; rebuilds write to versioned copies of it
+REBUILD_PAGE_SIZE = int(os.environ.get("REBUILD_PAGE_SIZE", 512)) # Movies embedded per rebuild checkpoint
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 64)) # Descriptions per /api/embed call
+ENRICH_MODE = os.environ.get("ENRICH_MODE", "structured") # "structured" (one JSON call) or "separate" (one prompt per task)
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 2)) # Max in-flight requests per Ollama endpoint, match the server setting
+OLLAMA_SLOTS = int(os.environ.get("OLLAMA_SLOTS", OLLAMA_NUM_PARALLEL * len(OLLAMA_URLS))) # Max in-flight Ollama requests in total; set it behind ollama_gate
+QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 256)) # Bound for each inter-stage queue
+EMBED_FLUSH_SECONDS = 5 # Flush a partial embedding batch when the LLM stage is slower than this
 
-# Initialize ChromaDB Client
-# We use the http client to connect to the chromadb container
-chroma_client = chromadb.HttpClient(host='chromadb', port=8000)
-collection = chroma_client.get_or_create_collection(name="movie_descriptions")
+# Job queue (shared by every worker container through the SQLite database)
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", 900)) # A claimed job returns to the queue after this
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 5)) # Then the job is dead-lettered
+JOB_RETRY_SECONDS = 30 # Base retry delay, doubled after every failed attempt
+JOB_POLL_SECONDS = int(os.environ.get("JOB_POLL_SECONDS", 5)) # Idle wait between claims
+OUTAGE_RETRY_SECONDS = int(os.environ.get("OUTAGE_RETRY_SECONDS", 60)) # Jobs hit by an Ollama/Chroma outage wait this long, without using an attempt
+CLAIM_BATCH = int(os.environ.get("CLAIM_BATCH", OLLAMA_SLOTS * 4)) # Movies claimed at a time
+INGEST_INTERVAL = int(os.environ.get("INGEST_INTERVAL", 300)) # Seconds between catalog ingestions
+
+# Local vector snapshot served by search_service (memory-mapped), refreshed after new embeddings
+VECTOR_INDEX = os.environ.get("VECTOR_INDEX", "float32") # "float32", "int8" (4x smaller) or "off"
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR", "/data/vector_index")
+VECTOR_EXPORT_INTERVAL = int(os.environ.get("VECTOR_EXPORT_INTERVAL", 300)) # Min seconds between exports
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100)) # Prometheus exporter port, 0 to disable
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "24h") # Sent with every Ollama call, keeps the models loaded
+WARMUP = os.environ.get("WARMUP", "1") == "1" # Load the LLM and embedding models before the first jobs
+RETRY_MAX_SECONDS = 30 # Max backoff while waiting for Ollama and Chroma
+
+PHOBIAS = ["spiders", "snakes", "clowns", "heights", "blood"]
+ANIMAL_HORROR = "Animal Horror"
+
+# Enrichment tasks tracked per movie. Each result is keyed by a hash of its input
+# (description + model + prompt), so only tasks whose input changed are recomputed.
+LLM_TASKS = ["translate", "classify", "phobia"]
+TASKS = LLM_TASKS + ["embed"]
+INDEX_META_VERSION = "2" # Bump when the Chroma metadata layout changes; existing vectors are backfilled
+
+# --- PROMPTS ---
+IT_PROMPT = "Translate the following movie description into natural, professional Italian. Return ONLY the translation."
+HORROR_PROMPT = (
+    "Analyze if this movie belongs to the 'Animal Horror' sub-genre (animals or creatures as antagonists). "
+    "Answer ONLY with 'YES' or 'NO'."
+)
+PHOBIA_PROMPT = (
+    f"Analyze the movie description for these triggers: {', '.join(PHOBIAS)}. "
+    "Return a comma-separated list of triggers found. If none, return 'NONE'. "
+    "Return ONLY the list."
+)
+ENRICH_PROMPT = (
+    "You enrich movie metadata. Read the movie description and return a JSON object with:\n"
+    "- translation_it: the description translated into natural, professional Italian\n"
+    "- animal_horror: true if the movie belongs to the 'Animal Horror' sub-genre "
+    "(animals or creatures as antagonists), otherwise false\n"
+    f"- phobias: the triggers found in the description, chosen only from: {', '.join(PHOBIAS)}. "
+    "Use an empty list if none are found.\n"
+    "Return ONLY the JSON object."
+)
+ENRICH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "translation_it": {"type": "string"},
+        "animal_horror": {"type": "boolean"},
+        "phobias": {"type": "array", "items": {"type": "string", "enum": PHOBIAS}},
+    },
+    "required": ["translation_it", "animal_horror", "phobias"],
+}
+
+# Keep-alive connection pool for catalog ingestion, reused across cycles
+catalog_session = requests.Session()
+catalog_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+catalog_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+# Caps concurrent Ollama calls across all pipeline threads; the pool spreads them over the endpoints
+ollama_slots = threading.BoundedSemaphore(OLLAMA_SLOTS)
+ollama = ollama_pool.OllamaPool(OLLAMA_URLS, OLLAMA_NUM_PARALLEL)
+ollama.export_metrics()
+
+# Metrics, served by the exporter thread started in main
+ollama_seconds = metrics.Histogram("ollama_request_seconds", "Ollama call latency", ["api"])
+ollama_eval_tokens = metrics.Counter("ollama_eval_tokens_total", "Tokens generated, as reported by Ollama (eval_count)")
+ollama_eval_seconds = metrics.Counter("ollama_eval_seconds_total", "Generation time reported by Ollama (eval_duration)")
+ollama_tokens_per_second = metrics.Gauge("ollama_tokens_per_second", "eval_count / eval_duration of the last generation")
+chroma_seconds = metrics.Histogram("chroma_request_seconds", "Chroma call latency", ["op"])
+sqlite_seconds = metrics.Histogram("sqlite_query_seconds", "SQLite transaction latency", ["query"])
+backlog_jobs = metrics.Gauge("worker_backlog_jobs", "Jobs not done, by state", ["state"])
+titles_done = metrics.Counter("worker_titles_total", "Movies written by the pipeline")
+titles_per_minute = metrics.Gauge("worker_titles_per_minute", "Pipeline throughput of the current run")
+task_failures = metrics.Counter("worker_task_failures_total", "Failed job attempts", ["task"])
+dead_jobs = metrics.Counter("worker_jobs_dead_total", "Jobs moved to the dead-letter state", ["task"])
+
+# ChromaDB client, created on first use: HttpClient() already connects, and importing
+# the worker (tests, the rebuild command) shouldn't need a running Chroma
+chroma_client = None
+chroma_lock = threading.Lock()
+
+class BackendUnavailable(Exception):
+    """
+    Ollama or Chroma couldn't serve a request: connection refused, timeout or a 5xx answer.
+    That's not the job's fault, so affected jobs go back to the queue without using an attempt.
+    """
+
+# Set by the pipeline stages when a backend is unavailable: no more jobs are claimed, and
+# jobs already claimed are deferred instead of failed (see defer_job)
+outage = threading.Event()
+
+def get_chroma():
+    global chroma_client
+    with chroma_lock:
+        if chroma_client is None:
+            chroma_client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+        return chroma_client
+
+# Collections written by this worker, as (name, embed model): the active one that search
+# reads first, then the one a rebuild is filling, if any. Refreshed from vector_collections.
+index_targets = [(INDEX_NAME, EMBED_MODEL)]
+collections = {}
+
+def get_collection(name):
+    if name not in collections:
+        collections[name] = get_chroma().get_or_create_collection(name=name)
+    return collections[name]
+
+def load_index_targets(conn):
+    """Refresh index_targets from the vector_collections pointer table."""
+    global index_targets
+    rows = conn.execute(
+        "SELECT name, model FROM vector_collections WHERE state IN ('active', 'building') ORDER BY state = 'building'"
+    ).fetchall()
+    if rows:
+        index_targets = [tuple(row) for row in rows]
+
+def ollama_post(path, payload, timeout):
+    """
+    POST to the pool endpoint chosen for payload["model"]. Connection errors, timeouts and
+    5xx answers count as endpoint failures and raise BackendUnavailable.
+    """
+    try:
+        response = common.ollama_post(ollama, requests, path, payload, timeout=timeout)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise BackendUnavailable(f"Ollama: {e}") from e
+    if response.status_code >= 500:
+        raise BackendUnavailable(f"Ollama {response.url} answered {response.status_code}: {response.text[:200]}")
+    return response
 
 def wait_for_services():
-    """Ensure Ollama and Chroma are reachable before starting."""
+    """Ensure Ollama and Chroma are reachable before starting, backing off between attempts."""
     print("Waiting for services to warm up...")
+    delay = 1
     while True:
         try:
-            # Check Ollama
-            requests.get(f"{OLLAMA_URL}/api/tags", timeout=5)
+            # Check Ollama: at least one endpoint up
+            ollama.check(lambda url: common.get_json(requests, url))
+            if not ollama.healthy_count():
+                raise RuntimeError("no Ollama endpoint is up")
             # Check Chroma
-            chroma_client.heartbeat()
+            get_chroma().heartbeat()
             print("Services online. Starting worker.")
             break
         except Exception as e:
-            print(f"Waiting for services... ({e})")
-            time.sleep(5)
+            print(f"Waiting for services... ({e}), retrying in {delay}s")
+            time.sleep(delay)
+            delay = min(delay * 2, RETRY_MAX_SECONDS)
 
-def ask_llm(system_prompt, user_input):
+def warm_up_models():
+    """
+    Load the LLM and the embedding models of index_targets into Ollama with OLLAMA_KEEP_ALIVE,
+    so the first batch doesn't wait for model loads. Failures only cost that first batch.
+    Each model is loaded on its home endpoint in the pool, where its requests will go.
+    """
+    calls = [("generate", {"model": LLM_MODEL, "keep_alive": OLLAMA_KEEP_ALIVE})] # No prompt: load only
+    calls += [("embed", {"model": model, "input": "warm up", "keep_alive": OLLAMA_KEEP_ALIVE})
+              for model in dict.fromkeys(model for _, model in index_targets)]
+    for endpoint, payload in calls:
+        started = time.perf_counter()
+        try:
+            ollama_post(f"/api/{endpoint}", payload, timeout=300).raise_for_status()
+            print(f"Loaded {payload['model']} in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            print(f"Warm-up of {payload['model']} failed: {e}")
+
+def ask_llm(system_prompt, user_input, format=None):
     payload = {
         "model": LLM_MODEL,
         "prompt": f"<<SYS>>\n{system_prompt}\n<</SYS>>\n\n[INST]{user_input}[/INST]",
         "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
         "options": {"temperature": 0.1, "num_ctx": 4096}
     }
+    if format is not None:
+        payload["format"] = format # Constrain output to JSON (Ollama structured outputs)
     try:
-        response = requests.post(f"{OLLAMA_URL}/api/generate", json=payload, timeout=120)
-        return response.json().get("response", "").strip()
+        with ollama_slots, ollama_seconds.time(api="generate"):
+            response = ollama_post("/api/generate", payload, timeout=120)
+        data = response.json()
+        if data.get("eval_count") and data.get("eval_duration"):
+            eval_seconds = data["eval_duration"] / 1e9 # Reported in nanoseconds
+            ollama_eval_tokens.inc(data["eval_count"])
+            ollama_eval_seconds.inc(eval_seconds)
+            ollama_tokens_per_second.set(data["eval_count"] / eval_seconds)
+        return data.get("response", "").strip()
+    except BackendUnavailable:
+        raise
     except Exception as e:
         print(f"LLM Error: {e}")
         return ""
 
-def get_embedding(text):
-    payload = {"model": EMBED_MODEL, "input": text}
+def parse_phobias(text):
+    """Extract the known phobia triggers mentioned in a free-text LLM answer."""
+    if not text or "NONE" in text.upper():
+        return []
+    found = text.lower()
+    return [p for p in PHOBIAS if p in found]
+
+def parse_enrichment(raw):
+    """
+    Validate a structured enrichment answer against ENRICH_SCHEMA.
+    Returns {"translation_it", "animal_horror", "phobias"} or None if the answer is unusable.
+    """
     try:
-        response = requests.post(f"{OLLAMA_URL}/api/embed", json=payload, timeout=30)
+        data = json.loads(raw)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    translation = data.get("translation_it")
+    is_horror = data.get("animal_horror")
+    phobias = data.get("phobias")
+    if not isinstance(translation, str) or not translation.strip():
+        return None
+    if not isinstance(is_horror, bool):
+        return None
+    if not isinstance(phobias, list) or not all(isinstance(p, str) for p in phobias):
+        return None
+
+    tags = {p.strip().lower() for p in phobias}
+    return {
+        "translation_it": translation.strip(),
+        "animal_horror": is_horror,
+        "phobias": [p for p in PHOBIAS if p in tags],
+    }
+
+def enrich_separate(desc_en, tasks):
+    """
+    Run the requested tasks as separate prompts.
+    Returns {task: result}; tasks whose answer was unusable are left out so they are retried.
+    """
+    results = {}
+    if "translate" in tasks:
+        desc_it = ask_llm(IT_PROMPT, desc_en)
+        if desc_it:
+            results["translate"] = desc_it
+    if "classify" in tasks:
+        is_horror = ask_llm(HORROR_PROMPT, desc_en).upper()
+        if "YES" in is_horror:
+            results["classify"] = True
+        elif "NO" in is_horror:
+            results["classify"] = False
+    if "phobia" in tasks:
+        phobia_tags = ask_llm(PHOBIA_PROMPT, desc_en)
+        if phobia_tags:
+            results["phobia"] = parse_phobias(phobia_tags)
+    return results
+
+def enrich(desc_en, tasks=LLM_TASKS):
+    """
+    Translate and classify a description for the requested tasks.
+    In structured mode all tasks share one JSON-constrained call, so the description is
+    only processed once; invalid answers fall back to the separate prompts.
+    Returns ({task: result}, mode), `mode` being the prompts that produced the results.
+    """
+    if ENRICH_MODE == "structured":
+        result = parse_enrichment(ask_llm(ENRICH_PROMPT, desc_en, format=ENRICH_SCHEMA))
+        if result is not None:
+            answers = {
+                "translate": result["translation_it"],
+                "classify": result["animal_horror"],
+                "phobia": result["phobias"],
+            }
+            return {task: answers[task] for task in tasks}, "structured"
+        print("Structured enrichment invalid, falling back to separate prompts.")
+    return enrich_separate(desc_en, tasks), "separate"
+
+def task_versions(embed_model=None, mode=None):
+    """
+    Version string of every task: the model plus the prompt that produces its result.
+    Changing LLM_MODEL, ENRICH_MODE or a prompt only changes the affected tasks. The embed
+    version follows the model of the active collection, which rebuild_index switches.
+    `mode` overrides ENRICH_MODE, for results of the fallback prompts.
+    """
+    if (mode or ENRICH_MODE) == "structured":
+        prompts = dict.fromkeys(LLM_TASKS, ENRICH_PROMPT + json.dumps(ENRICH_SCHEMA, sort_keys=True))
+    else:
+        prompts = {"translate": IT_PROMPT, "classify": HORROR_PROMPT, "phobia": PHOBIA_PROMPT}
+    versions = {task: f"{task}|{LLM_MODEL}|{prompts[task]}" for task in LLM_TASKS}
+    versions["embed"] = f"embed|{embed_model or index_targets[0][1]}"
+    return {task: hashlib.sha256(v.encode()).hexdigest()[:16] for task, v in versions.items()}
+
+def input_hash(version, text):
+    """Content address of a task result: same description + same task version = same result."""
+    return hashlib.sha256(f"{version}\0{text}".encode()).hexdigest()
+
+def with_animal_horror(genres, is_horror):
+    """Return the genres string with the Animal Horror tag added or removed."""
+    tags = [g.strip() for g in (genres or "").split(",") if g.strip() and g.strip() != ANIMAL_HORROR]
+    if is_horror:
+        tags.append(ANIMAL_HORROR)
+    return ", ".join(tags) or None
+
+def split_tags(text):
+    return [tag.strip() for tag in (text or "").split(",") if tag.strip()]
+
+def index_metadata(title, year, genres, phobias):
+    """
+    Chroma metadata for a movie, in a shape that `where` filters can use:
+    year as an int, one genre_<slug> flag per genre, and a phobia_<name> flag for every
+    known phobia.
+    """
+    meta = {"title": title or ""}
+    year = release_year(year)
+    if year:
+        meta["year"] = year
+    for genre in split_tags(genres):
+        meta[f"genre_{genre_slug(genre)}"] = True
+    for phobia in PHOBIAS:
+        meta[f"phobia_{phobia}"] = phobia in phobias
+    return meta
+
+def get_embedding(text, model=EMBED_MODEL):
+    payload = {"model": model, "input": text, "keep_alive": OLLAMA_KEEP_ALIVE}
+    try:
+        with ollama_slots:
+            response = ollama_post("/api/embed", payload, timeout=30)
         return response.json().get("embeddings", [None])[0]
+    except BackendUnavailable:
+        raise
     except Exception as e:
         print(f"Embedding Error: {e}")
         return None
 
+def get_embeddings(texts, model=EMBED_MODEL):
+    """Embed a list of texts in a single Ollama call. Returns None if the batch failed."""
+    payload = {"model": model, "input": texts, "keep_alive": OLLAMA_KEEP_ALIVE}
     try:
-        cursor.execute('''CREATE TABLE IF NOT EXISTS movies (
-            id TEXT PRIMARY KEY,
-            title TEXT,
-            description_en TEXT,
-            year TEXT,
-            poster TEXT,
-            background TEXT,
-            genres TEXT,
-            description_it TEXT,
-            ai_classified INTEGER DEFAULT 0,
-            phobia_warnings TEXT,
-            url TEXT,
-            path TEXT
-        )''')
-        cursor.execute("ALTER TABLE movies ADD COLUMN description_it TEXT")
-        cursor.execute("ALTER TABLE movies ADD COLUMN ai_classified INTEGER DEFAULT 0")
-        cursor.execute("ALTER TABLE movies ADD COLUMN phobia_warnings TEXT")
+        with ollama_slots, ollama_seconds.time(api="embed"):
+            response = ollama_post("/api/embed", payload, timeout=30 + 2 * len(texts))
+        response.raise_for_status()
+        embeddings = response.json().get("embeddings") or []
+        if len(embeddings) != len(texts):
+            print(f"Embedding Error: expected {len(texts)} vectors, got {len(embeddings)}")
+            return None
+        return embeddings
+    except BackendUnavailable:
+        raise
+    except Exception as e:
+        print(f"Batch Embedding Error: {e}")
+        return None
+
+def item_metadata(item):
+    """Index metadata for a pipeline item, using this run's results where there are any."""
+    results = item["results"]
+    genres = with_animal_horror(item["genres"], results["classify"]) if "classify" in results else item["genres"]
+    return index_metadata(item["title"], item["year"], genres, results.get("phobia", item["phobias"]))
+
+def update_index_metadata(conn, ids):
+    """Rewrite the Chroma metadata of already indexed movies from their current row."""
+    if not ids:
+        return
+    marks = ",".join("?" * len(ids))
+    rows = conn.execute(
+        f"""SELECT m.id, m.title, m.year, m.genres, m.phobia_warnings FROM movies m
+            JOIN movie_tasks t ON t.movie_id = m.id AND t.task = 'embed' WHERE m.id IN ({marks})""",
+        list(ids)
+    ).fetchall()
+    if not rows:
+        return
+    metadatas = [index_metadata(title, year, genres, split_tags(phobias)) for _, title, year, genres, phobias in rows]
+    for name, _ in index_targets:
+        with chroma_seconds.time(op="update"):
+            get_collection(name).update(ids=[str(row[0]) for row in rows], metadatas=metadatas)
+    with immediate(conn):
+        bump_index_generation(conn)
+
+def backfill_index_metadata(conn, page_size=500):
+    """Rewrite the metadata of every indexed movie, after INDEX_META_VERSION changed."""
+    last_id = ""
+    total = 0
+    while True:
+        ids = [row[0] for row in conn.execute(
+            "SELECT movie_id FROM movie_tasks WHERE task = 'embed' AND movie_id > ? ORDER BY movie_id LIMIT ?",
+            (last_id, page_size)
+        )]
+        if not ids:
+            break
+        update_index_metadata(conn, ids)
+        total += len(ids)
+        last_id = ids[-1]
+    print(f"Backfilled index metadata for {total} movies.")
+
+def embed_into(name, model, items):
+    """
+    Embed items with `model` and upsert them into collection `name`.
+    The whole list is embedded with one Ollama call and written with one Chroma upsert;
+    if the batch call fails, items are retried one by one. Returns {movie id: error}.
+    Raises BackendUnavailable if Ollama or Chroma is down.
+    """
+    vectors = get_embeddings([item["desc_en"] for item in items], model)
+    if vectors is None:
+        print(f"Retrying {len(items)} embeddings individually...")
+        vectors = [get_embedding(item["desc_en"], model) for item in items]
+
+    errors, indexed = {}, []
+    for item, vector in zip(items, vectors):
+        if vector:
+            indexed.append((item, vector))
+        else:
+            errors[item["id"]] = "embedding failed"
+    if not indexed:
+        return errors
+
+    try:
+        with chroma_seconds.time(op="upsert"):
+            get_collection(name).upsert(
+                ids=[str(item["id"]) for item, _ in indexed],
+                embeddings=[vector for _, vector in indexed],
+                metadatas=[item_metadata(item) for item, _ in indexed],
+                documents=[item["desc_en"] for item, _ in indexed]
+            )
+    except Exception as e:
+        try:
+            get_chroma().heartbeat()
+        except Exception:
+            raise BackendUnavailable(f"Chroma: {e}") from e
+        print(f"Indexing Error for batch of {len(indexed)} in {name}: {e}")
+        for item, _ in indexed:
+            errors[item["id"]] = f"chroma upsert failed: {e}"
+    return errors
+
+def embed_batch(batch):
+    """
+    Embed and index the movies of a batch whose embed task is pending.
+    Movies that could not be indexed in the active collection keep their embed task
+    pending. While a rebuild is running they are also written to its collection, so
+    the rebuild doesn't miss descriptions that change behind its checkpoint.
+    """
+    pending = [item for item in batch if "embed" in item["todo"]]
+    if not pending:
+        return
+
+    targets = index_targets
+    name, model = targets[0]
+    try:
+        if outage.is_set():
+            raise BackendUnavailable("backend unavailable earlier in this run")
+        errors = embed_into(name, model, pending)
+    except BackendUnavailable as e:
+        print(f"Embedding of {len(pending)} movies deferred: {e}")
+        outage.set()
+        for item in pending:
+            defer(item, ["embed"], e)
+        return
+    for item in pending:
+        if item["id"] in errors:
+            item["errors"]["embed"] = errors[item["id"]]
+            print(f"Embedding failed for {item['title']}, not indexed.")
+        else:
+            item["record"].append("embed")
+
+    indexed = [item for item in pending if item["id"] not in errors]
+    for name, model in targets[1:]:
+        if indexed:
+            try:
+                missed = embed_into(name, model, indexed)
+            except BackendUnavailable as e:
+                missed = {item["id"]: str(e) for item in indexed}
+            if missed:
+                print(f"{len(missed)} movies not written to {name}; the rebuild's final check adds them.")
+
+def defer(item, tasks, error):
+    """Mark tasks of a pipeline item as hit by an outage: retried later, without using an attempt."""
+    for task in tasks:
+        item["errors"][task] = str(error)
+        item["deferred"].add(task)
+
+def save_batch(conn, batch):
+    """
+    Write the enrichment results of a batch and settle its jobs in one transaction.
+    Newly computed LLM results are also stored by input hash so other titles with the
+    same description can reuse them. Tasks without a result are retried with backoff, or
+    after OUTAGE_RETRY_SECONDS without using an attempt if a backend was down.
+    Results are only applied if the description is still the one they were computed from.
+    """
+    now = time.time()
+    movie_rows, task_rows, result_rows, done_rows, failed, deferred = [], [], [], [], [], []
+    for item in batch:
+        results = item["results"]
+        genres = item["genres"]
+        if "classify" in results:
+            genres = with_animal_horror(genres, results["classify"])
+        phobias = ", ".join(results["phobia"]) if "phobia" in results else None
+        movie_rows.append((results.get("translate"), genres, phobias, item["id"], item["desc_en"]))
+
+        for task in item["record"]:
+            task_rows.append((item["id"], task, item["hashes"][task]))
+            if task in LLM_TASKS:
+                result_rows.append((item["result_hashes"].get(task, item["hashes"][task]), task, json.dumps(results[task])))
+            done_rows.append((item["job_ids"][task], WORKER_ID))
+        for task in item["todo"]:
+            if task not in item["record"]:
+                error = (item["job_ids"][task], item["errors"].get(task, "no usable result"))
+                (deferred if task in item["deferred"] else failed).append(error)
+
+    with immediate(conn):
+        conn.executemany(
+            """UPDATE movies SET description_it = COALESCE(?, description_it), genres = ?,
+               phobia_warnings = COALESCE(?, phobia_warnings) WHERE id = ? AND description_en = ?""",
+            movie_rows
+        )
+        sync_tags(conn, [item["id"] for item in batch if {"classify", "phobia"} & set(item["results"])])
+        conn.executemany(
+            """INSERT INTO movie_tasks (movie_id, task, input_hash) VALUES (?, ?, ?)
+               ON CONFLICT(movie_id, task) DO UPDATE SET input_hash = excluded.input_hash""",
+            task_rows
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO enrichment_results (input_hash, task, result) VALUES (?, ?, ?)",
+            result_rows
+        )
+        conn.executemany(
+            """UPDATE jobs SET state = 'done', lease_owner = NULL, lease_until = NULL, last_error = NULL
+               WHERE id = ? AND lease_owner = ?""",
+            done_rows
+        )
+        for job_id, error in failed:
+            fail_job(conn, job_id, error, now)
+        for job_id, error in deferred:
+            defer_job(conn, job_id, error, now)
+        # A movie is classified once none of its jobs are open any more
+        conn.executemany(
+            """UPDATE movies SET ai_classified = 1 WHERE id = ? AND description_en = ?
+               AND NOT EXISTS (SELECT 1 FROM jobs WHERE jobs.movie_id = movies.id AND jobs.state != 'done')""",
+            [(item["id"], item["desc_en"]) for item in batch]
+        )
+        if any("embed" in item["record"] for item in batch):
+            bump_index_generation(conn)
+
+def bump_index_generation(conn):
+    """Tell the search API that the active collection changed, so it drops cached results."""
+    conn.execute("UPDATE vector_collections SET generation = generation + 1 WHERE state = 'active'")
+
+# --- SCHEMA MIGRATIONS ---
+# Each migration runs once, in order, in its own transaction; PRAGMA user_version is the
+# number of migrations applied. Never edit a released migration, append a new one.
+
+MOVIE_COLUMNS = {
+    "description_it": "TEXT",
+    "ai_classified": "INTEGER DEFAULT 0",
+    "phobia_warnings": "TEXT",
+    "url": "TEXT",
+    "path": "TEXT",
+}
+
+def migrate_base_tables(conn):
+    """The worker's tables; databases created before migrations get their missing movie columns."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS movies (
+        id TEXT PRIMARY KEY,
+        title TEXT,
+        description_en TEXT,
+        year TEXT,
+        poster TEXT,
+        background TEXT,
+        genres TEXT
+    )''')
+    existing = {col[1] for col in conn.execute("PRAGMA table_info(movies)")}
+    for column, kind in MOVIE_COLUMNS.items():
+        if column not in existing:
+            conn.execute(f"ALTER TABLE movies ADD COLUMN {column} {kind}")
+    # Input hash of the result currently stored for each (movie, task)
+    conn.execute('''CREATE TABLE IF NOT EXISTS movie_tasks (
+        movie_id TEXT NOT NULL,
+        task TEXT NOT NULL,
+        input_hash TEXT NOT NULL,
+        PRIMARY KEY (movie_id, task)
+    )''')
+    # Content-addressed LLM results, shared by every title with the same description
+    conn.execute('''CREATE TABLE IF NOT EXISTS enrichment_results (
+        input_hash TEXT PRIMARY KEY,
+        task TEXT NOT NULL,
+        result TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    # Validators and content fingerprint of every catalog page seen by ingestion
+    conn.execute('''CREATE TABLE IF NOT EXISTS ingest_pages (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        fingerprint TEXT,
+        item_count INTEGER
+    )''')
+    # Durable work queue: one row per (movie, task), claimed with a lease
+    conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY,
+        movie_id TEXT NOT NULL,
+        task TEXT NOT NULL,
+        input_hash TEXT NOT NULL,
+        state TEXT NOT NULL DEFAULT 'pending', -- pending | leased | done | dead
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available_at REAL NOT NULL DEFAULT 0,
+        lease_owner TEXT,
+        lease_until REAL,
+        last_error TEXT,
+        UNIQUE (movie_id, task)
+    )''')
+    # Named singleton leases, e.g. so only one worker ingests the catalog at a time
+    conn.execute('''CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        lease_until REAL NOT NULL
+    )''')
+    # Task versions the stored results were produced with
+    conn.execute('''CREATE TABLE IF NOT EXISTS task_versions (
+        task TEXT PRIMARY KEY,
+        version TEXT NOT NULL
+    )''')
+
+def migrate_fts(conn):
+    """
+    Full-text index over title and descriptions, used by keyword/hybrid search.
+    It is an external-content FTS5 table over movies, kept in sync by triggers, so
+    ingestion and enrichment don't need to know about it.
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'movies_fts'").fetchone()
+    conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS movies_fts USING fts5(
+        title, description_en, description_it,
+        content='movies', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+    )''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS movies_fts_insert AFTER INSERT ON movies BEGIN
+        INSERT INTO movies_fts (rowid, title, description_en, description_it)
+        VALUES (new.rowid, new.title, new.description_en, new.description_it);
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS movies_fts_delete AFTER DELETE ON movies BEGIN
+        INSERT INTO movies_fts (movies_fts, rowid, title, description_en, description_it)
+        VALUES ('delete', old.rowid, old.title, old.description_en, old.description_it);
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS movies_fts_update AFTER UPDATE OF title, description_en, description_it ON movies BEGIN
+        INSERT INTO movies_fts (movies_fts, rowid, title, description_en, description_it)
+        VALUES ('delete', old.rowid, old.title, old.description_en, old.description_it);
+        INSERT INTO movies_fts (rowid, title, description_en, description_it)
+        VALUES (new.rowid, new.title, new.description_en, new.description_it);
+    END''')
+    if not exists:
+        # Index the rows that were there before the triggers
+        conn.execute("INSERT INTO movies_fts (movies_fts) VALUES ('rebuild')")
+
+def migrate_indexes(conn):
+    """Partial indexes that only hold open work, and the browse catalogs' covering index."""
+    # Movies waiting to be turned into jobs (enqueue_pending scans these by id)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_movies_pending ON movies (id) WHERE ai_classified = 0")
+    # Claimable jobs; done jobs, the vast majority, stay out of the claim indexes
+    conn.execute("DROP INDEX IF EXISTS idx_jobs_claim")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_pending ON jobs (available_at, movie_id) WHERE state = 'pending'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_leased ON jobs (lease_until, movie_id) WHERE state = 'leased'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_open ON jobs (state, movie_id) WHERE state != 'done'")
+    # Covering index for the addon's title-ordered browse catalogs (keyset on title, id)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_movies_browse ON movies (title, id, poster, genres, phobia_warnings, ai_classified)"
+    )
+
+def migrate_tag_tables(conn):
+    """
+    Normalized genres and phobia warnings, so genre catalogs and phobia filters are index
+    lookups. movies.genres / phobia_warnings stay the display copy; see sync_tags.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS movie_genres (
+        genre TEXT NOT NULL, -- genre_slug() of the name
+        movie_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        PRIMARY KEY (genre, movie_id)
+    ) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_movie_genres_movie ON movie_genres (movie_id)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS movie_phobias (
+        phobia TEXT NOT NULL,
+        movie_id TEXT NOT NULL,
+        PRIMARY KEY (phobia, movie_id)
+    ) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_movie_phobias_movie ON movie_phobias (movie_id)")
+    sync_tags(conn, [row[0] for row in conn.execute("SELECT id FROM movies")])
+
+def migrate_vector_collections(conn):
+    """
+    Pointer from the search index to its Chroma collection and embedding model.
+    A rebuild fills a 'building' collection and then swaps it with the 'active' one in
+    one transaction; the previous one is kept as 'retired' for rolling back.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS vector_collections (
+        name TEXT PRIMARY KEY,
+        model TEXT NOT NULL,
+        state TEXT NOT NULL, -- building, active or retired
+        checkpoint TEXT NOT NULL DEFAULT '', -- Last movie id embedded by the rebuild
+        indexed INTEGER NOT NULL DEFAULT 0,
+        created_at REAL,
+        activated_at REAL
+    )''')
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_vector_collections_active ON vector_collections (state) WHERE state = 'active'")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_vector_collections_building ON vector_collections (state) WHERE state = 'building'")
+    now = time.time()
+    conn.execute(
+        "INSERT OR IGNORE INTO vector_collections (name, model, state, created_at, activated_at) VALUES (?, ?, 'active', ?, ?)",
+        (INDEX_NAME, EMBED_MODEL, now, now)
+    )
+
+def migrate_index_generation(conn):
+    """Counter of writes to a collection (new vectors or metadata), read by the search API's result cache."""
+    conn.execute("ALTER TABLE vector_collections ADD COLUMN generation INTEGER NOT NULL DEFAULT 0")
+
+def migrate_genre_titles(conn):
+    """
+    A copy of the movie's title in movie_genres, kept current by triggers, so the addon's
+    genre catalogs walk (genre, title, movie_id) instead of probing every movie in title order.
+    """
+    conn.execute("ALTER TABLE movie_genres ADD COLUMN title TEXT")
+    conn.execute("UPDATE movie_genres SET title = (SELECT title FROM movies WHERE movies.id = movie_genres.movie_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_movie_genres_browse ON movie_genres (genre, title, movie_id)")
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS movie_genres_title_insert AFTER INSERT ON movie_genres BEGIN
+        UPDATE movie_genres SET title = (SELECT title FROM movies WHERE id = new.movie_id)
+        WHERE genre = new.genre AND movie_id = new.movie_id;
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS movie_genres_title_update AFTER UPDATE OF title ON movies BEGIN
+        UPDATE movie_genres SET title = new.title WHERE movie_id = new.id;
+    END''')
+
+def migrate_movie_seq(conn):
+    """
+    An INTEGER PRIMARY KEY (seq) on movies. movies_fts and the addon's "recent" cursor use
+    the rowid, and VACUUM may renumber the implicit rowid of a table keyed by TEXT; an
+    explicit one is kept. The table is rebuilt keeping the current rowids, with its indexes
+    and triggers, and the FTS index is rebuilt in case a VACUUM already renumbered it.
+    Rows without an id (which the old TEXT PRIMARY KEY let through) are dropped.
+    """
+    # Indexes on movies, and triggers on or reading it (RENAME refuses triggers naming a missing table)
+    dependents = conn.execute(
+        """SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL AND
+           ((type = 'index' AND tbl_name = 'movies') OR (type = 'trigger' AND (tbl_name = 'movies' OR sql LIKE '% movies %')))"""
+    ).fetchall()
+    for kind, name, _ in dependents:
+        if kind == "trigger":
+            conn.execute(f"DROP TRIGGER {name}")
+    columns = ["id", "title", "description_en", "year", "poster", "background", "genres", *MOVIE_COLUMNS]
+    conn.execute(f'''CREATE TABLE movies_new (
+        seq INTEGER PRIMARY KEY,
+        id TEXT NOT NULL UNIQUE,
+        title TEXT,
+        description_en TEXT,
+        year TEXT,
+        poster TEXT,
+        background TEXT,
+        genres TEXT,
+        {", ".join(f"{column} {kind}" for column, kind in MOVIE_COLUMNS.items())}
+    )''')
+    conn.execute(f"INSERT INTO movies_new (seq, {', '.join(columns)}) SELECT rowid, {', '.join(columns)} FROM movies "
+                 "WHERE id IS NOT NULL")
+    conn.execute("DROP TABLE movies")
+    conn.execute("ALTER TABLE movies_new RENAME TO movies")
+    for _, _, sql in dependents:
+        conn.execute(sql)
+    conn.execute("INSERT INTO movies_fts (movies_fts) VALUES ('rebuild')")
+
+MIGRATIONS = [migrate_base_tables, migrate_fts, migrate_indexes, migrate_tag_tables, migrate_vector_collections,
+              migrate_index_generation, migrate_genre_titles, migrate_movie_seq]
+
+def init_schema(conn):
+    """Apply the migrations this database hasn't seen yet (safe with several workers starting)."""
+    while True:
+        with immediate(conn):
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                return
+            migration = MIGRATIONS[version]
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+        print(f"Applied schema migration {version + 1}: {migration.__name__}")
+
+def sync_tags(conn, ids):
+    """Mirror movies.genres / phobia_warnings of these movies into movie_genres / movie_phobias."""
+    for start in range(0, len(ids), 500):
+        chunk = list(ids[start:start + 500])
+        marks = ",".join("?" * len(chunk))
+        rows = conn.execute(f"SELECT id, genres, phobia_warnings FROM movies WHERE id IN ({marks})", chunk).fetchall()
+        conn.execute(f"DELETE FROM movie_genres WHERE movie_id IN ({marks})", chunk)
+        conn.execute(f"DELETE FROM movie_phobias WHERE movie_id IN ({marks})", chunk)
+        conn.executemany(
+            "INSERT OR IGNORE INTO movie_genres (genre, movie_id, name) VALUES (?, ?, ?)",
+            [(genre_slug(name), m_id, name) for m_id, genres, _ in rows for name in split_tags(genres) if genre_slug(name)]
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO movie_phobias (phobia, movie_id) VALUES (?, ?)",
+            [(phobia, m_id) for m_id, _, phobias in rows for phobia in split_tags(phobias)]
+        )
+
+def sync_task_versions(conn):
+    """
+    Compare the current task versions with the stored ones.
+    If a model or prompt changed, the library is queued again; the per-task hashes make
+    sure only the affected task is actually recomputed. On the first run, movies that were
+    already classified are adopted as-is instead of being reprocessed.
+    """
+    versions = task_versions()
+    stored = dict(conn.execute("SELECT task, version FROM task_versions").fetchall())
+
+    if not stored:
+        rows = conn.execute(
+            "SELECT id, description_en FROM movies WHERE ai_classified = 1 AND description_en IS NOT NULL"
+        ).fetchall()
+        conn.executemany(
+            "INSERT OR IGNORE INTO movie_tasks (movie_id, task, input_hash) VALUES (?, ?, ?)",
+            [(m_id, task, input_hash(versions[task], desc_en)) for m_id, desc_en in rows for task in TASKS]
+        )
+        if rows:
+            print(f"Adopted {len(rows)} classified movies into task tracking.")
+    else:
+        changed = [task for task in TASKS if stored.get(task) != versions[task]]
+        if changed:
+            print(f"Task version changed for {', '.join(changed)}. Re-queueing library.")
+            conn.execute("UPDATE movies SET ai_classified = 0 WHERE ai_classified = 1 AND description_en != ''")
+
+    conn.executemany(
+        "INSERT INTO task_versions (task, version) VALUES (?, ?) ON CONFLICT(task) DO UPDATE SET version = excluded.version",
+        list(versions.items())
+    )
+    conn.commit()
+
+    # Vectors indexed with an older metadata layout get their metadata rewritten once
+    if stored.get("index_meta") != INDEX_META_VERSION:
+        try:
+            backfill_index_metadata(conn)
+        except Exception as e:
+            print(f"Index metadata backfill error: {e}")
+            return
+        conn.execute(
+            "INSERT INTO task_versions (task, version) VALUES ('index_meta', ?) "
+            "ON CONFLICT(task) DO UPDATE SET version = excluded.version",
+            (INDEX_META_VERSION,)
+        )
         conn.commit()
-    except sqlite3.OperationalError:
-        pass # Columns already exist
+
+# --- JOB QUEUE ---
+# Pending work lives in the jobs table so several worker containers can share it.
+# Claims are atomic (BEGIN IMMEDIATE); a claimed job is leased to one worker and returns
+# to the queue if that worker dies. Failures are retried with exponential backoff and
+# dead-lettered after JOB_MAX_ATTEMPTS.
+
+@contextmanager
+def immediate(conn):
+    """Run a read-then-write block in a transaction that holds the write lock from the start."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+def acquire_lease(conn, name, seconds):
+    """Take (or renew) a named lease. Returns False if another worker holds it."""
+    now = time.time()
+    with immediate(conn):
+        row = conn.execute("SELECT owner, lease_until FROM leases WHERE name = ?", (name,)).fetchone()
+        if row and row[0] != WORKER_ID and row[1] > now:
+            return False
+        conn.execute(
+            "INSERT INTO leases (name, owner, lease_until) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, lease_until = excluded.lease_until",
+            (name, WORKER_ID, now + seconds)
+        )
+    return True
+
+def enqueue_pending(conn, page_size=256):
+    """
+    Turn movies flagged ai_classified = 0 into jobs.
+    For every task the expected input hash is compared with the stored one: if it matches,
+    nothing is done; if another title already produced a result for the same input, it is
+    applied directly; otherwise a job is queued. Enqueueing is idempotent: a job whose
+    input hash is unchanged keeps its state, including dead-lettered jobs.
+    """
+    versions = task_versions()
+    last_id = ""
+    queued = 0
+    while True:
+        rows = conn.execute(
+            """SELECT id, description_en, genres FROM movies
+               WHERE ai_classified = 0 AND description_en != '' AND id > ? ORDER BY id LIMIT ?""",
+            (last_id, page_size)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        ids = [row[0] for row in rows]
+        marks = ",".join("?" * len(ids))
+        retagged = []
+
+        with immediate(conn):
+            stored = {(m_id, task): h for m_id, task, h in conn.execute(
+                f"SELECT movie_id, task, input_hash FROM movie_tasks WHERE movie_id IN ({marks})", ids)}
+            jobs = {(m_id, task): h for m_id, task, h in conn.execute(
+                f"SELECT movie_id, task, input_hash FROM jobs WHERE movie_id IN ({marks})", ids)}
+            wanted = [input_hash(versions[task], row[1]) for row in rows for task in LLM_TASKS]
+            cached = {}
+            for start in range(0, len(wanted), 500):
+                chunk = wanted[start:start + 500]
+                for h, result in conn.execute(
+                    f"SELECT input_hash, result FROM enrichment_results WHERE input_hash IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ):
+                    cached[h] = json.loads(result)
+
+            for m_id, desc_en, genres in rows:
+                reused = {}
+                open_tasks = 0
+                for task in TASKS:
+                    h = input_hash(versions[task], desc_en)
+                    if stored.get((m_id, task)) == h:
+                        continue
+                    if h in cached:
+                        reused[task] = cached[h]
+                        conn.execute(
+                            """INSERT INTO movie_tasks (movie_id, task, input_hash) VALUES (?, ?, ?)
+                               ON CONFLICT(movie_id, task) DO UPDATE SET input_hash = excluded.input_hash""",
+                            (m_id, task, h)
+                        )
+                        continue
+                    open_tasks += 1
+                    if jobs.get((m_id, task)) != h:
+                        conn.execute(
+                            """INSERT INTO jobs (movie_id, task, input_hash) VALUES (?, ?, ?)
+                               ON CONFLICT(movie_id, task) DO UPDATE SET input_hash = excluded.input_hash,
+                               state = 'pending', attempts = 0, available_at = 0,
+                               lease_owner = NULL, lease_until = NULL, last_error = NULL""",
+                            (m_id, task, h)
+                        )
+                        queued += 1
+
+                if reused:
+                    conn.execute(
+                        """UPDATE movies SET description_it = COALESCE(?, description_it), genres = ?,
+                           phobia_warnings = COALESCE(?, phobia_warnings) WHERE id = ?""",
+                        (reused.get("translate"),
+                         with_animal_horror(genres, reused["classify"]) if "classify" in reused else genres,
+                         ", ".join(reused["phobia"]) if "phobia" in reused else None,
+                         m_id)
+                    )
+                    if {"classify", "phobia"} & set(reused):
+                        retagged.append(m_id)
+                if not open_tasks:
+                    conn.execute("UPDATE movies SET ai_classified = 1 WHERE id = ?", (m_id,))
+            sync_tags(conn, retagged)
+        try:
+            update_index_metadata(conn, retagged)
+        except Exception as e:
+            print(f"Index metadata update error: {e}")
+    if queued:
+        print(f"Queued {queued} new jobs.")
+    return queued
+
+def claim_jobs(conn, limit):
+    """
+    Atomically lease the claimable jobs of up to `limit` movies.
+    All open tasks of a movie are claimed together so structured enrichment can answer them
+    with one LLM call. Returns pipeline items (one per movie).
+    """
+    now = time.time()
+    with sqlite_seconds.time(query="claim"), immediate(conn):
+        # Expired leases that have used up their attempts go to the dead-letter state
+        conn.execute(
+            "UPDATE jobs SET state = 'dead', last_error = 'lease expired' "
+            "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+            (now, JOB_MAX_ATTEMPTS)
+        )
+        claimable = "((j.state = 'pending' AND j.available_at <= :now) OR (j.state = 'leased' AND j.lease_until < :now))"
+        # One branch per partial index, so done jobs are never scanned
+        movie_ids = [row[0] for row in conn.execute(
+            """SELECT movie_id FROM (
+                   SELECT movie_id, available_at FROM jobs WHERE state = 'pending' AND available_at <= :now
+                   UNION ALL
+                   SELECT movie_id, available_at FROM jobs WHERE state = 'leased' AND lease_until < :now
+               ) GROUP BY movie_id ORDER BY MIN(available_at) LIMIT :limit""",
+            {"now": now, "limit": limit}
+        )]
+        if not movie_ids:
+            return []
+        params = {"now": now}
+        params.update({f"m{i}": m_id for i, m_id in enumerate(movie_ids)})
+        marks = ",".join(f":m{i}" for i in range(len(movie_ids)))
+        rows = conn.execute(
+            f"""SELECT j.id, j.movie_id, j.task, m.title, m.description_en, m.genres, m.year, m.phobia_warnings
+                FROM jobs j JOIN movies m ON m.id = j.movie_id
+                WHERE j.movie_id IN ({marks}) AND {claimable}""",
+            params
+        ).fetchall()
+        conn.executemany(
+            "UPDATE jobs SET state = 'leased', lease_owner = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+            [(WORKER_ID, now + JOB_LEASE_SECONDS, row[0]) for row in rows]
+        )
+
+    versions = task_versions()
+    items = {}
+    for job_id, m_id, task, title, desc_en, genres, year, phobias in rows:
+        item = items.setdefault(m_id, {
+            "id": m_id,
+            "title": title,
+            "desc_en": desc_en,
+            "genres": genres,
+            "year": year,
+            "phobias": split_tags(phobias),
+            "hashes": {},
+            "result_hashes": {}, # Cache keys of results from the fallback prompts, see enrich_stage
+            "job_ids": {},
+            "todo": [],
+            "results": {},
+            "record": [], # Tasks that produced a result
+            "errors": {},
+            "deferred": set(), # Tasks hit by an outage, see defer_job
+        })
+        # Hash of the current description; if it changed since enqueueing, the result is
+        # recorded under the new hash and the stale job is simply settled.
+        item["hashes"][task] = input_hash(versions[task], desc_en or "")
+        item["job_ids"][task] = job_id
+        item["todo"].append(task)
+    return list(items.values())
+
+def fail_job(conn, job_id, error, now):
+    """Return a failed job to the queue with exponential backoff, or dead-letter it."""
+    row = conn.execute("SELECT attempts, task FROM jobs WHERE id = ? AND lease_owner = ?", (job_id, WORKER_ID)).fetchone()
+    if not row:
+        return # Lease lost to another worker
+    attempts, task = row
+    task_failures.inc(task=task)
+    if attempts >= JOB_MAX_ATTEMPTS:
+        dead_jobs.inc(task=task)
+        conn.execute(
+            "UPDATE jobs SET state = 'dead', lease_owner = NULL, lease_until = NULL, last_error = ? WHERE id = ?",
+            (error, job_id)
+        )
+        print(f"Job {job_id} dead-lettered after {attempts} attempts: {error}")
+        return
+    delay = min(JOB_RETRY_SECONDS * 2 ** (attempts - 1), 3600) * random.uniform(0.8, 1.2)
+    conn.execute(
+        """UPDATE jobs SET state = 'pending', available_at = ?, lease_owner = NULL, lease_until = NULL,
+           last_error = ? WHERE id = ?""",
+        (now + delay, error, job_id)
+    )
+
+def defer_job(conn, job_id, error, now):
+    """Return a job that failed because a backend was down to the queue, giving back its attempt."""
+    conn.execute(
+        """UPDATE jobs SET state = 'pending', available_at = ?, attempts = MAX(attempts - 1, 0),
+           lease_owner = NULL, lease_until = NULL, last_error = ? WHERE id = ? AND lease_owner = ?""",
+        (now + OUTAGE_RETRY_SECONDS * random.uniform(0.8, 1.2), error, job_id, WORKER_ID)
+    )
+
+def requeue_dead(conn, task=None):
+    """Give dead-lettered jobs (of one task, or all) a fresh set of attempts. Returns how many."""
+    with immediate(conn):
+        count = conn.execute(
+            """UPDATE jobs SET state = 'pending', attempts = 0, available_at = 0, lease_owner = NULL,
+               lease_until = NULL, last_error = NULL WHERE state = 'dead' AND (? IS NULL OR task = ?)""",
+            (task, task)
+        ).rowcount
+    print(f"Requeued {count} dead jobs.")
+    return count
+
+def backlog_stats(conn):
+    """Number of jobs per state, for logging and the backlog gauge."""
+    stats = dict(conn.execute("SELECT state, COUNT(*) FROM jobs WHERE state != 'done' GROUP BY state").fetchall())
+    for state in ("pending", "leased", "dead"):
+        backlog_jobs.set(stats.get(state, 0), state=state)
+    return stats
+
+# --- LOCAL VECTOR SNAPSHOT ---
+# search_service can answer queries from a memory-mapped copy of the Chroma collection.
+# A snapshot is a matrix file (.npy), squared norms (and int8 scales) plus a JSON id table;
+# current.json names the active one and is swapped atomically after all files are written.
+
+def write_atomic(path, write):
+    """Write a file through a temporary name so readers never see a partial file."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def export_vectors(page_size=1000):
+    """Dump the active Chroma collection into a new local snapshot and make it current."""
+    name, model = index_targets[0]
+    collection = get_collection(name)
+    ids, titles, metadatas, chunks = [], [], [], []
+    offset = 0
+    while True:
+        with chroma_seconds.time(op="get"):
+            page = collection.get(include=["embeddings", "metadatas"], limit=page_size, offset=offset)
+        if not len(page["ids"]):
+            break
+        ids.extend(page["ids"])
+        titles.extend((meta or {}).get("title") for meta in page["metadatas"])
+        metadatas.extend(meta or {} for meta in page["metadatas"])
+        chunks.append(np.asarray(page["embeddings"], dtype=np.float32))
+        offset += len(page["ids"])
+    if not ids:
+        return
+
+    matrix = np.vstack(chunks)
+    stamp = str(time.time_ns())
+    files = {"vectors": f"vectors-{stamp}.npy", "norms": f"norms-{stamp}.npy", "ids": f"ids-{stamp}.json"}
+    os.makedirs(VECTOR_INDEX_DIR, exist_ok=True)
+    path = lambda name: os.path.join(VECTOR_INDEX_DIR, name)
+
+    # Squared norms of the original vectors, so search reproduces Chroma's (squared) L2 distance
+    write_atomic(path(files["norms"]), lambda f: np.save(f, np.einsum("ij,ij->i", matrix, matrix)))
+    if VECTOR_INDEX == "int8":
+        # Symmetric per-row quantization: vector ~= scale * int8 row
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+        files["scales"] = f"scales-{stamp}.npy"
+        write_atomic(path(files["scales"]), lambda f: np.save(f, scales.astype(np.float32)))
+        write_atomic(path(files["vectors"]), lambda f: np.save(f, quantized))
+    else:
+        write_atomic(path(files["vectors"]), lambda f: np.save(f, matrix))
+    write_atomic(path(files["ids"]), lambda f: f.write(json.dumps({"ids": ids, "titles": titles, "metadatas": metadatas}).encode()))
+
+    manifest = {"stamp": stamp, "dtype": VECTOR_INDEX, "count": len(ids), "dim": matrix.shape[1],
+                "model": model, "collection": name, "files": files}
+    write_atomic(path("current.json"), lambda f: f.write(json.dumps(manifest).encode()))
+    print(f"Exported {len(ids)} vectors ({VECTOR_INDEX}) to {VECTOR_INDEX_DIR}")
+
+    # Keep the previous snapshot for readers that still have it mapped, remove older ones
+    stamps = sorted({name.split("-", 1)[1].split(".")[0] for name in os.listdir(VECTOR_INDEX_DIR) if "-" in name})
+    for old in stamps[:-2]:
+        for name in os.listdir(VECTOR_INDEX_DIR):
+            if f"-{old}." in name:
+                os.remove(path(name))
+
+# --- INDEX REBUILD ---
+# `python metadata_worker.py rebuild [model]` re-embeds the library into a new, versioned
+# collection while search keeps using the active one, then flips the vector_collections
+# pointer. Progress is checkpointed per page: running the command again resumes.
+
+def start_rebuild(conn, model):
+    """The collection being built for `model`, resumed or created. Returns (name, checkpoint)."""
+    with immediate(conn):
+        row = conn.execute("SELECT name, model, checkpoint FROM vector_collections WHERE state = 'building'").fetchone()
+        if row and row[1] == model:
+            return row[0], row[2]
+        if row:
+            print(f"Abandoning the rebuild of {row[0]} ({row[1]}).")
+            conn.execute("UPDATE vector_collections SET state = 'retired' WHERE name = ?", (row[0],))
+        name = f"{INDEX_NAME}_{time.strftime('%Y%m%d%H%M%S')}"
+        conn.execute(
+            "INSERT INTO vector_collections (name, model, state, created_at) VALUES (?, ?, 'building', ?)",
+            (name, model, time.time())
+        )
+    return name, ""
+
+def rebuild_items(rows):
+    return [{"id": m_id, "title": title, "year": year, "genres": genres, "phobias": split_tags(phobias),
+             "desc_en": desc_en, "results": {}} for m_id, title, year, genres, phobias, desc_en in rows]
+
+REBUILD_COLUMNS = "id, title, year, genres, phobia_warnings, description_en"
+
+def missing_from_collection(conn, name, page_size=500):
+    """Movies with a description that have no vector in collection `name`."""
+    missing = []
+    last_id = ""
+    while True:
+        rows = conn.execute(
+            f"SELECT {REBUILD_COLUMNS} FROM movies WHERE description_en != '' AND id > ? ORDER BY id LIMIT ?",
+            (last_id, page_size)
+        ).fetchall()
+        if not rows:
+            return missing
+        with chroma_seconds.time(op="get"):
+            present = set(get_collection(name).get(ids=[row[0] for row in rows], include=[])["ids"])
+        missing.extend(row for row in rows if row[0] not in present)
+        last_id = rows[-1][0]
+
+def rebuild_index(conn, model=EMBED_MODEL):
+    """
+    Embed every described movie with `model` into a new collection and make it the active one.
+    Pages of REBUILD_PAGE_SIZE movies are embedded in EMBED_BATCH_SIZE batches, up to
+    OLLAMA_SLOTS at once. Pipeline workers write new embeddings into both collections
+    meanwhile; a final pass fills in whatever is still missing before the pointer flips.
+    """
+    name, checkpoint = start_rebuild(conn, model)
+    load_index_targets(conn)
+    print(f"Rebuilding the vector index into {name} with {model}" + (f", resuming after {checkpoint}" if checkpoint else ""))
+
+    with ThreadPoolExecutor(max_workers=OLLAMA_SLOTS) as pool:
+        def embed_page(items):
+            """Ids of the items that could not be embedded."""
+            batches = [items[start:start + EMBED_BATCH_SIZE] for start in range(0, len(items), EMBED_BATCH_SIZE)]
+            return [m_id for errors in pool.map(lambda batch: embed_into(name, model, batch), batches) for m_id in errors]
+
+        while True:
+            if not acquire_lease(conn, "rebuild", JOB_LEASE_SECONDS):
+                print("Another worker is running the rebuild.")
+                return False
+            rows = conn.execute(
+                f"SELECT {REBUILD_COLUMNS} FROM movies WHERE description_en != '' AND id > ? ORDER BY id LIMIT ?",
+                (checkpoint, REBUILD_PAGE_SIZE)
+            ).fetchall()
+            if not rows:
+                break
+            try:
+                failed = embed_page(rebuild_items(rows))
+            except BackendUnavailable as e:
+                print(f"Rebuild stopped, {e}. Run it again to resume after {checkpoint or 'the start'}.")
+                return False
+            checkpoint = rows[-1][0]
+            with immediate(conn):
+                conn.execute(
+                    "UPDATE vector_collections SET checkpoint = ?, indexed = indexed + ? WHERE name = ?",
+                    (checkpoint, len(rows) - len(failed), name)
+                )
+            print(f"Rebuild checkpoint {checkpoint}: {len(rows) - len(failed)}/{len(rows)} embedded")
+
+        # Movies that failed above, or were described before the pipeline wrote to both collections
+        missing = missing_from_collection(conn, name)
+        if missing:
+            print(f"Embedding {len(missing)} movies missing from {name}...")
+            try:
+                failed = embed_page(rebuild_items(missing))
+            except BackendUnavailable as e:
+                failed = missing
+                print(f"Rebuild stopped, {e}.")
+            if failed:
+                print(f"{len(failed)} movies could not be embedded; run the rebuild again to retry. Search still uses the old index.")
+                return False
+
+    with immediate(conn):
+        old = conn.execute("SELECT name FROM vector_collections WHERE state = 'active'").fetchone()
+        conn.execute("UPDATE vector_collections SET state = 'retired' WHERE state = 'active'")
+        conn.execute(
+            "UPDATE vector_collections SET state = 'active', activated_at = ?, "
+            "indexed = (SELECT COUNT(*) FROM movies WHERE description_en != '') WHERE name = ?",
+            (time.time(), name)
+        )
+        # The rebuild did the embed task for the new model: record it, or the library would be queued again.
+        # Movies with open jobs keep their old hash; their job embeds the current description.
+        version = task_versions(model)["embed"]
+        conn.execute(
+            "INSERT INTO task_versions (task, version) VALUES ('embed', ?) "
+            "ON CONFLICT(task) DO UPDATE SET version = excluded.version",
+            (version,)
+        )
+        conn.executemany(
+            "UPDATE movie_tasks SET input_hash = ? WHERE movie_id = ? AND task = 'embed'",
+            [(input_hash(version, desc_en), m_id) for m_id, desc_en in
+             conn.execute(
+                 "SELECT id, description_en FROM movies WHERE description_en != '' AND ai_classified = 1 "
+                 "AND id NOT IN (SELECT movie_id FROM jobs WHERE state != 'done')"
+             ).fetchall()]
+        )
+    load_index_targets(conn)
+    print(f"Search now uses {name} ({model}); {old[0] if old else 'nothing'} is kept for rolling back.")
+    return True
+
+def catalog_row(m):
+    """Map a Stremio catalog meta to the movies columns used by ingestion."""
+    return (
+        m.get('id'),
+        m.get('name'),
+        m.get('description'),
+        m.get('releaseInfo'),
+        m.get('poster'),
+        m.get('background'),
+        ", ".join(m.get('genres', [])) if isinstance(m.get('genres'), list) else m.get('genres')
+    )
+
+def save_page(conn, url, validators, fingerprint, item_count):
+    """Remember a catalog page's ETag/Last-Modified and content fingerprint for the next cycle."""
+    conn.execute("""
+        INSERT INTO ingest_pages (url, etag, last_modified, fingerprint, item_count)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(url) DO UPDATE SET
+        etag=excluded.etag,
+        last_modified=excluded.last_modified,
+        fingerprint=excluded.fingerprint,
+        item_count=excluded.item_count
+    """, (url, validators[0], validators[1], fingerprint, item_count))
 
 def ingest_from_api(conn):
-    """Downloads catalog data from the external Vixsrc Addon API."""
+    """
+    Downloads catalog data from the external Vixsrc Addon API.
+    Pages are fetched over a persistent session with conditional requests. A page that
+    answers 304 or whose content fingerprint is unchanged is skipped without touching
+    the movies table; changed pages are upserted in one transaction.
+    """
     print("--- Starting API Ingestion ---")
     base_url = os.environ.get("VIXSRC_URL", "http://godmode-vixsrc-addon:3000/catalog/movie/vixsrc_movies")
     skip = 0
     total_ingested = 0
+    unchanged_pages = 0
+    started = time.monotonic()
     
     while True:
         url = f"{base_url}/skip={skip}.json" if skip > 0 else f"{base_url}.json"
         try:
-            print(f"Fetching: {url}")
-            resp = requests.get(url, timeout=10)
+            page = conn.execute(
+                "SELECT etag, last_modified, fingerprint, item_count FROM ingest_pages WHERE url = ?", (url,)
+            ).fetchone()
+            headers = {}
+            if page and page[0]:
+                headers["If-None-Match"] = page[0]
+            if page and page[1]:
+                headers["If-Modified-Since"] = page[1]
+
+            resp = catalog_session.get(url, headers=headers, timeout=10)
+            if resp.status_code == 304 and page: # Not modified since last cycle
+                unchanged_pages += 1
+                if not page[3]:
+                    break
+                skip += page[3]
+                continue
             if resp.status_code == 404: # End of catalog
                 break
             resp.raise_for_status()
@@ -101,29 +1361,34 @@ def ingest_from_api(conn):
             if not metas:
                 print("No more items found.")
                 break
-                
-            print(f"Ingesting batch of {len(metas)} items...")
-            cursor = conn.cursor()
-            for m in metas:
-                # Upsert movie
-                cursor.execute("""
-                    INSERT INTO movies (id, title, description_en, year, poster, background, genres)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(id) DO UPDATE SET
-                    title=excluded.title,
-                    description_en=excluded.description_en,
-                    poster=excluded.poster
-                """, (
-                    m.get('id'),
-                    m.get('name'),
-                    m.get('description'),
-                    m.get('releaseInfo'),
-                    m.get('poster'),
-                    m.get('background'),
-                    ", ".join(m.get('genres', [])) if isinstance(m.get('genres'), list) else m.get('genres')
-                ))
-            conn.commit()
-            total_ingested += len(metas)
+
+            fingerprint = hashlib.sha256(json.dumps(metas, sort_keys=True).encode()).hexdigest()
+            validators = (resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+            if page and page[2] == fingerprint:
+                # Same content as last cycle: only refresh the validators if the server rotated them
+                unchanged_pages += 1
+                if validators != (page[0], page[1]):
+                    with conn:
+                        save_page(conn, url, validators, fingerprint, len(metas))
+            else:
+                print(f"Ingesting batch of {len(metas)} items...")
+                rows = [catalog_row(m) for m in metas if m.get('id')]
+                if len(rows) < len(metas):
+                    print(f"Skipping {len(metas) - len(rows)} items without an id.")
+                with conn:
+                    # Upsert movies; a changed description re-queues the movie for enrichment
+                    conn.executemany("""
+                        INSERT INTO movies (id, title, description_en, year, poster, background, genres)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(id) DO UPDATE SET
+                        title=excluded.title,
+                        description_en=excluded.description_en,
+                        poster=excluded.poster,
+                        ai_classified=CASE WHEN description_en IS excluded.description_en THEN ai_classified ELSE 0 END
+                    """, rows)
+                    sync_tags(conn, [row[0] for row in rows])
+                    save_page(conn, url, validators, fingerprint, len(metas))
+                total_ingested += len(metas)
             skip += len(metas)
             
             # Safety break for dev
@@ -133,113 +1398,242 @@ def ingest_from_api(conn):
             print(f"Ingestion Error: {e}")
             break
     
-    print(f"--- Ingestion Complete. Total: {total_ingested} ---")
+    elapsed = time.monotonic() - started
+    print(f"--- Ingestion Complete. Upserted: {total_ingested}, unchanged pages: {unchanged_pages} ({elapsed:.1f}s) ---")
+
+# --- ENRICHMENT PIPELINE ---
+# reader (main thread) -> enrich_q -> N LLM threads -> embed_q -> embedder -> write_q -> writer
+# Queues are bounded so a slow stage applies backpressure instead of buffering the whole library.
+_DONE = object() # End-of-stream marker passed between stages
+
+def feed_jobs(conn, enrich_q, items):
+    """Reader stage: keep claiming jobs until the queue has nothing claimable left or a backend is down."""
+    queued = 0
+    while items:
+        for item in items:
+            enrich_q.put(item)
+            queued += 1
+        if outage.is_set():
+            print("Ollama or Chroma unavailable, not claiming more jobs.")
+            break
+        items = claim_jobs(conn, CLAIM_BATCH)
+    return queued
+
+def enrich_stage(enrich_q, embed_q, memo, memo_lock):
+    """
+    LLM stage: translate and classify movies. Several of these run in parallel.
+    `memo` holds the results computed during this run by input hash, so duplicate
+    descriptions queued before the first result was saved are not sent to the LLM again.
+    """
+    while True:
+        job = enrich_q.get()
+        if job is _DONE:
+            embed_q.put(_DONE)
+            return
+        tasks = [task for task in job["todo"] if task in LLM_TASKS]
+        with memo_lock:
+            answers = {task: memo[job["hashes"][task]] for task in tasks if job["hashes"][task] in memo}
+        tasks = [task for task in tasks if task not in answers]
+        if tasks and outage.is_set():
+            defer(job, tasks, "backend unavailable earlier in this run") # Don't call a backend that's down
+        elif tasks:
+            print(f"Processing: {job['title']} ({', '.join(tasks)})")
+            try:
+                # Task A + B: Translate, Animal Horror check and phobia filter
+                computed, mode = enrich(job["desc_en"], tasks)
+            except BackendUnavailable as e:
+                print(f"Enrichment deferred for {job['title']}: {e}")
+                outage.set()
+                computed = {}
+                defer(job, tasks, e)
+            except Exception as e:
+                print(f"Enrichment Error for {job['title']}: {e}")
+                computed = {}
+                for task in tasks:
+                    job["errors"][task] = str(e)
+            if computed and mode != ENRICH_MODE:
+                # Cache fallback answers under their own prompts' version, so titles with the same
+                # description don't reuse them as structured answers
+                fallback = task_versions(mode=mode)
+                for task in computed:
+                    job["result_hashes"][task] = input_hash(fallback[task], job["desc_en"] or "")
+            with memo_lock:
+                for task, result in computed.items():
+                    memo[job["result_hashes"].get(task, job["hashes"][task])] = result
+            answers.update(computed)
+            print(f"Enriched {job['title']}. (Animal Horror: {answers.get('classify')} | Phobias: {answers.get('phobia')})")
+        job["results"].update(answers)
+        job["record"].extend(answers)
+        embed_q.put(job)
+
+def embed_stage(embed_q, write_q, producers):
+    """
+    Task C: Semantic Indexing.
+    We index the English description so we can search by meaning. Items are grouped into
+    batches of EMBED_BATCH_SIZE; a partial batch is flushed if nothing arrives for a while.
+    """
+    batch = []
+    remaining = producers
+
+    def flush():
+        embed_batch(batch)
+        write_q.put(list(batch))
+
+    while remaining:
+        try:
+            item = embed_q.get(timeout=EMBED_FLUSH_SECONDS)
+        except queue.Empty:
+            if batch:
+                flush()
+                batch = []
+            continue
+        if item is _DONE:
+            remaining -= 1
+            continue
+        batch.append(item)
+        if len(batch) >= EMBED_BATCH_SIZE:
+            flush()
+            batch = []
+
+    if batch:
+        flush()
+    write_q.put(_DONE)
+
+def write_stage(write_q, stats):
+    """Single writer: the only thread that writes enrichment results to SQLite."""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        while True:
+            batch = write_q.get()
+            if batch is _DONE:
+                return
+            try:
+                with sqlite_seconds.time(query="save_batch"):
+                    save_batch(conn, batch)
+            except sqlite3.Error as e:
+                # The jobs stay leased and are retried once their lease expires
+                print(f"DB Error, dropping batch of {len(batch)}: {e}")
+                continue
+            # Movies that were re-classified without being re-embedded keep stale filter metadata
+            stale = [item["id"] for item in batch
+                     if "embed" not in item["record"] and {"classify", "phobia"} & set(item["record"])]
+            try:
+                update_index_metadata(conn, stale)
+            except Exception as e:
+                print(f"Index metadata update error: {e}")
+            stats["done"] += len(batch)
+            titles_done.inc(len(batch))
+            elapsed = time.monotonic() - stats["started"]
+            titles_per_minute.set(stats["done"] / elapsed * 60)
+            print(f"Saved {stats['done']} movies ({stats['done'] / elapsed:.2f} items/sec)")
+    finally:
+        conn.close()
+
+def run_pipeline(conn):
+    """
+    Claim jobs and run them through enrichment, embedding and saving concurrently.
+    Returns the number of movies processed (0 if nothing was claimable).
+    """
+    load_index_targets(conn)
+    outage.clear()
+    items = claim_jobs(conn, CLAIM_BATCH)
+    if not items:
+        return 0
 
-def process_library():
+    # The LLM stage only holds what has been claimed, so leases aren't spent waiting in a queue
+    enrich_q = queue.Queue(maxsize=CLAIM_BATCH)
+    embed_q = queue.Queue(maxsize=QUEUE_SIZE)
+    write_q = queue.Queue(maxsize=max(1, QUEUE_SIZE // EMBED_BATCH_SIZE))
+    stats = {"done": 0, "started": time.monotonic()}
+    memo, memo_lock = {}, threading.Lock()
+
+    threads = [threading.Thread(target=enrich_stage, args=(enrich_q, embed_q, memo, memo_lock), daemon=True)
+               for _ in range(OLLAMA_SLOTS)]
+    threads.append(threading.Thread(target=embed_stage, args=(embed_q, write_q, OLLAMA_SLOTS), daemon=True))
+    threads.append(threading.Thread(target=write_stage, args=(write_q, stats), daemon=True))
+    for t in threads:
+        t.start()
+
+    try:
+        queued = feed_jobs(conn, enrich_q, items)
+    finally:
+        for _ in range(OLLAMA_SLOTS):
+            enrich_q.put(_DONE)
+    for t in threads:
+        t.join()
+
+    elapsed = time.monotonic() - stats["started"]
+    print(f"Processed {stats['done']}/{queued} movies in {elapsed:.1f}s ({stats['done'] / elapsed:.2f} items/sec)")
+    return stats["done"]
+
+def open_db():
     if not os.path.exists(os.path.dirname(DB_PATH)):
         os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, timeout=30)
     conn.execute("PRAGMA journal_mode=WAL;")
     
     # Ensure Schema Exists
     try:
-        cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS movies (
-            id TEXT PRIMARY KEY,
-            title TEXT,
-            description_en TEXT,
-            year TEXT,
-            poster TEXT,
-            background TEXT,
-            genres TEXT,
-            description_it TEXT,
-            ai_classified INTEGER DEFAULT 0,
-            phobia_warnings TEXT
-        )''')
+        init_schema(conn)
     except Exception as e:
         print(f"Schema Init Error: {e}")
+    return conn
 
-    # 1. Run Ingestion (New Logic)
-    ingest_from_api(conn)
-
-    cursor = conn.cursor()
-
-    # 1. TRANSLATION & CLASSIFICATION TASK
-    # Select movies that haven't been classified yet
-    cursor.execute("SELECT id, title, description_en, genres FROM movies WHERE ai_classified = 0")
-    movies = cursor.fetchall()
-
-    for m_id, title, desc_en, genres in movies:
-        print(f"Processing: {title}")
-
-        if not desc_en:
-            print(f"Skipping {title} (No description)")
-            continue
-
-        # Task A: Translate to Italian
-        it_prompt = "Translate the following movie description into natural, professional Italian. Return ONLY the translation."
-        desc_it = ask_llm(it_prompt, desc_en)
-
-        # Task B: Animal Horror Check
-        horror_prompt = (
-            "Analyze if this movie belongs to the 'Animal Horror' sub-genre (animals or creatures as antagonists). "
-            "Answer ONLY with 'YES' or 'NO'."
-        )
-        is_horror = ask_llm(horror_prompt, desc_en)
-        
-        # Task B.2: Phobia Filter
-        phobias = ["spiders", "snakes", "clowns", "heights", "blood"]
-        phobia_prompt = (
-            f"Analyze the movie description for these triggers: {', '.join(phobias)}. "
-            "Return a comma-separated list of triggers found. If none, return 'NONE'. "
-            "Return ONLY the list."
-        )
-        phobia_tags = ask_llm(phobia_prompt, desc_en)
-        if "NONE" in phobia_tags.upper():
-            phobia_tags = ""
-
-        # Task C: Semantic Indexing
-        # We index the English description so we can search by meaning
-        vector = get_embedding(desc_en)
-        if vector:
-            collection.upsert(
-                ids=[str(m_id)],
-                embeddings=[vector],
-                metadatas={"title": title, "year": "2024"}, # Simplified metadata
-                documents=[desc_en]
-            )
+def process_library(conn):
+    """Ingest the catalog and queue jobs for new or changed movies. Only one worker does this at a time."""
+    if not acquire_lease(conn, "ingest", INGEST_INTERVAL):
+        return
 
-        # Update Genres if it's Animal Horror
-        new_genres = genres
-        if is_horror and "YES" in is_horror.upper():
-            new_genres = f"{genres}, Animal Horror" if genres else "Animal Horror"
+    load_index_targets(conn)
+    sync_task_versions(conn)
 
-        # Save to DB
-        # Ensure column exists handled in main loop setup (or manually added) - adding to query
-        try:
-             cursor.execute(
-                "UPDATE movies SET description_it = ?, genres = ?, ai_classified = 1, phobia_warnings = ? WHERE id = ?",
-                (desc_it, new_genres, phobia_tags, m_id)
-            )
-        except sqlite3.OperationalError:
-            # Fallback if column missing (should be added in setup)
-            cursor.execute(
-                "UPDATE movies SET description_it = ?, genres = ?, ai_classified = 1 WHERE id = ?",
-                (desc_it, new_genres, m_id)
-            )
-
-        conn.commit()
-        print(f"Finished {title}. (Animal Horror: {is_horror} | Phobias: {phobia_tags})")
+    # 1. Run Ingestion (New Logic)
+    ingest_from_api(conn)
 
-    conn.close()
+    # 2. Queue TRANSLATION, CLASSIFICATION & INDEXING jobs
+    enqueue_pending(conn)
+    print(f"Backlog: {backlog_stats(conn)}")
 
 if __name__ == "__main__":
     # Wait for other containers to be ready
     wait_for_services()
+    threading.Thread(target=common.check_ollama, args=(ollama, requests, ollama_pool.OLLAMA_CHECK_INTERVAL),
+                     daemon=True).start()
+    conn = open_db()
+    load_index_targets(conn)
+    if sys.argv[1:2] == ["rebuild"]:
+        sys.exit(0 if rebuild_index(conn, *sys.argv[2:3]) else 1)
+    if sys.argv[1:2] == ["requeue-dead"]:
+        requeue_dead(conn, *sys.argv[2:3])
+        sys.exit(0)
+    if WARMUP:
+        warm_up_models()
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
     
-    # Main Loop
+    # Main Loop: ingest every INGEST_INTERVAL, work the job queue in between
+    last_ingest = None
+    last_export = time.monotonic() - VECTOR_EXPORT_INTERVAL
+    vectors_dirty = VECTOR_INDEX != "off" and not os.path.exists(os.path.join(VECTOR_INDEX_DIR, "current.json"))
+    active_index = index_targets[0]
     while True:
-        process_library()
-        print("Batch complete. Sleeping for 5 minutes...")
-        time.sleep(300) # Check for new movies every 5 minutes
+        if last_ingest is None or time.monotonic() - last_ingest >= INGEST_INTERVAL:
+            process_library(conn)
+            last_ingest = time.monotonic()
+        processed = run_pipeline(conn)
+        if (processed or index_targets[0] != active_index) and VECTOR_INDEX != "off":
+            vectors_dirty = True # New vectors, or a rebuild switched the active collection
+        active_index = index_targets[0]
+        if vectors_dirty and time.monotonic() - last_export >= VECTOR_EXPORT_INTERVAL:
+            last_export = time.monotonic()
+            if acquire_lease(conn, "vector_export", VECTOR_EXPORT_INTERVAL):
+                try:
+                    export_vectors()
+                    vectors_dirty = False
+                except Exception as e:
+                    print(f"Vector export error: {e}")
+        if outage.is_set():
+            wait_for_services() # Deferred jobs come back once Ollama and Chroma answer again
+        elif not processed:
+            time.sleep(JOB_POLL_SECONDS) # Queue empty, poll for work from other workers' ingestion
@@ -0,0 +1,212 @@
+"""
+Minimal Prometheus-style metrics shared by the worker, the search API and the addon.
+Counters, gauges and histograms with labels are rendered in the text exposition format.
+A request id (X-Request-ID) and the timings of the stages a request went through are
+kept in context variables, so a slow request can be traced to the stage that was slow.
+"""
+import bisect
+import contextvars
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 1.0)) # Requests slower than this are logged with their stages
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_lock = threading.Lock()
+_registry = []
+
+request_id = contextvars.ContextVar("request_id", default=None)
+_stages = contextvars.ContextVar("stages", default=None)
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {} # label values tuple -> value
+        with _lock:
+            _registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def samples(self):
+        """[(suffix, labels dict, value)] for rendering."""
+        with _lock:
+            items = list(self.values.items())
+        return [("", dict(zip(self.labels, key)), value) for key, value in items]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """A settable gauge, or a callback gauge when `fn` is given (called at scrape time)."""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with _lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.fn is None:
+            return super().samples()
+        value = self.fn()
+        if isinstance(value, dict):
+            # {label value: value} for a gauge with one label
+            return [("", {self.labels[0]: k}, v) for k, v in value.items()]
+        return [("", {}, value)]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with _lock:
+            counts, total = self.values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, stage=None, **labels):
+        """Observe the duration of the block; with `stage`, also record it in the request trace."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(elapsed, **labels)
+            if stage:
+                record_stage(stage, elapsed)
+
+    def samples(self):
+        with _lock:
+            items = [(key, list(counts), total[0]) for key, (counts, total) in self.values.items()]
+        samples = []
+        for key, counts, total in items:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append(("_bucket", {**labels, "le": le}, cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render():
+    """All registered metrics in the Prometheus text format."""
+    lines = []
+    with _lock:
+        metrics = list(_registry)
+    for metric in metrics:
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            print(f"Metrics error ({metric.name}): {e}")
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in samples:
+            label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            lines.append(f"{metric.name}{suffix}{{{label_text}}} {float(value)!r}" if label_text
+                         else f"{metric.name}{suffix} {float(value)!r}")
+    return "\n".join(lines) + "\n"
+
+# --- Request tracing ---
+
+def start_trace(rid=None):
+    """Start tracing the current request (or task) under `rid`, or a new id."""
+    rid = rid or uuid.uuid4().hex[:16]
+    request_id.set(rid)
+    _stages.set([])
+    return rid
+
+def record_stage(name, seconds):
+    stages = _stages.get()
+    if stages is not None:
+        stages.append((name, seconds))
+
+def trace_summary():
+    """The stages recorded for the current request, e.g. "embed=812.0ms vector=4.1ms"."""
+    return " ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in _stages.get() or [])
+
+def server_timing():
+    """The recorded stages as a Server-Timing header value."""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in _stages.get() or [])
+
+def instrument(app):
+    """
+    Add request tracing and a /metrics endpoint to a FastAPI app. The X-Request-ID header
+    is taken from the caller (or created) and returned; slow requests are logged with
+    their stages.
+    """
+    from starlette.responses import Response
+
+    http_seconds = Histogram("http_request_seconds", "HTTP request latency", ["method", "route", "status"])
+
+    @app.middleware("http")
+    async def trace_requests(request, call_next):
+        rid = start_trace(request.headers.get("x-request-id"))
+        start = time.perf_counter()
+        response = await call_next(request)
+        elapsed = time.perf_counter() - start
+        route = request.scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        http_seconds.observe(elapsed, method=request.method, route=path, status=response.status_code)
+        response.headers["X-Request-ID"] = rid
+        timing = server_timing()
+        if timing:
+            response.headers["Server-Timing"] = timing
+        if elapsed >= SLOW_REQUEST_SECONDS:
+            print(f"[{rid}] Slow request {request.method} {path}: {elapsed * 1000:.0f}ms {trace_summary()}")
+        return response
+
+    @app.get("/metrics", include_in_schema=False)
+    async def get_metrics():
+        return Response(render(), media_type=CONTENT_TYPE)
+
+def serve(port):
+    """Serve /metrics from a background thread (for services without a web framework)."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass # Scrapes are not worth a log line each
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Metrics exporter listening on :{port}/metrics")
+    return server
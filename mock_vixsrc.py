@@ -1,8 +1,17 @@
-from fastapi import FastAPI, Response
+from fastapi import FastAPI, Request, Response
+import hashlib
 import json
+import os
+import random
 
 app = FastAPI()
 
+# Configuration (defaults serve the 3 sample items below)
+CATALOG_SIZE = int(os.environ.get("MOCK_CATALOG_SIZE", 3)) # Titles in the catalog; beyond the samples they are generated
+PAGE_SIZE = int(os.environ.get("MOCK_PAGE_SIZE", 100)) # Titles per catalog page
+CATALOG_SEED = int(os.environ.get("MOCK_CATALOG_SEED", 42)) # Same seed, same catalog
+PORT = int(os.environ.get("PORT", 3000))
+
 SAMPLE_DATA = {
     "metas": [
         {
@@ -35,17 +44,60 @@ SAMPLE_DATA = {
     ]
 }
 
+# Word lists for generated titles. Some descriptions mention animals and phobia triggers,
+# so enrichment has something to classify.
+ADJECTIVES = ["Silent", "Crimson", "Last", "Hidden", "Broken", "Electric", "Frozen", "Golden", "Midnight", "Savage"]
+NOUNS = ["Harbor", "Signal", "Garden", "Protocol", "Frontier", "Empire", "Orchard", "Reef", "Station", "Canyon"]
+PLACES = ["a coastal town", "Rome", "an abandoned mine", "a research base in Antarctica", "the Amazon",
+          "a small Tuscan village", "a space freighter", "Naples", "a mountain resort", "a swamp in Louisiana"]
+HEROES = ["a retired detective", "two estranged sisters", "a marine biologist", "a young chef",
+          "a group of students", "a night-shift nurse", "a washed-up boxer", "a park ranger"]
+THREATS = ["a giant shark", "a swarm of spiders", "venomous snakes", "a killer clown", "a corrupt mayor",
+           "a pack of wolves", "a rogue AI", "a blood-soaked cult", "a fear of heights", "a family secret"]
+GENRES = ["Action", "Adventure", "Animation", "Comedy", "Crime", "Documentary", "Drama", "Fantasy",
+          "Horror", "Mystery", "Romance", "Sci-Fi", "Thriller", "War", "Western"]
+
+def generated_meta(index):
+    """A deterministic catalog item; the same index always gives the same item."""
+    rng = random.Random(CATALOG_SEED * 1_000_003 + index)
+    title = f"The {rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}"
+    description = (
+        f"In {rng.choice(PLACES)}, {rng.choice(HEROES)} must face {rng.choice(THREATS)} "
+        f"before {rng.choice(HEROES)} uncovers {rng.choice(THREATS)}. "
+        f"{rng.choice(['A tense', 'A tender', 'A darkly funny', 'A sweeping'])} story about "
+        f"{rng.choice(['survival', 'family', 'revenge', 'friendship', 'ambition'])}."
+    )
+    return {
+        "id": f"vix_{index + 1}",
+        "name": f"{title} {index + 1}",
+        "description": description,
+        "releaseInfo": str(rng.randint(1960, 2024)),
+        "poster": f"https://example.org/posters/{index + 1}.jpg",
+        "background": f"https://example.org/backgrounds/{index + 1}.jpg",
+        "genres": rng.sample(GENRES, rng.randint(1, 3)),
+    }
+
+def catalog_meta(index):
+    samples = SAMPLE_DATA["metas"]
+    return samples[index] if index < len(samples) else generated_meta(index)
+
+def catalog_page(request: Request, skip: int):
+    """One page of the catalog, with an ETag so conditional requests can get a 304."""
+    metas = [catalog_meta(i) for i in range(max(skip, 0), min(skip + PAGE_SIZE, CATALOG_SIZE))]
+    body = json.dumps({"metas": metas}).encode()
+    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type="application/json", headers={"ETag": etag})
+
 @app.get("/catalog/movie/vixsrc_movies.json")
-def get_catalog():
-    return SAMPLE_DATA
+def get_catalog(request: Request):
+    return catalog_page(request, 0)
 
 @app.get("/catalog/movie/vixsrc_movies/skip={skip}.json")
-def get_catalog_skip(skip: int):
-    # Retrieve skip logic
-    if skip >= len(SAMPLE_DATA["metas"]):
-        return {"metas": []}
-    return SAMPLE_DATA
+def get_catalog_skip(request: Request, skip: int):
+    return catalog_page(request, skip)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=3000)
+    uvicorn.run(app, host="0.0.0.0", port=PORT)
@@ -0,0 +1,185 @@
+"""
+Priority gate in front of Ollama.
+The search API's query embeddings are interactive; the worker's generations and
+embeddings are background work. Interactive requests always go straight through.
+Background requests are limited to GATE_BACKGROUND_SLOTS at a time, and new ones are
+held while interactive requests are in flight (and for GATE_QUIET_SECONDS after), so
+a search doesn't compete with newly started translations for the CPU. A held request
+is let through after GATE_MAX_WAIT_SECONDS, so the worker slows down under constant
+search traffic but never stops.
+
+Callers mark interactive requests with the X-Ollama-Priority: interactive header.
+With several Ollama nodes in OLLAMA_URLS, each request goes to the pool endpoint chosen
+for the "model" in its body (see ollama_pool), so callers can keep a single URL.
+"""
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from contextlib import asynccontextmanager
+import asyncio
+import httpx
+import json
+import os
+import time
+import common
+import metrics
+import ollama_pool
+
+OLLAMA_URLS = ollama_pool.endpoint_urls() # OLLAMA_URLS (comma-separated) or OLLAMA_URL
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 2)) # Requests per endpoint, match the server setting
+GATE_BACKGROUND_SLOTS = int(os.environ.get("GATE_BACKGROUND_SLOTS", OLLAMA_NUM_PARALLEL * len(OLLAMA_URLS))) # Background requests in flight
+GATE_QUIET_SECONDS = float(os.environ.get("GATE_QUIET_SECONDS", 2.0)) # Background stays paused this long after interactive traffic
+GATE_MAX_WAIT_SECONDS = float(os.environ.get("GATE_MAX_WAIT_SECONDS", 10.0)) # Longest a background request is held for interactive traffic
+PORT = int(os.environ.get("PORT", 11434))
+PRIORITY_HEADER = "x-ollama-priority"
+GATED_PATHS = {"/api/generate", "/api/chat", "/api/embed", "/api/embeddings"} # Model calls; the rest is passed through
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "te", "upgrade", "host", "content-length"}
+
+wait_seconds = metrics.Histogram("ollama_gate_wait_seconds", "Time requests waited at the gate", ["priority"])
+preemptions = metrics.Counter("ollama_gate_preemptions_total", "Background requests held back for interactive traffic")
+forced = metrics.Counter("ollama_gate_forced_total", "Background requests let through after GATE_MAX_WAIT_SECONDS")
+
+class PriorityGate:
+    """Admission control for background requests; see the module docstring."""
+
+    def __init__(self, slots, quiet, max_wait):
+        self.slots = slots
+        self.quiet = quiet
+        self.max_wait = max_wait
+        self.interactive = 0 # In flight
+        self.background = 0 # In flight
+        self.waiting = 0 # Background requests being held
+        self.last_interactive = float("-inf") # When the last interactive request finished
+        self.changed = asyncio.Condition()
+
+    def paused_for(self, now):
+        """Seconds background work must still wait for interactive traffic (inf while it's in flight)."""
+        if self.interactive:
+            return float("inf")
+        return max(self.last_interactive + self.quiet - now, 0.0)
+
+    async def enter(self, priority):
+        """Wait for admission. Returns the seconds waited."""
+        if priority == "interactive":
+            self.interactive += 1
+            return 0.0
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        held = False
+        async with self.changed:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    paused = min(self.paused_for(now), max(deadline - now, 0.0))
+                    if not paused and self.background < self.slots:
+                        break
+                    if paused and not held:
+                        held = True
+                        preemptions.inc()
+                    try:
+                        # Woken by a finished request, or when the pause runs out
+                        await asyncio.wait_for(self.changed.wait(), paused or None)
+                    except asyncio.TimeoutError:
+                        pass
+                if held and self.paused_for(time.monotonic()):
+                    forced.inc()
+                self.background += 1
+            finally:
+                self.waiting -= 1
+        return time.monotonic() - started
+
+    async def leave(self, priority):
+        async with self.changed:
+            if priority == "interactive":
+                self.interactive -= 1
+                self.last_interactive = time.monotonic()
+            else:
+                self.background -= 1
+            self.changed.notify_all()
+
+    def stats(self):
+        return {"interactive": self.interactive, "background": self.background, "waiting": self.waiting}
+
+gate = PriorityGate(GATE_BACKGROUND_SLOTS, GATE_QUIET_SECONDS, GATE_MAX_WAIT_SECONDS)
+metrics.Gauge("ollama_gate_requests", "Requests in flight or held at the gate", ["state"], fn=gate.stats)
+ollama = ollama_pool.OllamaPool(OLLAMA_URLS, OLLAMA_NUM_PARALLEL)
+ollama.export_metrics()
+
+# Keep-alive client to Ollama; no read timeout, callers have their own
+client: httpx.AsyncClient = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client
+    client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=5.0),
+                               limits=httpx.Limits(max_connections=None, max_keepalive_connections=32))
+    checks = asyncio.create_task(common.check_ollama_async(ollama, client, ollama_pool.OLLAMA_CHECK_INTERVAL))
+    try:
+        yield
+    finally:
+        checks.cancel()
+        await client.aclose()
+
+def body_model(body):
+    """The "model" of a JSON request body, None for anything else."""
+    try:
+        return json.loads(body).get("model")
+    except (ValueError, AttributeError):
+        return None
+
+app = FastAPI(title="Ollama Priority Gate", lifespan=lifespan)
+metrics.instrument(app)
+
+@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "HEAD"])
+async def proxy(request: Request, path: str):
+    """Forward to Ollama; model calls hold their gate slot until the response is fully relayed."""
+    priority = "interactive" if request.headers.get(PRIORITY_HEADER) == "interactive" else "background"
+    gated = request.url.path in GATED_PATHS
+    body = await request.body()
+    if gated:
+        with wait_seconds.time("gate", priority=priority):
+            await gate.enter(priority)
+    endpoint = ollama.acquire(body_model(body) if gated else None)
+
+    released = False
+
+    async def release():
+        nonlocal released
+        if not released:
+            released = True
+            await upstream.aclose()
+            ollama.release(endpoint, upstream.status_code < 500)
+            if gated:
+                await gate.leave(priority)
+
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_HEADERS and k.lower() != PRIORITY_HEADER}
+    try:
+        upstream = await client.send(
+            client.build_request(request.method, endpoint.url + request.url.path, params=request.query_params,
+                                 headers=headers, content=body),
+            stream=True,
+        )
+    except httpx.HTTPError:
+        ollama.release(endpoint, False)
+        if gated:
+            await gate.leave(priority)
+        raise
+
+    async def relay():
+        try:
+            async for chunk in upstream.aiter_raw():
+                yield chunk
+        finally:
+            await release()
+
+    return StreamingResponse(
+        relay(),
+        status_code=upstream.status_code,
+        headers={k: v for k, v in upstream.headers.items() if k.lower() not in HOP_HEADERS},
+        background=BackgroundTask(release), # Also runs if the caller went away before the body started
+    )
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=PORT)
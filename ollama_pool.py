@@ -0,0 +1,148 @@
+"""
+Pool of Ollama endpoints shared by the worker, the search API and the gate.
+OLLAMA_URLS lists the endpoints (comma-separated); a request for a model goes to:
+- a healthy endpoint whose circuit is closed and which has the model (from /api/tags),
+- preferably one where the model is already loaded (/api/ps), or else the model's home
+  endpoint by rendezvous hashing, so each model sticks to its own nodes instead of
+  reloading on every node in turn,
+- with the fewest outstanding requests; when the model's nodes are all busy
+  (`parallel` requests each) it spills to the least busy endpoint that has the model.
+An endpoint is skipped for OLLAMA_CIRCUIT_SECONDS after OLLAMA_CIRCUIT_FAILURES
+failed requests in a row, and while its health checks fail, as long as another endpoint
+is usable: the pool never runs out of endpoints, so with a single one (e.g. the gate)
+callers see Ollama's own errors instead of the pool refusing every request.
+The pool only chooses endpoints; callers make the HTTP requests with their own client.
+"""
+import hashlib
+import os
+import threading
+import time
+import metrics
+
+OLLAMA_CIRCUIT_FAILURES = int(os.environ.get("OLLAMA_CIRCUIT_FAILURES", 3)) # Failed requests in a row that open the circuit
+OLLAMA_CIRCUIT_SECONDS = float(os.environ.get("OLLAMA_CIRCUIT_SECONDS", 30)) # How long an open circuit skips the endpoint
+OLLAMA_CHECK_INTERVAL = float(os.environ.get("OLLAMA_CHECK_INTERVAL", 15)) # Seconds between health / model checks
+
+def endpoint_urls(default="http://ollama:11434"):
+    """OLLAMA_URLS, or the single OLLAMA_URL, as a list."""
+    urls = os.environ.get("OLLAMA_URLS") or os.environ.get("OLLAMA_URL", default)
+    return [url.strip().rstrip("/") for url in urls.split(",") if url.strip()]
+
+def model_name(name):
+    """Ollama's implicit tag dropped, so "nomic-embed-text" matches "nomic-embed-text:latest"."""
+    return name[:-len(":latest")] if name and name.endswith(":latest") else name
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.failures = 0 # Failed requests in a row
+        self.open_until = 0.0 # Circuit open (endpoint skipped) until then
+        self.healthy = True # Until a health check says otherwise
+        self.models = None # Available models, None until the first check
+        self.loaded = set() # Models in memory
+        self.missing = set() # Requested models this endpoint doesn't have (logged once)
+
+    def usable(self, now):
+        return self.healthy and now >= self.open_until
+
+class OllamaPool:
+
+    def __init__(self, urls, parallel, failures=OLLAMA_CIRCUIT_FAILURES, open_seconds=OLLAMA_CIRCUIT_SECONDS):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.parallel = parallel
+        self.failures = failures
+        self.open_seconds = open_seconds
+        self.requested = set() # Models callers asked for, checked against every endpoint
+        self.lock = threading.Lock()
+
+    def rank(self, endpoint, model):
+        """Rendezvous hash: every model has its own, stable order of preferred endpoints."""
+        return hashlib.sha1(f"{model}|{endpoint.url}".encode()).digest()
+
+    def acquire(self, model=None):
+        """Pick an endpoint for a request and count it as outstanding."""
+        model = model_name(model)
+        with self.lock:
+            now = time.monotonic()
+            usable = [e for e in self.endpoints if e.usable(now)] or self.endpoints
+            if model is None:
+                endpoint = min(usable, key=lambda e: e.outstanding)
+            else:
+                self.requested.add(model)
+                # If no endpoint lists the model, let Ollama answer (pull in progress, or a typo to report)
+                having = [e for e in usable if e.models is None or model in e.models] or usable
+                by_rank = lambda e: self.rank(e, model)
+                home = [e for e in having if model in e.loaded] or [max(having, key=by_rank)]
+                endpoint = min(home, key=lambda e: (e.outstanding, by_rank(e)))
+                if endpoint.outstanding >= self.parallel:
+                    spill = min(having, key=lambda e: (e.outstanding, by_rank(e)))
+                    if spill.outstanding < endpoint.outstanding:
+                        endpoint = spill
+                endpoint.loaded.add(model) # Ollama loads it for this request
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint, ok):
+        """Finish a request; `ok` is False for connection errors and 5xx answers, None if the caller gave up."""
+        with self.lock:
+            endpoint.outstanding -= 1
+            if ok is None:
+                return
+            if ok:
+                endpoint.failures = 0
+                return
+            endpoint.failures += 1
+            now = time.monotonic()
+            others = any(e.usable(now) for e in self.endpoints if e is not endpoint)
+            if endpoint.failures >= self.failures and now >= endpoint.open_until and others:
+                endpoint.open_until = now + self.open_seconds
+                print(f"Ollama {endpoint.url}: {endpoint.failures} failures in a row, skipped for {self.open_seconds:.0f}s")
+
+    def update(self, endpoint, tags=None, ps=None, error=None):
+        """Record a health check: the /api/tags and /api/ps answers, or the error."""
+        with self.lock:
+            if error is not None:
+                if endpoint.healthy:
+                    print(f"Ollama {endpoint.url} is down: {error}")
+                endpoint.healthy = False
+                return
+            if not endpoint.healthy:
+                print(f"Ollama {endpoint.url} is back")
+            endpoint.healthy = True
+            endpoint.models = {model_name(m.get("name") or m.get("model")) for m in tags.get("models") or []}
+            endpoint.loaded = {model_name(m.get("name") or m.get("model")) for m in ps.get("models") or []}
+            missing = self.requested - endpoint.models
+            for model in missing - endpoint.missing:
+                print(f"Ollama {endpoint.url} doesn't have {model} (ollama pull {model})")
+            endpoint.missing = missing
+
+    def check(self, get):
+        """Health-check every endpoint; `get(url)` returns the decoded JSON or raises."""
+        for endpoint in self.endpoints:
+            try:
+                tags, ps = get(f"{endpoint.url}/api/tags"), get(f"{endpoint.url}/api/ps")
+            except Exception as e:
+                self.update(endpoint, error=e)
+                continue
+            self.update(endpoint, tags, ps)
+
+    async def check_async(self, get):
+        """check() for async callers; `get(url)` is a coroutine function."""
+        for endpoint in self.endpoints:
+            try:
+                tags, ps = await get(f"{endpoint.url}/api/tags"), await get(f"{endpoint.url}/api/ps")
+            except Exception as e:
+                self.update(endpoint, error=e)
+                continue
+            self.update(endpoint, tags, ps)
+
+    def healthy_count(self):
+        now = time.monotonic()
+        return sum(1 for e in self.endpoints if e.usable(now))
+
+    def export_metrics(self):
+        metrics.Gauge("ollama_endpoint_outstanding", "Requests in flight per Ollama endpoint", ["endpoint"],
+                      fn=lambda: {e.url: e.outstanding for e in self.endpoints})
+        metrics.Gauge("ollama_endpoint_up", "1 if the endpoint is healthy and its circuit closed", ["endpoint"],
+                      fn=lambda: {e.url: int(e.usable(time.monotonic())) for e in self.endpoints})
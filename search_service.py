@@ -1,61 +1,755 @@
 from fastapi import FastAPI, Query
-import requests
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import httpx
 import chromadb
-from typing import List
+import numpy as np
+from typing import List, Optional
+import json
 import os
-
-app = FastAPI(title="AI Media Search API")
+import re
+import sqlite3
+import threading
+import time
+import common
+import metrics
+import ollama_pool
+from common import genre_slug, release_year
 
 # Configuration
-OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://ollama:11434")
-EMBED_MODEL = "nomic-embed-text"
+OLLAMA_URLS = ollama_pool.endpoint_urls() # OLLAMA_URLS (comma-separated) or OLLAMA_URL
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 2)) # Requests per endpoint before the pool spills to another
+EMBED_MODEL = os.environ.get("EMBED_MODEL", "nomic-embed-text") # Until the worker's vector_collections pointer is readable
 CHROMA_HOST = os.environ.get("CHROMA_HOST", "chromadb")
 CHROMA_PORT = int(os.environ.get("CHROMA_PORT", 8000))
+EMBED_TIMEOUT = float(os.environ.get("EMBED_TIMEOUT", 10)) # Seconds for a query embedding
+CHROMA_TIMEOUT = float(os.environ.get("CHROMA_TIMEOUT", 5)) # Seconds for a vector query
+CHROMA_WORKERS = int(os.environ.get("CHROMA_WORKERS", 8)) # Threads for blocking Chroma calls
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", 32)) # Keep-alive pool size per upstream
+DB_PATH = os.environ.get("DB_PATH", "/data/media_library.db") # Read-only, for keyword search
+SEARCH_MODE = os.environ.get("SEARCH_MODE", "hybrid") # Default mode: "hybrid", "vector" or "keyword"
+RRF_K = 60 # Reciprocal-rank fusion constant
+VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "chroma") # "chroma" or "local"; the other one is the fallback
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR", "/data/vector_index") # Snapshots exported by the worker
+VECTOR_CHUNK_ROWS = int(os.environ.get("VECTOR_CHUNK_ROWS", 16384)) # int8 snapshot rows converted to float32 at a time
+INDEX_POINTER_CHECK = 5.0 # Seconds between reads of the active collection pointer and checks for a new snapshot
+EMBED_CACHE_SIZE = int(os.environ.get("EMBED_CACHE_SIZE", 5000)) # Query embeddings kept by exact text (LRU)
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", 1024)) # Recent query vectors whose results are reused (0: off)
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", 600)) # Seconds a cached result list is reused
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95)) # Cosine similarity for reusing another query's results
+BATCH_MAX_QUERIES = int(os.environ.get("BATCH_MAX_QUERIES", 64)) # Queries per /search/batch request
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "24h") # Sent with every embed call, keeps the model loaded
+WARMUP = os.environ.get("WARMUP", "1") == "1" # Load the embedding model before /readyz reports ready
+RETRY_MAX_SECONDS = 30.0 # Max backoff between Chroma connection / warm-up attempts
 
-# Initialize Chroma Client
-client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
-collection = client.get_or_create_collection(name="movie_descriptions")
+# Chroma client, created on first use so the API starts (and imports) while Chroma is down.
+# Failed attempts back off, doubling up to RETRY_MAX_SECONDS; see get_chroma.
+chroma = {"client": None, "retry_at": 0.0, "delay": 1.0}
+chroma_lock = threading.Lock()
+collections = {}
 
-def get_query_embedding(text: str):
-    """Convert search query into a vector using Ollama."""
-    payload = {"model": EMBED_MODEL, "input": text}
+# The collection searched and the model its vectors were made with, as (name, model).
+# The worker's rebuild switches it in the vector_collections table; see refresh_indexes.
+active_index = ("movie_descriptions", EMBED_MODEL)
+index_generation = 0 # Bumped by the worker on every write to the active collection
+
+# Metrics (exposed on /metrics)
+ollama_seconds = metrics.Histogram("ollama_request_seconds", "Ollama call latency", ["api"])
+vector_seconds = metrics.Histogram("vector_query_seconds", "Vector index query latency", ["backend"])
+sqlite_seconds = metrics.Histogram("sqlite_query_seconds", "SQLite query latency", ["query"])
+embed_cache_lookups = metrics.Counter("embedding_cache_lookups_total", "Query embedding cache lookups", ["result"])
+metrics.Gauge("embedding_cache_hit_ratio", "Share of query embeddings answered from the cache",
+              fn=lambda: embed_cache_lookups.values.get(("hit",), 0) / (sum(embed_cache_lookups.values.values()) or 1))
+metrics.Gauge("embedding_cache_size", "Query embeddings in the cache", fn=lambda: len(embedding_cache))
+semantic_cache_lookups = metrics.Counter("semantic_cache_lookups_total", "Vector result cache lookups", ["result"])
+metrics.Gauge("semantic_cache_size", "Query vectors in the result cache", fn=lambda: len(semantic_cache.entries))
+
+# The Chroma client and SQLite are blocking, so their calls run in a bounded pool off the event loop
+# (one per app lifespan, like http_client)
+chroma_pool: ThreadPoolExecutor = None
+
+class LocalIndex:
+    """
+    In-process vector index over the snapshot exported by metadata_worker.
+    The matrix is memory-mapped (float32, or int8 with per-row scales) and searched with
+    one vectorized dot product; distances are squared L2 like Chroma's default space.
+    refresh() loads a new snapshot when current.json changes; the API calls it from a
+    background task, never while answering a query.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.vectors = None
+        self.norms = None
+        self.scales = None
+        self.ids = []
+        self.titles = []
+        self.years = None
+        self.flags = None # genre_*/phobia_* metadata key -> boolean array
+        self.model = None
+
+    def refresh(self):
+        """Load the current snapshot if it changed (blocking). Cheap when nothing changed."""
+        try:
+            with open(os.path.join(self.directory, "current.json")) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if manifest["stamp"] == self.stamp:
+            return
+
+        files = {k: os.path.join(self.directory, v) for k, v in manifest["files"].items()}
+        vectors = np.load(files["vectors"], mmap_mode="r")
+        norms = np.load(files["norms"])
+        scales = np.load(files["scales"]) if "scales" in files else None
+        with open(files["ids"]) as f:
+            table = json.load(f)
+        years, flags = None, None
+        if "metadatas" in table:
+            metadatas = table["metadatas"]
+            years = np.array([meta.get("year") or 0 for meta in metadatas], dtype=np.int32)
+            keys = {key for meta in metadatas for key in meta if key.startswith(("genre_", "phobia_"))}
+            flags = {key: np.array([bool(meta.get(key)) for meta in metadatas]) for key in keys}
+        with self.lock:
+            self.vectors, self.norms, self.scales = vectors, norms, scales
+            self.ids, self.titles = table["ids"], table["titles"]
+            self.years, self.flags = years, flags
+            self.model = manifest.get("model")
+            self.stamp = manifest["stamp"]
+        print(f"Loaded local vector index {manifest['stamp']} ({manifest['count']} x {manifest['dim']}, {manifest['dtype']})")
+
+    def mask(self, filters, years, flags):
+        """Boolean row mask for the filters, or None if nothing is filtered."""
+        if not filters:
+            return None
+        if years is None:
+            raise RuntimeError("Local vector snapshot has no metadata for filtering")
+        keep = np.ones(len(years), dtype=bool)
+        missing = np.zeros(len(years), dtype=bool)
+        for genre in filters.get("genres", []):
+            keep &= flags.get(f"genre_{genre}", missing)
+        for phobia in filters.get("exclude_phobias", []):
+            if f"phobia_{phobia}" in flags:
+                keep &= ~flags[f"phobia_{phobia}"]
+        if "year_min" in filters:
+            keep &= years >= filters["year_min"]
+        if "year_max" in filters:
+            keep &= (years <= filters["year_max"]) & (years > 0)
+        return keep
+
+    def query(self, vector, k, filters=None, model=None):
+        """Return the k nearest ids matching the filters as [(id, title, distance)], closest first."""
+        return self.query_many([vector], k, filters, model)[0]
+
+    def query_many(self, vectors_in, k, filters=None, model=None):
+        """
+        Like query(), for several vectors at once: one matrix product for the whole batch.
+        With `model`, a snapshot of vectors from another embedding model is refused.
+        """
+        with self.lock:
+            vectors, norms, scales, ids, titles = self.vectors, self.norms, self.scales, self.ids, self.titles
+            years, flags, snapshot_model = self.years, self.flags, self.model
+        if vectors is None:
+            raise RuntimeError("No local vector snapshot available")
+        if model and snapshot_model and snapshot_model != model:
+            raise RuntimeError(f"Local vector snapshot is from {snapshot_model}, the active index uses {model}")
+
+        queries = np.asarray(vectors_in, dtype=np.float32)
+        if scales is None:
+            dots = vectors @ queries.T
+        else:
+            # int8 rows are converted a chunk at a time, instead of copying the whole matrix per query
+            dots = np.empty((len(vectors), len(queries)), dtype=np.float32)
+            for start in range(0, len(vectors), VECTOR_CHUNK_ROWS):
+                rows = slice(start, start + VECTOR_CHUNK_ROWS)
+                np.matmul(vectors[rows].astype(np.float32), queries.T, out=dots[rows])
+            dots *= scales[:, None]
+        distances = np.maximum(norms[:, None] + np.einsum("ij,ij->i", queries, queries)[None, :] - 2.0 * dots, 0.0)
+        keep = self.mask(filters, years, flags)
+        candidates = np.arange(len(ids)) if keep is None else np.flatnonzero(keep)
+        k = min(k, len(candidates))
+        results = []
+        for column in distances.T:
+            if k == 0:
+                results.append([])
+                continue
+            top = candidates[np.argpartition(column[candidates], k - 1)[:k]] if k < len(candidates) else candidates
+            top = top[np.argsort(column[top])]
+            results.append([(ids[i], titles[i], float(column[i])) for i in top])
+        return results
+
+local_index = LocalIndex(VECTOR_INDEX_DIR)
+
+class SemanticCache:
+    """
+    Vector search results of recent queries, reused for a new query with the same filters
+    whose embedding has at least `threshold` cosine similarity to a cached one ("shark
+    movies", "movies with sharks"). Entries expire after `ttl` seconds, the least recently
+    used go first beyond `maxsize`, and everything is dropped when the generation (active
+    collection, worker writes, local snapshot) changes.
+    """
+
+    def __init__(self, maxsize, ttl, threshold):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.generation = None
+        self.entries = OrderedDict() # key -> (filters key, unit vector, limit, results, expires)
+        self.matrices = {} # filters key -> (keys, stacked unit vectors), rebuilt after changes
+        self.next_key = 0
+
+    def unit(self, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def sync(self, generation):
+        if generation != self.generation:
+            self.generation = generation
+            self.entries.clear()
+            self.matrices.clear()
+
+    def get(self, vector, limit, scope, generation):
+        """Results of the closest cached query within the threshold, or None."""
+        self.sync(generation)
+        if scope not in self.matrices:
+            keys = [key for key, entry in self.entries.items() if entry[0] == scope]
+            self.matrices[scope] = (keys, np.stack([self.entries[key][1] for key in keys]) if keys else None)
+        keys, matrix = self.matrices[scope]
+        if matrix is None:
+            return None
+        now = time.monotonic()
+        similarities = matrix @ self.unit(vector)
+        for i in np.argsort(-similarities):
+            if similarities[i] < self.threshold:
+                return None
+            key = keys[i]
+            _, _, cached_limit, results, expires = self.entries[key]
+            if expires <= now:
+                self.remove(key)
+                continue
+            if cached_limit >= limit:
+                self.entries.move_to_end(key)
+                return results[:limit]
+        return None
+
+    def put(self, vector, limit, scope, results, generation):
+        if not self.maxsize:
+            return
+        self.sync(generation)
+        self.entries[self.next_key] = (scope, self.unit(vector), limit, results, time.monotonic() + self.ttl)
+        self.next_key += 1
+        self.matrices.pop(scope, None)
+        while len(self.entries) > self.maxsize:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        scope = self.entries.pop(key)[0]
+        self.matrices.pop(scope, None)
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD)
+
+# One read-only SQLite connection per pool thread, for the FTS5 keyword index
+db_local = threading.local()
+
+# Query embeddings by (model, exact query text); the same preset and repeated queries skip Ollama
+embedding_cache = OrderedDict()
+
+# Shared keep-alive client for Ollama, opened in the lifespan hook; requests go to the
+# pool endpoint chosen for their model (see ollama_post)
+http_client: httpx.AsyncClient = None
+ollama = ollama_pool.OllamaPool(OLLAMA_URLS, OLLAMA_NUM_PARALLEL)
+ollama.export_metrics()
+
+# Embedding models loaded by warm_up_model; /readyz waits for the active one
+warm_models = set()
+warm_tasks = {}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client, chroma_pool
+    chroma_pool = ThreadPoolExecutor(max_workers=CHROMA_WORKERS, thread_name_prefix="chroma")
+    http_client = httpx.AsyncClient(
+        headers={"X-Ollama-Priority": "interactive"}, # Served ahead of the worker by ollama_gate
+        timeout=httpx.Timeout(EMBED_TIMEOUT, connect=2.0),
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+    )
+    # Connecting and loading the model happen in the background: /healthz answers at once,
+    # /readyz once the first queries won't pay for them
+    startup = asyncio.create_task(start_backends())
+    checks = asyncio.create_task(common.check_ollama_async(ollama, http_client, ollama_pool.OLLAMA_CHECK_INTERVAL))
+    watch = asyncio.create_task(watch_indexes())
     try:
-        response = requests.post(f"{OLLAMA_URL}/api/embed", json=payload)
-        response.raise_for_status()
-        return response.json().get("embeddings", [None])[0]
+        yield
+    finally:
+        startup.cancel()
+        checks.cancel()
+        watch.cancel()
+        for task in warm_tasks.values():
+            task.cancel()
+        await http_client.aclose()
+        chroma_pool.shutdown(wait=False)
+
+async def ollama_post(path, payload, **kwargs):
+    """POST to the pool endpoint chosen for payload["model"], with the shared client."""
+    return await common.ollama_post_async(ollama, http_client, path, payload, **kwargs)
+
+async def start_backends():
+    """Read the active index, load the local snapshot, warm up the embedding model and connect to Chroma."""
+    await refresh_indexes()
+    schedule_warm_up(active_index[1])
+    while chroma["client"] is None:
+        try:
+            await run_blocking(get_chroma)
+        except Exception as e:
+            print(f"Chroma not ready: {e!r}")
+            await asyncio.sleep(max(chroma["retry_at"] - time.monotonic(), 0.1))
+
+def schedule_warm_up(model):
+    if WARMUP and model not in warm_models and model not in warm_tasks:
+        warm_tasks[model] = asyncio.create_task(warm_up_model(model))
+
+async def warm_up_model(model):
+    """Have Ollama load `model` (and keep it loaded), retrying with backoff until it answers."""
+    delay = 1.0
+    while True:
+        try:
+            started = time.perf_counter()
+            response = await ollama_post(
+                "/api/embed", {"model": model, "input": "warm up", "keep_alive": OLLAMA_KEEP_ALIVE},
+                timeout=httpx.Timeout(300.0, connect=2.0) # The first load reads the model from disk
+            )
+            response.raise_for_status()
+            warm_models.add(model)
+            warm_tasks.pop(model, None)
+            print(f"Embedding model {model} loaded in {time.perf_counter() - started:.1f}s")
+            return
+        except Exception as e:
+            print(f"Warm-up of {model} failed: {e!r}; retrying in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RETRY_MAX_SECONDS)
+
+app = FastAPI(title="AI Media Search API", lifespan=lifespan)
+metrics.instrument(app)
+
+async def run_blocking(func, *args, timeout=CHROMA_TIMEOUT, **kwargs):
+    """Run a blocking call (e.g. the Chroma client) in the bounded thread pool, with a timeout."""
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(loop.run_in_executor(chroma_pool, lambda: func(*args, **kwargs)), timeout)
+
+def get_db():
+    conn = getattr(db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+        conn.execute("PRAGMA query_only = 1")
+        # Same year parsing as the worker's index metadata, so keyword and vector filters agree
+        conn.create_function("release_year", 1, release_year, deterministic=True)
+        db_local.conn = conn
+    return conn
+
+def read_active_index():
+    """(name, model, generation) of the active collection from the worker's pointer table, or None."""
+    try:
+        return get_db().execute("SELECT name, model, generation FROM vector_collections WHERE state = 'active'").fetchone()
+    except sqlite3.Error:
+        return None # No database yet, or one from before versioned collections
+
+async def refresh_indexes():
+    """Re-read the active collection pointer and load a new local snapshot, if there is one."""
+    global active_index, index_generation
+    try:
+        row = await run_blocking(read_active_index)
     except Exception as e:
-        print(f"Embedding error: {e}")
-        return None
+        print(f"Index pointer error: {e!r}")
+        row = None
+    if row and tuple(row[:2]) != active_index:
+        print(f"Searching {row[0]} (embeddings from {row[1]})")
+        active_index = tuple(row[:2])
+        schedule_warm_up(row[1])
+    if row:
+        index_generation = row[2]
+    try:
+        await run_blocking(local_index.refresh, timeout=None) # Loading a large snapshot's ids takes a while
+    except Exception as e:
+        print(f"Local vector index error: {e!r}")
 
-@app.get("/search")
-async def search_movies(q: str = Query(..., description="Natural language search query"), limit: int = 5):
+async def watch_indexes():
+    """Background task: refresh_indexes every INDEX_POINTER_CHECK seconds, so queries never wait for it."""
+    while True:
+        await asyncio.sleep(INDEX_POINTER_CHECK)
+        await refresh_indexes()
+
+def get_chroma():
+    """The Chroma client, connecting if needed (blocking). Raises while Chroma is unreachable."""
+    with chroma_lock:
+        if chroma["client"] is None:
+            now = time.monotonic()
+            if now < chroma["retry_at"]:
+                raise RuntimeError(f"Chroma unreachable, next attempt in {chroma['retry_at'] - now:.0f}s")
+            try:
+                chroma["client"] = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+            except Exception:
+                chroma["retry_at"] = now + chroma["delay"]
+                chroma["delay"] = min(chroma["delay"] * 2, RETRY_MAX_SECONDS)
+                raise
+            chroma["delay"] = 1.0
+            print(f"Connected to Chroma at {CHROMA_HOST}:{CHROMA_PORT}")
+        return chroma["client"]
+
+def query_collection(name, **kwargs):
+    """Query a Chroma collection by name (blocking, run in the pool)."""
+    if name not in collections:
+        collections[name] = get_chroma().get_collection(name=name)
+    return collections[name].query(**kwargs)
+
+def parse_filters(genre=None, year_min=None, year_max=None, exclude_phobias=None):
     """
-    Perform semantic search. 
-    Example: /search?q=movies about giant sharks in Italy
+    Normalize the /search filter parameters. `genre` and `exclude_phobias` are
+    comma-separated; every listed genre must match. Returns {} when nothing is filtered.
     """
-    vector = get_query_embedding(q)
-    if not vector:
-        return {"error": "Could not generate embedding for query"}
+    filters = {}
+    genres = [genre_slug(g) for g in (genre or "").split(",") if genre_slug(g)]
+    phobias = [p.strip().lower() for p in (exclude_phobias or "").split(",") if p.strip()]
+    if genres:
+        filters["genres"] = genres
+    if phobias:
+        filters["exclude_phobias"] = phobias
+    if year_min is not None:
+        filters["year_min"] = year_min
+    if year_max is not None:
+        filters["year_max"] = year_max
+    return filters
+
+def build_where(filters):
+    """Translate filters into a Chroma `where` clause (None when nothing is filtered)."""
+    clauses = [{f"genre_{genre}": True} for genre in filters.get("genres", [])]
+    # $ne also matches vectors without the flag, like the keyword and local filters do
+    clauses += [{f"phobia_{phobia}": {"$ne": True}} for phobia in filters.get("exclude_phobias", [])]
+    if "year_min" in filters:
+        clauses.append({"year": {"$gte": filters["year_min"]}})
+    if "year_max" in filters:
+        clauses.append({"year": {"$lte": filters["year_max"]}})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def filter_sql(filters):
+    """SQL conditions (on alias m) and parameters for the filters, using the worker's tag tables."""
+    conditions, params = [], []
+    for genre in filters.get("genres", []):
+        conditions.append("m.id IN (SELECT movie_id FROM movie_genres WHERE genre = ?)")
+        params.append(genre)
+    for phobia in filters.get("exclude_phobias", []):
+        conditions.append("m.id NOT IN (SELECT movie_id FROM movie_phobias WHERE phobia = ?)")
+        params.append(phobia)
+    if "year_min" in filters:
+        conditions.append("release_year(m.year) >= ?")
+        params.append(filters["year_min"])
+    if "year_max" in filters:
+        conditions.append("release_year(m.year) <= ?")
+        params.append(filters["year_max"])
+    return "".join(f" AND {c}" for c in conditions), params
+
+def query_terms(text: str):
+    """Lowercased word tokens, as FTS5's unicode61 tokenizer sees them."""
+    return re.findall(r"\w+", text.lower())
+
+def keyword_search(q: str, limit: int, filters=None):
+    """BM25 search over title and descriptions (title weighted highest)."""
+    terms = query_terms(q)
+    if not terms:
+        return []
+    match = " OR ".join(f'"{term}"' for term in terms)
+    conditions, params = filter_sql(filters or {})
+    rows = get_db().execute(
+        f"""SELECT m.id, m.title, m.description_en
+           FROM movies_fts JOIN movies m ON m.rowid = movies_fts.rowid
+           WHERE movies_fts MATCH ?{conditions}
+           ORDER BY bm25(movies_fts, 10.0, 1.0, 1.0) LIMIT ?""",
+        (match, *params, limit)
+    ).fetchall()
+    return [{"id": m_id, "title": title, "description": desc} for m_id, title, desc in rows]
+
+def exact_title_hit(q: str, hits):
+    """Return the keyword hit whose title is exactly the query (ignoring case and punctuation)."""
+    wanted = query_terms(q)
+    for hit in hits:
+        if hit["title"] and query_terms(hit["title"]) == wanted:
+            return hit
+    return None
 
-    # Query ChromaDB
-    results = collection.query(
-        query_embeddings=[vector],
+def get_descriptions(ids):
+    """English descriptions by id, for results that come from the local index."""
+    if not ids:
+        return {}
+    marks = ",".join("?" * len(ids))
+    return dict(get_db().execute(f"SELECT id, description_en FROM movies WHERE id IN ({marks})", list(ids)).fetchall())
+
+def local_vector_search(vectors, limit: int, filters=None, model=None):
+    """Answer vector queries from the memory-mapped snapshot (blocking, run in the pool)."""
+    batches = local_index.query_many(vectors, limit, filters, model)
+    try:
+        descriptions = get_descriptions(list({m_id for hits in batches for m_id, _, _ in hits}))
+    except sqlite3.Error as e:
+        print(f"Description lookup error: {e!r}")
+        descriptions = {}
+    return [[{
+        "id": m_id,
+        "title": title,
+        "score": 1 - distance, # Same conversion as for Chroma distances
+        "description": descriptions.get(m_id),
+    } for m_id, title, distance in hits] for hits in batches]
+
+async def chroma_vector_search(vectors, limit: int, filters=None, name="movie_descriptions"):
+    # Filters are applied inside the index, so a filtered query fetches no more than `limit`
+    results = await run_blocking(
+        query_collection,
+        name,
+        query_embeddings=vectors,
         n_results=limit,
+        where=build_where(filters or {}),
         include=["documents", "metadatas", "distances"]
     )
 
-    # Format output for the addon
+    # Format output for the addon, one result list per query vector
     formatted_results = []
-    if results["ids"]:
-        for i in range(len(results["ids"][0])):
-            formatted_results.append({
-                "id": results["ids"][0][i],
-                "title": results["metadatas"][0][i].get("title"),
-                "score": 1 - results["distances"][0][i], # Convert distance to similarity score
-                "description": results["documents"][0][i]
-            })
-
-    return {"query": q, "results": formatted_results}
+    for n in range(len(vectors)):
+        hits = []
+        if results["ids"] and n < len(results["ids"]):
+            for i in range(len(results["ids"][n])):
+                hits.append({
+                    "id": results["ids"][n][i],
+                    "title": results["metadatas"][n][i].get("title"),
+                    "score": 1 - results["distances"][n][i], # Convert distance to similarity score
+                    "description": results["documents"][n][i]
+                })
+        formatted_results.append(hits)
+    return formatted_results
+
+def rrf_merge(result_lists, limit, k=RRF_K):
+    """Reciprocal-rank fusion: score(id) = sum of 1 / (k + rank) over the lists it appears in."""
+    scores, items = {}, {}
+    for results in result_lists:
+        for rank, item in enumerate(results, start=1):
+            scores[item["id"]] = scores.get(item["id"], 0.0) + 1.0 / (k + rank)
+            items.setdefault(item["id"], item)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [{**items[m_id], "score": scores[m_id]} for m_id in ranked]
+
+async def get_query_embeddings(texts, model=EMBED_MODEL):
+    """
+    Convert search queries into vectors with `model` using Ollama. Cached texts are
+    answered from embedding_cache and all others are embedded in one /api/embed call.
+    Returns one vector (or None on failure) per text.
+    """
+    vectors = {text: embedding_cache.get((model, text)) for text in texts}
+    missing = [text for text, vector in vectors.items() if vector is None]
+    embed_cache_lookups.inc(len(vectors) - len(missing), result="hit")
+    embed_cache_lookups.inc(len(missing), result="miss")
+    if missing:
+        payload = {"model": model, "input": missing, "keep_alive": OLLAMA_KEEP_ALIVE}
+        try:
+            with ollama_seconds.time("embed", api="embed"):
+                response = await ollama_post("/api/embed", payload)
+            response.raise_for_status()
+            embeddings = response.json().get("embeddings") or []
+        except Exception as e:
+            print(f"Embedding error: {e}")
+            embeddings = []
+        for text, vector in zip(missing, embeddings):
+            vectors[text] = vector
+            embedding_cache[(model, text)] = vector
+        while len(embedding_cache) > EMBED_CACHE_SIZE:
+            embedding_cache.popitem(last=False)
+    for text in texts:
+        if (model, text) in embedding_cache:
+            embedding_cache.move_to_end((model, text))
+    return [vectors[text] for text in texts]
+
+async def get_query_embedding(text: str, model=EMBED_MODEL):
+    """Convert search query into a vector using Ollama."""
+    return (await get_query_embeddings([text], model))[0]
+
+async def search_vectors(vectors, limit: int, filters, index):
+    """
+    Semantic search for a batch of query vectors. Vectors close enough to a recent query
+    are answered from semantic_cache, the others are searched in one index query.
+    Returns one result list per vector, or None if the batch can't be answered.
+    """
+    scope = json.dumps(filters or {}, sort_keys=True)
+    generation = (*index, index_generation, local_index.stamp)
+    results = [semantic_cache.get(vector, limit, scope, generation) for vector in vectors]
+    missing = [i for i, hits in enumerate(results) if hits is None]
+    semantic_cache_lookups.inc(len(results) - len(missing), result="hit")
+    semantic_cache_lookups.inc(len(missing), result="miss")
+    if missing:
+        found = await query_vectors([vectors[i] for i in missing], limit, filters, index)
+        if found is None:
+            return None
+        for i, hits in zip(missing, found):
+            results[i] = hits
+            semantic_cache.put(vectors[i], limit, scope, hits, generation)
+    return results
+
+async def query_vectors(vectors, limit: int, filters, index):
+    """
+    Query Chroma or the local snapshot (VECTOR_BACKEND), falling back to the other one if
+    the first fails. `index` is the (collection, model) the vectors were embedded for.
+    """
+    name, model = index
+    backends = [("local", lambda: run_blocking(local_vector_search, vectors, limit, filters, model)),
+                ("chroma", lambda: chroma_vector_search(vectors, limit, filters, name))]
+    if VECTOR_BACKEND != "local":
+        backends.reverse()
+    for backend, search in backends:
+        try:
+            with vector_seconds.time(f"vector_{backend}", backend=backend):
+                return await search()
+        except Exception as e:
+            print(f"Vector search error ({backend}): {e!r}")
+    return None
+
+async def vector_search(q: str, limit: int, filters=None):
+    """Semantic search for one query. Returns None if the query can't be answered."""
+    index = active_index
+    vector = await get_query_embedding(q, index[1])
+    if not vector:
+        return None
+    results = await search_vectors([vector], limit, filters, index)
+    return results[0] if results is not None else None
+
+async def keyword_stage(q: str, limit: int, mode: str, filters):
+    """
+    Keyword part of a search. Returns (keyword hits, response), where response is the
+    final answer when no vector search is needed (keyword mode or an exact title match).
+    """
+    if mode == "vector":
+        return [], None
+    try:
+        with sqlite_seconds.time("keyword", query="keyword"):
+            keyword_results = await run_blocking(keyword_search, q, limit, filters)
+    except Exception as e:
+        print(f"Keyword search error: {e!r}")
+        if mode == "keyword":
+            return [], {"error": "Keyword search unavailable"}
+        return [], None
+
+    exact = exact_title_hit(q, keyword_results)
+    if mode == "keyword" or exact:
+        if exact:
+            keyword_results = [exact] + [hit for hit in keyword_results if hit is not exact]
+        return keyword_results, {"query": q, "mode": "keyword", "results": rrf_merge([keyword_results], limit)}
+    return keyword_results, None
+
+def fuse_results(q: str, limit: int, mode: str, keyword_results, vector_results):
+    """Final response from the keyword and vector hits of a query."""
+    if vector_results is None:
+        if keyword_results:
+            # Degrade to keyword results rather than failing the query
+            return {"query": q, "mode": "keyword", "results": rrf_merge([keyword_results], limit)}
+        return {"error": "Could not generate embedding for query"}
+
+    if mode == "vector":
+        return {"query": q, "mode": "vector", "results": vector_results[:limit]}
+    return {"query": q, "mode": "hybrid", "results": rrf_merge([vector_results, keyword_results], limit)}
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process serves requests."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness: the active embedding model is loaded (unless WARMUP is off) and a vector
+    backend, Chroma or the local snapshot, is available.
+    """
+    _, model = active_index
+    checks = {
+        "embed_model": not WARMUP or model in warm_models,
+        "chroma": chroma["client"] is not None,
+        "local_index": local_index.vectors is not None,
+    }
+    ready = checks["embed_model"] and (checks["chroma"] or checks["local_index"])
+    return JSONResponse({"status": "ready" if ready else "starting", **checks}, status_code=200 if ready else 503)
+
+@app.get("/search")
+async def search_movies(
+    q: str = Query(..., description="Natural language search query"),
+    limit: int = 5,
+    mode: str = Query(SEARCH_MODE, pattern="^(hybrid|vector|keyword)$"),
+    genre: Optional[str] = Query(None, description="Comma-separated genres, all required (e.g. Animal Horror)"),
+    year_min: Optional[int] = None,
+    year_max: Optional[int] = None,
+    exclude_phobias: Optional[str] = Query(None, description="Comma-separated phobias to exclude (e.g. spiders)"),
+):
+    """
+    Perform semantic, keyword or hybrid search.
+    Example: /search?q=movies about giant sharks in Italy&genre=Animal Horror&exclude_phobias=spiders
+
+    Hybrid mode merges BM25 keyword hits and vector hits with reciprocal-rank fusion
+    (scores are fused RRF scores). If the query is exactly a title, the keyword hits are
+    returned directly and the embedding call is skipped.
+    """
+    filters = parse_filters(genre, year_min, year_max, exclude_phobias)
+    keyword_results, response = await keyword_stage(q, limit, mode, filters)
+    if response:
+        return response
+    vector_results = await vector_search(q, limit, filters)
+    return fuse_results(q, limit, mode, keyword_results, vector_results)
+
+class BatchQuery(BaseModel):
+    q: str
+    limit: int = 5
+    genre: Optional[str] = None
+    year_min: Optional[int] = None
+    year_max: Optional[int] = None
+    exclude_phobias: Optional[str] = None
+
+class BatchRequest(BaseModel):
+    queries: List[BatchQuery] = Field(..., max_length=BATCH_MAX_QUERIES)
+    mode: str = Field(SEARCH_MODE, pattern="^(hybrid|vector|keyword)$")
+
+@app.post("/search/batch")
+async def search_batch(request: BatchRequest):
+    """
+    Run several searches at once (preset rows, relevance checks).
+    Queries that need a vector search are embedded in one Ollama call, and queries with
+    the same filters share one multi-vector index query. Returns one /search response per
+    query, in order.
+    """
+    mode = request.mode
+    plans = [(item, parse_filters(item.genre, item.year_min, item.year_max, item.exclude_phobias))
+             for item in request.queries]
+    stages = await asyncio.gather(*(keyword_stage(item.q, item.limit, mode, filters) for item, filters in plans))
+    responses = [response for _, response in stages]
+
+    pending = [i for i, response in enumerate(responses) if response is None]
+    index = active_index
+    vectors = await get_query_embeddings([plans[i][0].q for i in pending], index[1])
+    groups = {}
+    for i, vector in zip(pending, vectors):
+        if vector:
+            groups.setdefault(json.dumps(plans[i][1], sort_keys=True), []).append((i, vector))
+
+    vector_results = {}
+    for members in groups.values():
+        filters = plans[members[0][0]][1]
+        limit = max(plans[i][0].limit for i, _ in members)
+        results = await search_vectors([vector for _, vector in members], limit, filters, index)
+        if results is not None:
+            # Each query ranks only its own top hits, so it fuses exactly like a /search call
+            vector_results.update((i, hits[:plans[i][0].limit]) for (i, _), hits in zip(members, results))
+
+    for i in pending:
+        item = plans[i][0]
+        responses[i] = fuse_results(item.q, item.limit, mode, stages[i][0], vector_results.get(i))
+    return {"mode": mode, "results": responses}
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,13 +1,631 @@
 import time
-from fastapi import FastAPI, HTTPException, Response
+import asyncio
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-import requests
+import gzip
+import hashlib
+import httpx
+import json
+import operator
 import sqlite3
 import os
 import urllib.parse
-from functools import lru_cache
+import metrics
+from common import genre_slug
 
-app = FastAPI(title="AI Search Stremio Addon")
+try:
+    import orjson # Optional, several times faster than json for catalog bodies
+except ImportError:
+    orjson = None
+try:
+    import brotli # Optional, smaller bodies than gzip for clients that accept br
+except ImportError:
+    brotli = None
+
+# Configuration
+SEARCH_API_URL = os.environ.get("SEARCH_API_URL", "http://search-api:8080")
+MEDIAFLOW_URL = os.environ.get("MEDIAFLOW_URL", "http://mediaflow-proxy:8000") # Internal
+FILE_SERVER_URL = os.environ.get("FILE_SERVER_URL", "http://localhost:8090") # Configuration for file server
+PUBLIC_DOMAIN = os.environ.get("PUBLIC_DOMAIN", "http://localhost:8080") # Needs to be public for Stremio to play
+DB_PATH = os.environ.get("DB_PATH", "/data/media_library.db")
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", 10)) # Seconds for a call to the search API
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 1000)) # Cached queries (LRU)
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", 3600)) # Seconds a result is fresh
+SEARCH_CACHE_STALE = int(os.environ.get("SEARCH_CACHE_STALE", 86400)) # Extra seconds it may be served while refreshing
+SEARCH_CACHE_NEGATIVE_TTL = int(os.environ.get("SEARCH_CACHE_NEGATIVE_TTL", 30)) # Seconds a failure is cached
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 4)) # Read-only SQLite connections (and threads)
+ROW_CACHE_SIZE = int(os.environ.get("ROW_CACHE_SIZE", 20000)) # Movies kept in the hot-row cache
+DB_VERSION_CHECK_INTERVAL = 1.0 # Seconds between PRAGMA data_version checks on the cache-hit path
+SEARCH_FILTERS = ("genre", "year_min", "year_max", "exclude_phobias") # Catalog extras passed through to /search
+SEARCH_DEPTH = int(os.environ.get("SEARCH_DEPTH", 100)) # Ranked results fetched and cached per query, paged with skip
+SEARCH_PAGE_SIZE = 20 # Search results per catalog page
+BROWSE_PAGE_SIZE = int(os.environ.get("BROWSE_PAGE_SIZE", 100)) # Movies per browse catalog page
+STREAM_TTL = int(os.environ.get("STREAM_TTL", 3600)) # Seconds a playability check is trusted before the sweep redoes it
+STREAM_CHECK_INTERVAL = int(os.environ.get("STREAM_CHECK_INTERVAL", 300)) # Seconds between background sweeps
+STREAM_PROBE_TIMEOUT = float(os.environ.get("STREAM_PROBE_TIMEOUT", 5)) # Seconds for a HEAD / range probe
+STREAM_CHECK_CONCURRENCY = int(os.environ.get("STREAM_CHECK_CONCURRENCY", 8)) # Probes in flight during a sweep
+STREAM_DATA_ROOT = os.environ.get("STREAM_DATA_ROOT", "/data") # Local files must be under this mount, the file server's root
+STREAM_PROXY_URL = os.environ.get("STREAM_PROXY_URL", "") # Public Mediaflow URL for remote streams, empty for direct links
+MEDIAFLOW_API_PASSWORD = os.environ.get("MEDIAFLOW_API_PASSWORD", "")
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 5000)) # Serialized catalog/meta bodies kept (LRU)
+COMPRESS_MIN_BYTES = 1024 # Smaller bodies are sent uncompressed
+GENRE_OPTIONS = ["Action", "Adventure", "Animation", "Comedy", "Crime", "Documentary", "Drama", "Fantasy",
+                 "Horror", "Animal Horror", "Mystery", "Romance", "Sci-Fi", "Thriller", "War", "Western"]
+
+# Metrics (exposed on /metrics)
+search_api_seconds = metrics.Histogram("search_api_request_seconds", "Search API call latency")
+sqlite_seconds = metrics.Histogram("sqlite_query_seconds", "SQLite query latency", ["query"])
+not_modified = metrics.Counter("http_not_modified_total", "Requests answered 304 from their ETag", ["route"])
+stream_probe_seconds = metrics.Histogram("stream_probe_seconds", "Stream source check latency", ["kind", "result"])
+
+class SearchCache:
+    """
+    Async LRU cache for search results.
+    - Concurrent misses for the same key share one in-flight fetch (single-flight).
+    - Entries are fresh for `ttl` seconds, then served stale for up to `stale` more
+      seconds while one background refresh runs.
+    - Failures are cached for `negative_ttl` seconds only, and never replace a good entry.
+    `fetch(key)` must return (value, ok).
+    """
+
+    def __init__(self, fetch, maxsize, ttl, stale, negative_ttl):
+        self.fetch = fetch
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale = stale
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict() # key -> (value, fresh_until, stale_until)
+        self.inflight = {} # key -> asyncio.Task
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    async def get(self, key):
+        now = time.monotonic()
+        entry = self.entries.get(key)
+        if entry:
+            value, fresh_until, stale_until = entry
+            if now < fresh_until:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return value
+            if now < stale_until:
+                self.stale_hits += 1
+                self.entries.move_to_end(key)
+                self._refresh(key) # Revalidate in the background, answer now
+                return value
+
+        if key in self.inflight:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+        return await asyncio.shield(self._refresh(key))
+
+    def _refresh(self, key):
+        """Start a fetch for `key` unless one is already running; returns its task."""
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key))
+            self.inflight[key] = task
+        return task
+
+    async def _load(self, key):
+        try:
+            value, ok = await self.fetch(key)
+        except Exception as e:
+            print(f"Search cache fetch error: {e}")
+            value, ok = {"results": []}, False
+        finally:
+            self.inflight.pop(key, None)
+
+        now = time.monotonic()
+        if ok:
+            self._store(key, (value, now + self.ttl, now + self.ttl + self.stale))
+        else:
+            self.errors += 1
+            entry = self.entries.get(key)
+            if entry and now < entry[2]:
+                return entry[0] # Keep serving the last good result
+            self._store(key, (value, now + self.negative_ttl, now + self.negative_ttl))
+        return value
+
+    def _store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses + self.coalesced
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "hit_ratio": (self.hits + self.stale_hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+class LibraryDB:
+    """
+    Read-only access to the media library for request handlers.
+    Connections are opened once (mode=ro, query_only) and reused from a pool by a matching
+    thread pool, so queries never run on the event loop. Looked-up rows are kept in an LRU
+    cache that is dropped whenever PRAGMA data_version shows the worker committed.
+    """
+    ROW_COLUMNS = ["title", "description_en", "year", "poster", "background", "url", "path"]
+    BROWSE_ORDERS = {
+        # FROM, keyset column(s), ORDER BY, "after the cursor" condition, base condition
+        "title": ("movies", ["title", "id"], "title, id", "(title, id) > (?, ?)", "title IS NOT NULL"),
+        "recent": ("movies", ["rowid"], "rowid DESC", "rowid < ?", "1"),
+        # A genre in title order: a seek on movie_genres (genre, title, movie_id), one genre's rows only
+        "genre_title": ("movie_genres g JOIN movies ON movies.id = g.movie_id", ["g.title", "g.movie_id"],
+                        "g.title, g.movie_id", "(g.title, g.movie_id) > (?, ?)", "g.genre = ? AND g.title IS NOT NULL"),
+    }
+
+    def __init__(self, path, size, cache_size, check_interval):
+        self.path = path
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="sqlite")
+        self.idle = queue.SimpleQueue() # Connections not in use
+        self.lock = threading.Lock() # Guards the cache and the watch connection
+        self.watch_conn = None
+        self.version = None
+        self.checked_at = 0.0
+        self.columns = None
+        self.rows = OrderedDict() # movie id -> dict of ROW_COLUMNS (None if not found)
+        self.cursors = OrderedDict() # (catalog, genre) -> {skip: keyset of the last row before it}
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only = 1")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        broken = False
+        try:
+            yield conn
+        except sqlite3.Error:
+            broken = True
+            raise
+        finally:
+            if broken:
+                conn.close() # Don't return a possibly broken connection to the pool
+            else:
+                self.idle.put(conn)
+
+    def _check_version(self):
+        """Drop the cache if another connection committed since the last check."""
+        with self.lock:
+            if self.watch_conn is None:
+                self.watch_conn = self._connect()
+            version = self.watch_conn.execute("PRAGMA data_version").fetchone()[0]
+            self.checked_at = time.monotonic()
+            if version != self.version:
+                self.version = version
+                self.rows.clear() # Browse cursors are kept, see _browse
+                self.columns = None
+
+    def _cached(self, movie_id):
+        with self.lock:
+            if movie_id in self.rows:
+                self.hits += 1
+                self.rows.move_to_end(movie_id)
+                return True, self.rows[movie_id]
+        return False, None
+
+    def _load_row(self, movie_id):
+        self._check_version()
+        found, row = self._cached(movie_id)
+        if found:
+            return row
+        version = self.version
+        with self.connection() as conn:
+            if self.columns is None:
+                existing = {col[1] for col in conn.execute("PRAGMA table_info(movies)")}
+                self.columns = [col for col in self.ROW_COLUMNS if col in existing]
+            row = conn.execute(
+                f"SELECT {', '.join(self.columns)} FROM movies WHERE id = ?", (movie_id,)
+            ).fetchone()
+        row = dict(row) if row else None
+        with self.lock:
+            self.misses += 1
+            # If another thread saw a commit meanwhile, the row may predate it: don't cache it
+            if self.version == version:
+                self.rows[movie_id] = row
+                while len(self.rows) > self.cache_size:
+                    self.rows.popitem(last=False)
+        return row
+
+    def _browse(self, name, where, order, genre, skip, limit):
+        """
+        One page of a browse catalog with keyset pagination. Stremio only sends `skip`,
+        so the keyset of the last row of every served page is remembered under the skip
+        that follows it; a sequential scroll is then an index seek per page. An unknown
+        skip starts from the closest remembered cursor below it.
+        Cursors survive the worker's commits: a keyset stays a valid position when rows are
+        added or removed (even its own row), and every page served rewrites the cursor of
+        the next skip, so a scroll from the top follows the current order.
+        """
+        self._check_version()
+        params = []
+        if genre and order == "title":
+            order = "genre_title"
+            params.append(genre_slug(genre))
+        table, keys, order_by, after, base = self.BROWSE_ORDERS[order]
+        with self.lock:
+            known = self.cursors.get((name, genre), {})
+            start = max((k for k in known if k <= skip), default=0)
+            cursor = known.get(start)
+
+        conditions = [base, where or "1"]
+        if genre and order != "genre_title":
+            # Correlated probe, so the page still walks the keyset index in order
+            conditions.append("EXISTS (SELECT 1 FROM movie_genres g WHERE g.genre = ? AND g.movie_id = movies.id)")
+            params.append(genre_slug(genre))
+        if cursor:
+            conditions.append(after)
+            params.extend(cursor)
+        with self.connection() as conn:
+            rows = conn.execute(
+                f"""SELECT {', '.join(keys)}, movies.id, movies.title, movies.poster FROM {table}
+                    WHERE {' AND '.join(conditions)} ORDER BY {order_by} LIMIT ? OFFSET ?""",
+                (*params, limit, skip - start)
+            ).fetchall()
+
+        if rows:
+            with self.lock:
+                self.cursors.setdefault((name, genre), {})[skip + len(rows)] = tuple(rows[-1][:len(keys)])
+                self.cursors.move_to_end((name, genre))
+                while len(self.cursors) > 1000:
+                    self.cursors.popitem(last=False)
+        return [{"id": row["id"], "title": row["title"], "poster": row["poster"]} for row in rows]
+
+    async def browse(self, name, where, order, genre=None, skip=0, limit=100):
+        """A page of movies for a browse catalog, as dicts of id, title and poster."""
+        loop = asyncio.get_running_loop()
+        with sqlite_seconds.time("browse", query="browse"):
+            return await loop.run_in_executor(self.executor, self._browse, name, where, order, genre, skip, limit)
+
+    def _sources(self, after, limit):
+        with self.connection() as conn:
+            return [tuple(row) for row in conn.execute(
+                """SELECT id, url, path FROM movies
+                   WHERE id > ? AND (COALESCE(url, '') != '' OR COALESCE(path, '') != '') ORDER BY id LIMIT ?""",
+                (after, limit)
+            )]
+
+    async def sources(self, after="", limit=500):
+        """Movies with a url or path after id `after`, as (id, url, path)."""
+        loop = asyncio.get_running_loop()
+        with sqlite_seconds.time(query="sources"):
+            return await loop.run_in_executor(self.executor, self._sources, after, limit)
+
+    async def data_version(self):
+        """The library's PRAGMA data_version, re-read at most every check_interval seconds."""
+        if self.version is None or time.monotonic() - self.checked_at >= self.check_interval:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self._check_version)
+        return self.version
+
+    async def get_row(self, movie_id):
+        """Return the movie's columns as a dict, or None if it doesn't exist."""
+        # Fast path: answer from memory if the data version was checked very recently
+        if time.monotonic() - self.checked_at < self.check_interval:
+            found, row = self._cached(movie_id)
+            if found:
+                return row
+        loop = asyncio.get_running_loop()
+        with sqlite_seconds.time("row", query="row"):
+            return await loop.run_in_executor(self.executor, self._load_row, movie_id)
+
+library_db = LibraryDB(DB_PATH, DB_POOL_SIZE, ROW_CACHE_SIZE, DB_VERSION_CHECK_INTERVAL)
+metrics.Gauge("row_cache_lookups", "Hot-row cache lookups", ["result"],
+              fn=lambda: {"hit": library_db.hits, "miss": library_db.misses})
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode()
+
+def accepted_encodings(header):
+    """Content codings allowed by an Accept-Encoding header (those not given q=0)."""
+    accepted = set()
+    for part in (header or "").split(","):
+        name, _, params = part.partition(";")
+        q = params.strip().removeprefix("q=")
+        try:
+            if q and float(q) <= 0:
+                continue
+        except ValueError:
+            pass
+        accepted.add(name.strip().lower())
+    return accepted
+
+class Body:
+    """
+    A serialized JSON response with its strong ETag (a hash of the bytes). Compressed
+    copies are made on first request for each coding and kept; they carry the coding in
+    their ETag ("<hash>-br"), since they are different bytes.
+    """
+
+    def __init__(self, payload):
+        self.raw = dumps(payload)
+        self.hash = hashlib.blake2b(self.raw, digest_size=12).hexdigest()
+        self.encoded = {}
+
+    def matches(self, if_none_match):
+        """If-None-Match comparison (weak, as RFC 9110 asks), accepting any coding's ETag."""
+        for tag in (if_none_match or "").split(","):
+            tag = tag.strip().removeprefix("W/").strip('"')
+            if tag == "*" or tag.split("-")[0] == self.hash:
+                return True
+        return False
+
+    def coding(self, accepted):
+        """The best content coding among those accepted, or None to send the body as is."""
+        if len(self.raw) >= COMPRESS_MIN_BYTES:
+            if "br" in accepted and brotli is not None:
+                return "br"
+            if "gzip" in accepted:
+                return "gzip"
+        return None
+
+    def etag(self, coding):
+        return f'"{self.hash}-{coding}"' if coding else f'"{self.hash}"'
+
+    def content(self, coding):
+        if coding is None:
+            return self.raw
+        if coding not in self.encoded:
+            self.encoded[coding] = (brotli.compress(self.raw, quality=5) if coding == "br"
+                                    else gzip.compress(self.raw, compresslevel=6, mtime=0))
+        return self.encoded[coding]
+
+class ResponseCache:
+    """
+    LRU of serialized bodies for the catalog and meta routes. An entry holds for the version
+    it was built at, so repeats and revalidations skip SQLite and JSON encoding: the library
+    data_version, or for search pages the cached result list itself (`same=operator.is_`).
+    """
+
+    def __init__(self, maxsize, same=operator.eq):
+        self.maxsize = maxsize
+        self.same = same
+        self.entries = OrderedDict() # key -> (version, Body)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        entry = self.entries.get(key)
+        if entry is None or not self.same(entry[0], version):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, version, body):
+        self.entries[key] = (version, body)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+metrics.Gauge("response_cache_lookups", "Serialized response cache lookups", ["result"],
+              fn=lambda: {"hit": response_cache.hits, "miss": response_cache.misses})
+# Search catalog pages by (query, filters, skip), valid while search_cache returns the same result list
+search_bodies = ResponseCache(RESPONSE_CACHE_SIZE, same=operator.is_)
+metrics.Gauge("search_body_cache_lookups", "Serialized search page cache lookups", ["result"],
+              fn=lambda: {"hit": search_bodies.hits, "miss": search_bodies.misses})
+
+def send(request: Request, body: Body, cache_control: str):
+    """The response for `body`: 304 if the client has it, else the best compressed copy."""
+    coding = body.coding(accepted_encodings(request.headers.get("accept-encoding")))
+    headers = {"ETag": body.etag(coding), "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if body.matches(request.headers.get("if-none-match")):
+        not_modified.inc(route=getattr(request.scope.get("route"), "path", ""))
+        return Response(status_code=304, headers=headers)
+    if coding:
+        headers["Content-Encoding"] = coding
+    return Response(body.content(coding), media_type="application/json", headers=headers)
+
+async def send_cached(request: Request, cache_control: str, build):
+    """
+    Answer from response_cache when the library hasn't changed, else from `build()`, which
+    returns (payload, ok); failed builds are sent but not cached.
+    """
+    key = request.url.path
+    try:
+        version = await library_db.data_version()
+    except sqlite3.Error:
+        version = None
+    body = response_cache.get(key, version) if version is not None else None
+    if body is None:
+        payload, ok = await build()
+        body = Body(payload)
+        if ok and version is not None:
+            response_cache.put(key, version, body)
+    return send(request, body, cache_control)
+
+class StreamResolver:
+    """
+    Playable stream sources per movie, checked ahead of the /stream requests.
+    A background sweep walks the movies with a url or path every STREAM_CHECK_INTERVAL
+    seconds and re-checks those whose result is older than `ttl`: a local file (the path, or
+    a url starting with "/") must exist under `data_root` (its size and mtime are kept), a
+    remote URL must answer a HEAD, or a one-byte range GET, through the pooled `client`.
+    The final URL (file server or Mediaflow) is computed at check time, so a lookup
+    returns ready streams, best first.
+    """
+
+    def __init__(self, db, ttl, data_root, concurrency):
+        self.db = db
+        self.ttl = ttl
+        self.data_root = os.path.realpath(data_root)
+        self.limit = asyncio.Semaphore(concurrency)
+        self.client: httpx.AsyncClient = None # Set in the lifespan hook
+        self.entries = {} # movie id -> (checked_at, (url, path), [(rank, stream)])
+        self.inflight = {} # movie id -> asyncio.Task
+        self.sweeps = 0
+
+    def check_file(self, path):
+        """(size, mtime) of a regular, non-empty file under data_root, else None (blocking)."""
+        real = os.path.realpath(path)
+        if os.path.commonpath([real, self.data_root]) != self.data_root:
+            return None
+        try:
+            info = os.stat(real)
+        except OSError:
+            return None
+        return (info.st_size, info.st_mtime) if os.path.isfile(real) and info.st_size > 0 else None
+
+    async def probe(self, url):
+        """Response time of a remote source, or None if it can't be played."""
+        started = time.perf_counter()
+        try:
+            response = await self.client.head(url)
+            if response.status_code in (403, 405, 501): # Some hosts refuse HEAD, ask for one byte instead
+                async with self.client.stream("GET", url, headers={"Range": "bytes=0-0"}) as response:
+                    pass
+        except httpx.HTTPError:
+            return None
+        return time.perf_counter() - started if response.status_code < 400 else None
+
+    async def check(self, movie_id, url, path):
+        """The playable streams of one movie as [(rank, stream)], lowest rank first."""
+        streams = []
+        local = [path] if path else []
+        if url and url.startswith("/") and url != path: # A local file given as the url, served like a path
+            local.append(url)
+        for source in local:
+            with stream_probe_seconds.time(kind="file", result="checked"):
+                found = await asyncio.get_running_loop().run_in_executor(None, self.check_file, source)
+            if found:
+                final_url = f"{FILE_SERVER_URL}/{urllib.parse.quote(source.lstrip('/'))}"
+                streams.append(((0, 0.0), {"title": "Local File via God Mode", "url": final_url}))
+        if url and url.startswith(("http://", "https://")):
+            async with self.limit:
+                latency = await self.probe(url)
+            stream_probe_seconds.observe(latency or 0.0, kind="remote", result="ok" if latency is not None else "dead")
+            if latency is not None:
+                final_url = url
+                if STREAM_PROXY_URL:
+                    query = {"d": url, **({"api_password": MEDIAFLOW_API_PASSWORD} if MEDIAFLOW_API_PASSWORD else {})}
+                    final_url = f"{STREAM_PROXY_URL}/proxy/stream?{urllib.parse.urlencode(query)}"
+                streams.append(((1, latency), {"title": "Stream via God Mode", "url": final_url}))
+        streams.sort(key=lambda item: item[0])
+        self.entries[movie_id] = (time.monotonic(), (url, path), streams)
+        return streams
+
+    async def resolve(self, movie_id, url, path):
+        """check(), shared by concurrent callers for the same movie."""
+        task = self.inflight.get(movie_id)
+        if task is None:
+            task = asyncio.ensure_future(self.check(movie_id, url, path))
+            self.inflight[movie_id] = task
+            task.add_done_callback(lambda _: self.inflight.pop(movie_id, None))
+        return await task
+
+    async def streams(self, movie_id):
+        """
+        Playable streams for /stream. Answered from the last check, even an expired one (the
+        sweep renews it); only a movie never checked, or whose url/path changed, is checked now.
+        """
+        row = await self.db.get_row(movie_id)
+        if not row:
+            return []
+        sources = (row.get("url"), row.get("path"))
+        entry = self.entries.get(movie_id)
+        if entry is None or entry[1] != sources:
+            return [stream for _, stream in await self.resolve(movie_id, *sources)]
+        return [stream for _, stream in entry[2]]
+
+    async def sweep(self):
+        """Re-check every movie whose check expired or whose sources changed."""
+        now = time.monotonic()
+        seen, after = set(), ""
+        while True:
+            page = await self.db.sources(after)
+            if not page:
+                break
+            due = []
+            for movie_id, url, path in page:
+                seen.add(movie_id)
+                entry = self.entries.get(movie_id)
+                if entry is None or entry[1] != (url, path) or now - entry[0] >= self.ttl:
+                    due.append(self.resolve(movie_id, url, path))
+            await asyncio.gather(*due)
+            after = page[-1][0]
+        for movie_id in set(self.entries) - seen:
+            del self.entries[movie_id] # Removed from the library, or its sources were cleared
+        self.sweeps += 1
+
+    async def run(self, interval):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Stream check error: {e!r}")
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        playable = sum(1 for _, _, streams in self.entries.values() if streams)
+        return {"playable": playable, "unplayable": len(self.entries) - playable}
+
+stream_resolver = StreamResolver(library_db, STREAM_TTL, STREAM_DATA_ROOT, STREAM_CHECK_CONCURRENCY)
+metrics.Gauge("stream_sources", "Movies by the result of their last stream check", ["state"], fn=stream_resolver.stats)
+
+# Shared keep-alive client for the search API, opened in the lifespan hook
+http_client: httpx.AsyncClient = None
+
+async def propagate_request_id(request):
+    """Pass this request's id on to the search API, so both logs can be correlated."""
+    rid = metrics.request_id.get()
+    if rid:
+        request.headers["X-Request-ID"] = rid
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    http_client = httpx.AsyncClient(
+        base_url=SEARCH_API_URL,
+        timeout=SEARCH_TIMEOUT,
+        event_hooks={"request": [propagate_request_id]},
+    )
+    # Pooled client for the stream probes, which go to many hosts
+    stream_resolver.client = httpx.AsyncClient(
+        timeout=STREAM_PROBE_TIMEOUT,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=STREAM_CHECK_CONCURRENCY * 2),
+    )
+    checker = asyncio.create_task(stream_resolver.run(STREAM_CHECK_INTERVAL))
+    try:
+        yield
+    finally:
+        checker.cancel()
+        await stream_resolver.client.aclose()
+        await http_client.aclose()
+
+app = FastAPI(title="AI Search Stremio Addon", lifespan=lifespan)
+metrics.instrument(app)
 
 app.add_middleware(
     CORSMiddleware,
@@ -15,12 +633,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configuration
-SEARCH_API_URL = os.environ.get("SEARCH_API_URL", "http://search-api:8080")
-MEDIAFLOW_URL = os.environ.get("MEDIAFLOW_URL", "http://mediaflow-proxy:8000") # Internal
-FILE_SERVER_URL = os.environ.get("FILE_SERVER_URL", "http://localhost:8090") # Configuration for file server
-PUBLIC_DOMAIN = os.environ.get("PUBLIC_DOMAIN", "http://localhost:8080") # Needs to be public for Stremio to play
-DB_PATH = "/data/media_library.db"
+# Browse catalogs served straight from SQLite: (name, WHERE condition on movies, order, fixed genre)
+BROWSE_CATALOGS = {
+    "ai_recent": ("Recently Added", "", "recent", None),
+    "ai_animal_horror": ("Animal Horror", "", "title", "Animal Horror"),
+    "ai_phobia_safe": ("Phobia-safe", "movies.ai_classified = 1 AND COALESCE(movies.phobia_warnings, '') = ''", "title", None),
+    "ai_genres": ("By Genre", "", "title", None),
+}
 
 MANIFEST = {
     "id": "org.antigravity.aisearch",
@@ -29,145 +648,171 @@ MANIFEST = {
     "description": "Search your library using natural language and AI.",
     "types": ["movie"],
     "catalogs": [
-        {"type": "movie", "id": "ai_search", "name": "AI Search", "extra": [{"name": "search", "isRequired": False}]}
+        {"type": "movie", "id": "ai_search", "name": "AI Search", "extra": [
+            {"name": "search", "isRequired": False},
+            {"name": "genre", "isRequired": False, "options": GENRE_OPTIONS},
+            {"name": "year_min", "isRequired": False},
+            {"name": "year_max", "isRequired": False},
+            {"name": "exclude_phobias", "isRequired": False},
+            {"name": "skip", "isRequired": False},
+        ]},
+        {"type": "movie", "id": "ai_recent", "name": "Recently Added", "extra": [
+            {"name": "genre", "isRequired": False, "options": GENRE_OPTIONS},
+            {"name": "skip", "isRequired": False},
+        ]},
+        {"type": "movie", "id": "ai_animal_horror", "name": "Animal Horror", "extra": [
+            {"name": "skip", "isRequired": False},
+        ]},
+        {"type": "movie", "id": "ai_phobia_safe", "name": "Phobia-safe", "extra": [
+            {"name": "genre", "isRequired": False, "options": GENRE_OPTIONS},
+            {"name": "skip", "isRequired": False},
+        ]},
+        {"type": "movie", "id": "ai_genres", "name": "By Genre", "extra": [
+            {"name": "genre", "isRequired": True, "options": GENRE_OPTIONS},
+            {"name": "skip", "isRequired": False},
+        ]},
     ],
     "resources": ["catalog", "stream", "meta"],
     "idPrefixes": ["ai_"]
 }
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA journal_mode=WAL;") # Enable Write-Ahead Logging for concurrency
-    conn.row_factory = sqlite3.Row
-    return conn
-
-@lru_cache(maxsize=100)
-def cached_search(query: str):
+async def fetch_search(key):
+    """Call the search API for a (query, filters) key. Returns (data, ok) for SearchCache."""
+    query, filters = key
     try:
-        response = requests.get(f"{SEARCH_API_URL}/search", params={"q": query, "limit": 10}, timeout=10)
+        with search_api_seconds.time("search_api"):
+            response = await http_client.get("/search", params={"q": query, "limit": SEARCH_DEPTH, **dict(filters)})
         response.raise_for_status()
-        return response.json()
+        data = response.json()
     except Exception as e:
         print(f"Search API Error: {e}")
-        return {"results": []}
+        return {"results": []}, False
+    if "error" in data:
+        print(f"Search API Error: {data['error']}")
+        return {"results": []}, False
+    return data, True
+
+search_cache = SearchCache(
+    fetch_search,
+    maxsize=SEARCH_CACHE_SIZE,
+    ttl=SEARCH_CACHE_TTL,
+    stale=SEARCH_CACHE_STALE,
+    negative_ttl=SEARCH_CACHE_NEGATIVE_TTL,
+)
+metrics.Gauge("search_cache_hit_ratio", "Share of searches answered from the cache (fresh, stale or coalesced)",
+              fn=lambda: search_cache.stats()["hit_ratio"])
+metrics.Gauge("search_cache_lookups", "Search cache lookups by outcome", ["result"],
+              fn=lambda: {k: v for k, v in search_cache.stats().items() if k not in ("size", "hit_ratio")})
+metrics.Gauge("search_cache_size", "Queries in the search cache", fn=lambda: len(search_cache.entries))
+
+async def cached_search(query: str, filters=None):
+    """Cached search; filters are part of the cache key."""
+    return await search_cache.get((query, tuple(sorted((filters or {}).items()))))
+
+def parse_extra(extra: str):
+    """Parse a Stremio extra path segment ("search=foo&genre=Horror") into a dict."""
+    return dict(urllib.parse.parse_qsl(extra))
+
+manifest_body = Body(MANIFEST)
+empty_catalog_body = Body({"metas": []})
 
 @app.get("/manifest.json")
-async def get_manifest(response: Response):
-    response.headers["Cache-Control"] = "max-age=86400, public" # Cache for 1 day
-    return MANIFEST
-
-@app.get("/catalog/movie/ai_search.json")
-@app.get("/catalog/movie/ai_search/search={query}.json")
-async def get_catalog(response: Response, query: str = ""):
-    response.headers["Cache-Control"] = "max-age=3600, public" # Cache for 1 hour
-    
-    if not query:
-        return {"metas": []}
+async def get_manifest(request: Request):
+    return send(request, manifest_body, "max-age=86400, public") # Cache for 1 day
+
+def parse_skip(extras):
+    try:
+        return max(int(extras.get("skip", 0)), 0)
+    except ValueError:
+        return 0
 
-    # Call Search API (Cached)
-    data = cached_search(query)
+@app.get("/catalog/movie/{catalog_id}.json")
+@app.get("/catalog/movie/{catalog_id}/{extra}.json")
+async def get_catalog(request: Request, catalog_id: str, extra: str = ""):
+    extras = parse_extra(extra)
+    if catalog_id in BROWSE_CATALOGS:
+        return await send_cached(request, "max-age=600, public", # Cache for 10 minutes
+                                 lambda: get_browse_catalog(catalog_id, extras))
+    cache_control = "max-age=3600, public" # Cache for 1 hour
 
-    metas = []
-    for item in data.get("results", []):
-        metas.append({
-            "id": f"ai_{item['id']}",
-            "type": "movie",
-            "name": item['title'],
-            "description": item['description']
-        })
+    query = extras.get("search", "")
+    if catalog_id != "ai_search" or not query:
+        return send(request, empty_catalog_body, cache_control)
+    filters = {name: extras[name] for name in SEARCH_FILTERS if extras.get(name)}
 
-    return {"metas": metas}
+    # Call Search API (Cached). The ranked list is fetched once and paged from the cache.
+    data = await cached_search(query, filters)
+    skip = parse_skip(extras)
+    key = (query, tuple(sorted(filters.items())), skip)
+    body = search_bodies.get(key, data)
+    if body is None:
+        metas = []
+        for item in data.get("results", [])[skip:skip + SEARCH_PAGE_SIZE]:
+            metas.append({
+                "id": f"ai_{item['id']}",
+                "type": "movie",
+                "name": item['title'],
+                "description": item['description']
+            })
+        body = Body({"metas": metas})
+        search_bodies.put(key, data, body) # Holds `data`, so its identity can't be reused by another list
+
+    return send(request, body, cache_control)
+
+async def get_browse_catalog(catalog_id: str, extras):
+    """A browse catalog page as (payload, ok)."""
+    _, where, order, genre = BROWSE_CATALOGS[catalog_id]
+    genre = genre or extras.get("genre")
+    if catalog_id == "ai_genres" and not genre:
+        return {"metas": []}, True
+    try:
+        rows = await library_db.browse(catalog_id, where, order, genre, parse_skip(extras), BROWSE_PAGE_SIZE)
+    except Exception as e:
+        print(f"DB Error: {e}")
+        return {"metas": []}, False
+    return {"metas": [
+        {"id": f"ai_{row['id']}", "type": "movie", "name": row["title"], "poster": row["poster"]}
+        for row in rows
+    ]}, True
 
 @app.get("/meta/movie/{id}.json")
-async def get_meta(response: Response, id: str):
-    response.headers["Cache-Control"] = "max-age=43200, public" # Cache for 12 hours
-    
+async def get_meta(request: Request, id: str):
+    return await send_cached(request, "max-age=43200, public", lambda: build_meta(id)) # Cache for 12 hours
+
+async def build_meta(id: str):
+    """The meta of a movie as (payload, ok)."""
     # Retrieve details from DB
     clean_id = id.replace("ai_", "")
     
-    conn = get_db_connection()
     try:
-        row = conn.execute("SELECT * FROM movies WHERE id = ?", (clean_id,)).fetchone()
+        row = await library_db.get_row(clean_id)
     except Exception as e:
         print(f"DB Error: {e}")
-        row = None
-    finally:
-        conn.close()
+        return {"meta": {"id": id, "type": "movie", "name": "Unknown"}}, False
 
     if not row:
-         return {"meta": {"id": id, "type": "movie", "name": "Unknown"}}
+         return {"meta": {"id": id, "type": "movie", "name": "Unknown"}}, True
 
     meta = {
         "id": id,
         "type": "movie",
         "name": row['title'],
-        "description": row['description_en'] if 'description_en' in row.keys() else "No description",
+        "description": row['description_en'] if 'description_en' in row else "No description",
     }
     # Optional fields
-    if 'year' in row.keys(): meta['releaseInfo'] = str(row['year'])
-    if 'poster' in row.keys(): meta['poster'] = row['poster']
-    if 'background' in row.keys(): meta['background'] = row['background']
+    if 'year' in row: meta['releaseInfo'] = str(row['year'])
+    if 'poster' in row: meta['poster'] = row['poster']
+    if 'background' in row: meta['background'] = row['background']
 
-    return {"meta": meta}
+    return {"meta": meta}, True
 
 @app.get("/stream/movie/{id}.json")
 async def get_stream(response: Response, id: str):
     response.headers["Cache-Control"] = "no-cache" # Do not cache streams
     clean_id = id.replace("ai_", "")
-    
-    conn = get_db_connection()
-    try:
-        row = conn.execute("SELECT * FROM movies WHERE id = ?", (clean_id,)).fetchone()
-    finally:
-        conn.close()
-
-    if not row:
-        return {"streams": []}
-
-    stream_url = None
-    if 'url' in row.keys() and row['url']:
-        stream_url = row['url']
-        # If it's a direct link, we might want to proxy it if Mediaflow is set up for that.
-        # For now, we return it directly as per standard behavior unless user specifically asked for proxying everything.
-    elif 'path' in row.keys() and row['path']:
-        # It's a local file path. Stremio CANNOT play local paths from a remote server.
-        # We MUST proxy this.
-        # Since we don't have a file server set up for /data, but we have Mediaflow...
-        # Mediaflow usually proxies HTTP URLs. 
-        # Ideally, we should have Caddy serve the /data directory statically if we want to play files.
-        # For now, let's assume we return a warning if it's a path, or try to construct a hypothetical URL.
-        # As a fallback, we return the path but unlikely to work without a file server.
-        stream_url = row['path']
-
-    if not stream_url:
-        return {"streams": [{"title": "No URL found in DB"}]}
-
-    # Construct the final URL
-    # If it's a remote URL, we use it directly or proxy via Mediaflow
-    # If it's a local path, we MUST direct it to the File Server
-    
-    final_url = stream_url
-    title_prefix = "Stream"
-
-    if stream_url.startswith("/"):
-        # It's a local path, e.g., /data/movies/movie.mp4
-        # We need to prepend the FILE_SERVER_URL
-        # Ensure we don't double slash
-        clean_path = stream_url.lstrip("/")
-        final_url = f"{FILE_SERVER_URL}/{clean_path}"
-        title_prefix = "Local File"
-
-    # Optional: Route through Mediaflow if desired (not strictly necessary for simple file serving but good for "God Mode" unification)
-    # final_url = f"{MEDIAFLOW_URL}/proxy/stream?url={urllib.parse.quote(final_url)}"
-
-    return {
-        "streams": [
-            {
-                "title": f"{title_prefix} via God Mode",
-                "url": final_url
-            }
-        ]
-    }
+    # Only sources that passed the last playability check, best first (local file, then
+    # remote by response time); see StreamResolver
+    return {"streams": await stream_resolver.streams(clean_id)}
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,14 +1,24 @@
 import unittest
+import asyncio
 import json
 import os
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from unittest import mock
 
 # Add parent directory to path to import modules
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from mock_vixsrc import app as mock_app
-from stremio_addon import app as stremio_app
+from stremio_addon import app as stremio_app, SearchCache, LibraryDB, StreamResolver
 from fastapi.testclient import TestClient
+import httpx
+import numpy as np
 
 class TestGodModeStack(unittest.TestCase):
     
@@ -25,21 +35,967 @@ class TestGodModeStack(unittest.TestCase):
         self.assertGreater(len(data["metas"]), 0)
         self.assertEqual(data["metas"][0]["name"], "Big Buck Bunny")
 
+    def test_mock_catalog_pages_generated_titles(self):
+        """A larger mock catalog is paged by skip, deterministic and supports ETags."""
+        import mock_vixsrc
+        size = mock_vixsrc.CATALOG_SIZE
+        mock_vixsrc.CATALOG_SIZE = 250
+        try:
+            pages = [self.mock_client.get(f"/catalog/movie/vixsrc_movies/skip={skip}.json") for skip in (100, 200, 300)]
+            again = self.mock_client.get("/catalog/movie/vixsrc_movies/skip=100.json",
+                                         headers={"If-None-Match": pages[0].headers["ETag"]})
+        finally:
+            mock_vixsrc.CATALOG_SIZE = size
+        ids = [[m["id"] for m in page.json()["metas"]] for page in pages]
+        self.assertEqual([len(page) for page in ids], [100, 50, 0])
+        self.assertEqual(ids[0][0], "vix_101")
+        self.assertEqual(again.status_code, 304)
+
     def test_stremio_file_server_injection(self):
         """Test if local paths are correctly rewritten to file-server URLs."""
-        # We need to simulate the DB returning a local path. 
-        # Since we can't easily mock the DB inside the imported module without patching,
-        # we will rely on a generic check or patch sqlite3 if needed. 
-        # Ideally, we'd refactor `get_stream` to split logic, but for "rigorous" testing of CURRENT code:
-        pass
+        import stremio_addon
+        with tempfile.TemporaryDirectory() as root, tempfile.NamedTemporaryFile(suffix=".mp4") as other:
+            movie = os.path.join(root, "movies", "Big Buck Bunny.mp4")
+            os.makedirs(os.path.dirname(movie))
+            for name in (movie, other.name):
+                with open(name, "wb") as f:
+                    f.write(b"\0" * 16)
+            resolver = StreamResolver(None, ttl=60, data_root=root, concurrency=1)
+
+            async def run(url, path):
+                return [stream for _, stream in await resolver.check("vix_1", url, path)]
+
+            expected = f"{stremio_addon.FILE_SERVER_URL}/{movie.lstrip('/').replace(' ', '%20')}"
+            self.assertEqual(asyncio.run(run(movie, None)), [{"title": "Local File via God Mode", "url": expected}])
+            self.assertEqual(asyncio.run(run(None, movie)), [{"title": "Local File via God Mode", "url": expected}])
+            self.assertEqual(len(asyncio.run(run(movie, movie))), 1)
+            # Paths outside the data root, or that escape it, never reach the file server
+            self.assertEqual(asyncio.run(run(other.name, None)), [])
+            self.assertEqual(asyncio.run(run(f"{root}/../{os.path.basename(other.name)}", None)), [])
+            self.assertEqual(asyncio.run(run("/etc/passwd", None)), [])
+
+    def test_request_id_is_propagated_and_metrics_exposed(self):
+        """The addon echoes the caller's X-Request-ID and serves Prometheus metrics."""
+        response = self.stremio_client.get("/manifest.json", headers={"X-Request-ID": "trace-1"})
+        self.assertEqual(response.headers["X-Request-ID"], "trace-1")
+        metrics = self.stremio_client.get("/metrics").text
+        self.assertIn('http_request_seconds_count{method="GET",route="/manifest.json",status="200"}', metrics)
+        self.assertIn("search_cache_hit_ratio", metrics)
+
+    def test_responses_have_etags_and_are_compressed(self):
+        first = self.stremio_client.get("/manifest.json", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(first.headers["Content-Encoding"], "gzip")
+        self.assertEqual(first.json()["id"], "org.antigravity.aisearch")
+        again = self.stremio_client.get("/manifest.json", headers={"If-None-Match": first.headers["ETag"],
+                                                                    "Accept-Encoding": "identity"})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b"")
+        self.assertNotEqual(again.headers["ETag"], first.headers["ETag"]) # Identity and gzip bodies differ
+
+    def test_search_pages_are_encoded_once_per_result_list(self):
+        import stremio_addon
+        results = [{"id": f"vix_{i}", "title": f"Movie {i}", "description": "A shark"} for i in range(30)]
+
+        async def fetch(key):
+            return {"results": list(results)}, True
+
+        with mock.patch.object(stremio_addon.search_cache, "fetch", fetch), \
+             mock.patch.object(stremio_addon, "Body", wraps=stremio_addon.Body) as body:
+            stremio_addon.search_cache.entries.clear()
+            self.addCleanup(stremio_addon.search_cache.entries.clear)
+            url = "/catalog/movie/ai_search/search=sharks&genre=Horror.json"
+            first = self.stremio_client.get(url)
+            again = self.stremio_client.get(url)
+            self.assertEqual(body.call_count, 1)
+            self.assertEqual(again.headers["ETag"], first.headers["ETag"])
+            page = self.stremio_client.get("/catalog/movie/ai_search/search=sharks&genre=Horror&skip=20.json")
+            self.assertEqual([m["id"] for m in page.json()["metas"]], [f"ai_vix_{i}" for i in range(20, 30)])
+            self.assertEqual(body.call_count, 2)
+
+            stremio_addon.search_cache.entries.clear() # Expired: the refreshed list gets new bodies
+            results.reverse()
+            refreshed = self.stremio_client.get(url)
+        self.assertEqual(body.call_count, 3)
+        self.assertEqual(refreshed.json()["metas"][0]["id"], "ai_vix_29")
 
     def test_search_api_health(self):
-        # We can't really test search API without ChromaDB running, 
-        # but we can check if the file imports correctly (syntax check).
+        # ChromaDB and Ollama aren't running here: the API must still import and start,
+        # report itself alive, and not ready.
         try:
             import search_service
         except ImportError:
             self.fail("Could not import search_service")
+        with TestClient(search_service.app) as client:
+            self.assertEqual(client.get("/healthz").json(), {"status": "ok"})
+            ready = client.get("/readyz")
+        self.assertEqual(ready.status_code, 503)
+        self.assertFalse(ready.json()["embed_model"])
+
+    def test_search_api_can_start_again_after_shutdown(self):
+        """Every lifespan runs blocking calls in its own pool, so a restarted app still can."""
+        import search_service
+        for _ in range(2):
+            with TestClient(search_service.app):
+                self.assertEqual(asyncio.run(search_service.run_blocking(lambda: 42)), 42)
+
+class TestSearchCache(unittest.TestCase):
+
+    def test_concurrent_misses_share_one_fetch(self):
+        """Identical concurrent queries should hit the search API once."""
+        calls = []
+
+        async def fetch(query):
+            calls.append(query)
+            await asyncio.sleep(0.01)
+            return {"results": [query]}, True
+
+        async def run():
+            cache = SearchCache(fetch, maxsize=10, ttl=60, stale=60, negative_ttl=1)
+            results = await asyncio.gather(*[cache.get("sharks") for _ in range(5)])
+            again = await cache.get("sharks")
+            return cache, results, again
+
+        cache, results, again = asyncio.run(run())
+        self.assertEqual(calls, ["sharks"])
+        self.assertTrue(all(r == {"results": ["sharks"]} for r in results))
+        self.assertEqual(again, {"results": ["sharks"]})
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_failures_are_cached_briefly_and_lru_is_bounded(self):
+        outcomes = [({"results": []}, False), ({"results": ["ok"]}, True)]
+
+        async def fetch(query):
+            return outcomes.pop(0) if query == "flaky" else ({"results": [query]}, True)
+
+        async def run():
+            cache = SearchCache(fetch, maxsize=2, ttl=60, stale=60, negative_ttl=0)
+            first = await cache.get("flaky")
+            second = await cache.get("flaky") # Negative entry already expired
+            await cache.get("a")
+            await cache.get("b")
+            return cache, first, second
+
+        cache, first, second = asyncio.run(run())
+        self.assertEqual(first, {"results": []})
+        self.assertEqual(second, {"results": ["ok"]})
+        self.assertEqual(list(cache.entries), ["a", "b"])
+        self.assertEqual(cache.stats()["errors"], 1)
+
+class FakeCollection:
+    """Answers Chroma queries with fixed hits and records them."""
+
+    def __init__(self, name, queries):
+        self.name = name
+        self.queries = queries
+
+    def query(self, query_embeddings, n_results, where, include):
+        self.queries.append((self.name, n_results, where))
+        return {
+            "ids": [["vix_1", "vix_2"][:n_results] for _ in query_embeddings],
+            "metadatas": [[{"title": "Jaws"}, {"title": "Sintel"}][:n_results] for _ in query_embeddings],
+            "distances": [[0.1, 0.4][:n_results] for _ in query_embeddings],
+            "documents": [["A shark", "A dragon"][:n_results] for _ in query_embeddings],
+        }
+
+class FakeChroma:
+    def __init__(self):
+        self.queries = []
+
+    def get_collection(self, name):
+        return FakeCollection(name, self.queries)
+
+class TestSearchService(unittest.TestCase):
+
+    def setUp(self):
+        import search_service
+        self.service = search_service
+        self.chroma = FakeChroma()
+        search_service.chroma["client"] = self.chroma
+        pool = mock.patch.object(search_service, "chroma_pool", ThreadPoolExecutor(max_workers=2)) # Made by the lifespan
+        pool.start()
+        self.addCleanup(pool.stop)
+        search_service.collections.clear()
+        search_service.semantic_cache.sync(None)
+
+    def tearDown(self):
+        self.service.chroma["client"] = None
+        self.service.chroma_pool.shutdown()
+        self.service.collections.clear()
+
+    def library(self, *movies):
+        """A worker database holding these (id, title, description[, year, genres, phobias]) movies, read by the service."""
+        import metadata_worker
+        path = os.path.join(tempfile.mkdtemp(), "media_library.db")
+        with mock.patch.object(metadata_worker, "DB_PATH", path):
+            conn = metadata_worker.open_db()
+        columns = ("id", "title", "description_en", "year", "genres", "phobia_warnings")[:len(movies[0])]
+        with conn:
+            conn.executemany(f"INSERT INTO movies ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", movies)
+            metadata_worker.sync_tags(conn, [movie[0] for movie in movies])
+        conn.close()
+        for patch in (mock.patch.object(self.service, "DB_PATH", path),
+                      mock.patch.object(self.service, "db_local", threading.local())):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_filters_translate_to_chroma_sql_and_the_local_mask(self):
+        filters = self.service.parse_filters("Animal Horror, thriller", 1970, 1980, "Spiders")
+        self.assertEqual(filters, {"genres": ["animal_horror", "thriller"], "exclude_phobias": ["spiders"],
+                                   "year_min": 1970, "year_max": 1980})
+        self.assertEqual(self.service.build_where(filters), {"$and": [
+            {"genre_animal_horror": True}, {"genre_thriller": True}, {"phobia_spiders": {"$ne": True}},
+            {"year": {"$gte": 1970}}, {"year": {"$lte": 1980}},
+        ]})
+        self.assertEqual(self.service.build_where({"year_min": 1970}), {"year": {"$gte": 1970}})
+        self.assertIsNone(self.service.build_where({}))
+
+        self.library(
+            ("vix_1", "Jaws", "A shark", "1975", "Thriller, Animal Horror", ""),
+            ("vix_2", "Arachno Shark", "A shark with legs", "1975", "Thriller, Animal Horror", "spiders"),
+            ("vix_3", "Deep Blue Sea", "Clever sharks", "1999-2000", "Thriller, Animal Horror", ""),
+            ("vix_4", "Sharkwater", "A shark documentary", "1975", "Documentary", ""),
+        )
+        self.assertEqual([hit["id"] for hit in self.service.keyword_search("shark", 10, filters)], ["vix_1"])
+
+        years = np.array([1975, 1975, 1999, 1975, 0])
+        horror = np.array([True, True, True, False, True])
+        flags = {"genre_animal_horror": horror, "genre_thriller": horror,
+                 "phobia_spiders": np.array([False, True, False, False, False])}
+        index = self.service.LocalIndex(tempfile.mkdtemp())
+        self.assertEqual(index.mask(filters, years, flags).tolist(), [True, False, False, False, False])
+        self.assertEqual(index.mask({"genres": ["western"]}, years, flags).tolist(), [False] * 5)
+        self.assertEqual(index.mask({"year_max": 1980}, years, flags).tolist(), [True, True, False, True, False])
+        self.assertIsNone(index.mask({}, years, flags))
+
+    def test_rank_fusion_and_exact_title_hits(self):
+        vector = [{"id": "vix_1", "title": "Jaws", "score": 0.9}, {"id": "vix_2", "title": "Sintel", "score": 0.5}]
+        keyword = [{"id": "vix_2", "title": "Sintel"}, {"id": "vix_3", "title": "Jaws: The Revenge"}]
+        merged = self.service.rrf_merge([vector, keyword], 3)
+        self.assertEqual([hit["id"] for hit in merged], ["vix_2", "vix_1", "vix_3"]) # In both lists first
+        self.assertAlmostEqual(merged[0]["score"], 1 / 62 + 1 / 61)
+        self.assertEqual(merged[1], {"id": "vix_1", "title": "Jaws", "score": 1 / 61})
+        self.assertEqual(len(self.service.rrf_merge([vector, keyword], 1)), 1)
+
+        self.assertIs(self.service.exact_title_hit("jaws the revenge", keyword), keyword[1]) # Case and punctuation ignored
+        self.assertIsNone(self.service.exact_title_hit("jaws", keyword))
+
+    def test_local_index_reproduces_squared_l2_distances(self):
+        import metadata_worker
+        rng = np.random.default_rng(7)
+        matrix = rng.normal(size=(50, 8)).astype(np.float32)
+        queries = rng.normal(size=(3, 8)).astype(np.float32)
+        expected = ((matrix[:, None, :] - queries[None, :, :]) ** 2).sum(axis=2) # What Chroma returns, rows x queries
+        ids = [f"vix_{i}" for i in range(len(matrix))]
+
+        class Collection:
+            def get(self, include, limit, offset):
+                return {"ids": ids[offset:offset + limit], "embeddings": matrix[offset:offset + limit].tolist(),
+                        "metadatas": [{"title": m_id} for m_id in ids[offset:offset + limit]]}
+
+        for dtype, tolerance in (("float32", 1e-4), ("int8", 0.05)):
+            directory = tempfile.mkdtemp()
+            with mock.patch.object(metadata_worker, "VECTOR_INDEX", dtype), \
+                 mock.patch.object(metadata_worker, "VECTOR_INDEX_DIR", directory), \
+                 mock.patch.object(metadata_worker, "index_targets", [("movie_descriptions", "m")]), \
+                 mock.patch.object(metadata_worker, "get_collection", lambda name: Collection()):
+                metadata_worker.export_vectors(page_size=20)
+            index = self.service.LocalIndex(directory)
+            index.refresh()
+            with mock.patch.object(self.service, "VECTOR_CHUNK_ROWS", 16): # int8 rows in several chunks
+                results = index.query_many(queries.tolist(), 5, model="m")
+            for column, hits in zip(expected.T, results):
+                self.assertEqual(len(hits), 5)
+                for m_id, title, distance in hits:
+                    self.assertAlmostEqual(distance, column[ids.index(m_id)], delta=tolerance * column.max())
+                if dtype == "float32":
+                    self.assertEqual([m_id for m_id, _, _ in hits], [ids[i] for i in np.argsort(column)[:5]])
+            with self.assertRaises(RuntimeError): # Vectors from another embedding model
+                index.query_many(queries.tolist(), 5, model="other")
+
+    def test_batch_results_match_single_searches(self):
+        self.library(("vix_1", "Jaws", "A shark"), ("vix_2", "Sintel", "A dragon"))
+        vectors = {"dragon": [1.0, 0.0], "sea monsters": [0.0, 1.0]}
+
+        async def embeddings(texts, model=None):
+            return [vectors[text] for text in texts]
+
+        queries = [{"q": "dragon", "limit": 1}, {"q": "sea monsters", "limit": 2}, {"q": "jaws"}]
+        with mock.patch.object(self.service, "get_query_embeddings", embeddings):
+            client = TestClient(self.service.app) # Not started: the lifespan would shut the pool down
+            single = [client.get("/search", params=query).json() for query in queries]
+            self.service.semantic_cache.sync(None)
+            batch = client.post("/search/batch", json={"queries": queries}).json()
+        self.assertEqual(batch, {"mode": "hybrid", "results": single})
+        self.assertEqual([r["mode"] for r in single], ["hybrid", "hybrid", "keyword"]) # "jaws" is a title
+        self.assertEqual([hit["id"] for hit in single[0]["results"]], ["vix_1"])
+        self.assertEqual(len(self.chroma.queries), 3) # The batch's two vector queries share one index query
+
+    def test_vector_search_queries_the_active_chroma_collection(self):
+        results = asyncio.run(self.service.search_vectors([[1.0, 0.0]], 2, {}, ("movie_descriptions_v2", "m")))
+        self.assertEqual(self.chroma.queries, [("movie_descriptions_v2", 2, None)])
+        self.assertEqual([hit["id"] for hit in results[0]], ["vix_1", "vix_2"])
+        self.assertAlmostEqual(results[0][0]["score"], 0.9)
+
+    def test_slow_backends_time_out_without_blocking_the_event_loop(self):
+        """A hung blocking call gives up after its timeout while the loop keeps running; a hung Ollama gives no vector."""
+        release = threading.Event()
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def hung_chroma():
+            tick = asyncio.create_task(ticker())
+            started = time.monotonic()
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.service.run_blocking(release.wait, 5, timeout=0.2)
+            tick.cancel()
+            return time.monotonic() - started
+
+        elapsed = asyncio.run(hung_chroma())
+        release.set()
+        self.assertLess(elapsed, 1.0)
+        self.assertGreater(len(ticks), 10) # The loop kept serving while the call was stuck
+
+        def hung_ollama(request):
+            raise httpx.ReadTimeout("timed out", request=request)
+
+        async def embed():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(hung_ollama)) as client:
+                with mock.patch.object(self.service, "http_client", client):
+                    return await self.service.get_query_embeddings(["a query that times out"])
+
+        self.assertEqual(asyncio.run(embed()), [None])
+        self.assertNotIn((self.service.EMBED_MODEL, "a query that times out"), self.service.embedding_cache)
+
+class TestSemanticCache(unittest.TestCase):
+
+    def test_close_queries_share_results_until_the_index_changes(self):
+        from search_service import SemanticCache
+        cache = SemanticCache(maxsize=10, ttl=60, threshold=0.95)
+        hits = [{"id": "vix_1"}, {"id": "vix_2"}]
+        cache.put([1.0, 0.0, 0.1], 2, "{}", hits, generation=1)
+
+        self.assertEqual(cache.get([1.0, 0.0, 0.12], 1, "{}", 1), hits[:1]) # Near-identical query
+        self.assertIsNone(cache.get([0.0, 1.0, 0.0], 1, "{}", 1)) # Different meaning
+        self.assertIsNone(cache.get([1.0, 0.0, 0.1], 1, '{"year_min": 2000}', 1)) # Other filters
+        self.assertIsNone(cache.get([1.0, 0.0, 0.1], 5, "{}", 1)) # Needs more results than cached
+        self.assertIsNone(cache.get([1.0, 0.0, 0.1], 1, "{}", 2)) # The worker wrote new vectors
+        self.assertEqual(len(cache.entries), 0)
+
+class TestPriorityGate(unittest.TestCase):
+
+    def test_background_waits_for_interactive_traffic(self):
+        from ollama_gate import PriorityGate
+
+        async def run():
+            gate = PriorityGate(slots=1, quiet=0.05, max_wait=5)
+            order = []
+
+            async def background(name):
+                await gate.enter("background")
+                order.append(name)
+                await asyncio.sleep(0.01)
+                await gate.leave("background")
+
+            await gate.enter("interactive")
+            tasks = [asyncio.create_task(background(n)) for n in ("a", "b")]
+            await asyncio.sleep(0.1)
+            held = list(order)
+            await gate.leave("interactive")
+            await asyncio.gather(*tasks)
+            return held, order, gate.stats()
+
+        held, order, stats = asyncio.run(run())
+        self.assertEqual(held, []) # Nothing started while the search was in flight
+        self.assertEqual(sorted(order), ["a", "b"])
+        self.assertEqual(stats, {"interactive": 0, "background": 0, "waiting": 0})
+
+class TestOllamaPool(unittest.TestCase):
+
+    def test_models_stick_to_their_nodes_and_spill_when_busy(self):
+        from ollama_pool import OllamaPool
+        pool = OllamaPool(["http://a", "http://b", "http://c"], parallel=2, failures=2, open_seconds=60)
+        tags = {"models": [{"name": "llama3.1:8b"}, {"name": "nomic-embed-text:latest"}]}
+        for endpoint in pool.endpoints:
+            pool.update(endpoint, tags, {"models": []})
+
+        held = [pool.acquire("llama3.1:8b") for _ in range(2)]
+        self.assertEqual(held[0], held[1]) # Same home node while it has free slots
+        spilled = pool.acquire("llama3.1:8b")
+        self.assertNotEqual(spilled, held[0])
+        for endpoint in held + [spilled]:
+            pool.release(endpoint, True)
+
+        # Two failures in a row open the circuit: the node is skipped
+        broken = pool.acquire("nomic-embed-text")
+        pool.release(broken, False)
+        pool.release(pool.acquire("nomic-embed-text"), False)
+        self.assertNotEqual(pool.acquire("nomic-embed-text"), broken)
+        self.assertEqual(pool.healthy_count(), 2)
+
+    def test_the_last_endpoint_is_never_skipped(self):
+        from ollama_pool import OllamaPool
+        pool = OllamaPool(["http://gate"], parallel=2, failures=1, open_seconds=60)
+        gate = pool.endpoints[0]
+        pool.release(pool.acquire("llama3.1:8b"), False)
+        pool.update(gate, error=OSError("connection refused"))
+        self.assertIs(pool.acquire("llama3.1:8b"), gate) # Callers get Ollama's own error, not a refusal
+        self.assertEqual(gate.open_until, 0.0)
+
+class TestLibraryDB(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "media_library.db")
+        self.writer = sqlite3.connect(self.path)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute("CREATE TABLE movies (id TEXT PRIMARY KEY, title TEXT, description_en TEXT)")
+        self.writer.execute("INSERT INTO movies VALUES ('vix_1', 'Big Buck Bunny', 'A rabbit')")
+        self.writer.commit()
+
+    def tearDown(self):
+        self.writer.close()
+
+    def test_rows_are_cached_until_the_worker_commits(self):
+        db = LibraryDB(self.path, size=2, cache_size=10, check_interval=0)
+
+        async def run():
+            first = await db.get_row("vix_1")
+            second = await db.get_row("vix_1")
+            self.writer.execute("UPDATE movies SET title = 'Sintel' WHERE id = 'vix_1'")
+            self.writer.commit()
+            third = await db.get_row("vix_1")
+            return first, second, third
+
+        first, second, third = asyncio.run(run())
+        self.assertEqual(first, {"title": "Big Buck Bunny", "description_en": "A rabbit"})
+        self.assertEqual(second, first)
+        self.assertEqual(third["title"], "Sintel")
+        self.assertEqual((db.hits, db.misses), (1, 2))
+
+    def test_a_row_read_before_a_commit_is_not_cached_after_it(self):
+        db = LibraryDB(self.path, size=1, cache_size=10, check_interval=0)
+        connection = db.connection
+
+        @contextmanager
+        def racing():
+            with connection() as conn:
+                yield conn
+            # Another request notices the worker's commit while this one still holds the old row
+            self.writer.execute("UPDATE movies SET title = 'Sintel' WHERE id = 'vix_1'")
+            self.writer.commit()
+            db._check_version()
+
+        with mock.patch.object(db, "connection", racing):
+            self.assertEqual(db._load_row("vix_1")["title"], "Big Buck Bunny")
+        self.assertEqual(db._load_row("vix_1")["title"], "Sintel")
+
+    def test_connections_go_back_to_the_pool_unless_broken(self):
+        db = LibraryDB(self.path, size=1, cache_size=10, check_interval=0)
+        with self.assertRaises(KeyError):
+            with db.connection() as conn:
+                raise KeyError("vix_1")
+        self.assertIs(db.idle.get_nowait(), conn)
+        with self.assertRaises(sqlite3.OperationalError):
+            with db.connection() as conn:
+                conn.execute("SELECT * FROM missing_table")
+        self.assertTrue(db.idle.empty())
+        with self.assertRaises(sqlite3.ProgrammingError): # Closed
+            conn.execute("SELECT 1")
+
+    def test_connections_are_read_only(self):
+        db = LibraryDB(self.path, size=1, cache_size=10, check_interval=0)
+        with db.connection() as conn:
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute("DELETE FROM movies")
+
+    def test_browse_pages_follow_skip(self):
+        self.writer.execute("ALTER TABLE movies ADD COLUMN poster TEXT")
+        self.writer.executemany(
+            "INSERT INTO movies (id, title) VALUES (?, ?)",
+            [(f"vix_{i}", f"Movie {i:02d}") for i in range(2, 26)]
+        )
+        self.writer.commit()
+        db = LibraryDB(self.path, size=1, cache_size=10, check_interval=0)
+
+        async def run():
+            pages = []
+            skip = 0
+            while True:
+                page = await db.browse("ai_all", "", "title", skip=skip, limit=10)
+                if not page:
+                    return pages
+                pages.append(page)
+                skip += len(page)
+
+        pages = asyncio.run(run())
+        titles = [row["title"] for page in pages for row in page]
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(titles, sorted(titles))
+        self.assertEqual(titles[0], "Big Buck Bunny")
+        self.assertEqual(len(set(titles)), 25)
+
+    def test_genre_catalogs_walk_the_genre_index_and_keep_their_cursors(self):
+        import metadata_worker
+        path = os.path.join(tempfile.mkdtemp(), "media_library.db")
+        with mock.patch.object(metadata_worker, "DB_PATH", path):
+            writer = metadata_worker.open_db()
+        self.addCleanup(writer.close)
+        with writer:
+            writer.executemany("INSERT INTO movies (id, title, genres) VALUES (?, ?, ?)",
+                               [(f"vix_{i}", f"Movie {i:02d}", "Horror" if i % 3 else "Comedy") for i in range(30)])
+            metadata_worker.sync_tags(writer, [f"vix_{i}" for i in range(30)])
+        db = LibraryDB(path, size=1, cache_size=10, check_interval=0)
+
+        async def scroll():
+            titles, skip = [], 0
+            while page := await db.browse("ai_genres", "", "title", "Horror", skip=skip, limit=8):
+                titles += [row["title"] for row in page]
+                skip += len(page)
+            return titles
+
+        horror = [f"Movie {i:02d}" for i in range(30) if i % 3]
+        self.assertEqual(asyncio.run(scroll()), horror)
+        cursors = dict(db.cursors[("ai_genres", "Horror")])
+
+        # The worker renames a movie (the trigger updates movie_genres) and adds one
+        with writer:
+            writer.execute("UPDATE movies SET title = 'A Movie' WHERE id = 'vix_29'")
+            writer.execute("INSERT INTO movies (id, title, genres) VALUES ('vix_30', 'Movie 30', 'Horror')")
+            metadata_worker.sync_tags(writer, ["vix_30"])
+        self.assertEqual(asyncio.run(scroll()), ["A Movie"] + horror[:-1] + ["Movie 30"])
+        self.assertLessEqual(set(cursors), set(db.cursors[("ai_genres", "Horror")])) # Kept across commits
+
+        with db.connection() as conn:
+            plan = " ".join(row[3] for row in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT movies.id FROM movie_genres g JOIN movies ON movies.id = g.movie_id "
+                "WHERE g.genre = 'horror' AND g.title IS NOT NULL AND (g.title, g.movie_id) > ('Movie 10', 'vix_10') "
+                "ORDER BY g.title, g.movie_id LIMIT 8"))
+        self.assertIn("idx_movie_genres_browse", plan)
+        self.assertNotIn("TEMP B-TREE", plan) # No sort: the index gives the order
+
+    def test_streams_are_checked_and_ranked(self):
+        root = tempfile.mkdtemp()
+        with open(os.path.join(root, "bunny.mp4"), "wb") as f:
+            f.write(b"video")
+        self.writer.execute("ALTER TABLE movies ADD COLUMN url TEXT")
+        self.writer.execute("ALTER TABLE movies ADD COLUMN path TEXT")
+        self.writer.execute("UPDATE movies SET url = 'http://cdn/ok.mp4', path = ? WHERE id = 'vix_1'",
+                            (os.path.join(root, "bunny.mp4"),))
+        self.writer.execute("INSERT INTO movies (id, title, url, path) VALUES ('vix_2', 'Sintel', 'http://cdn/gone.mp4', ?)",
+                            (os.path.join(root, "missing.mp4"),))
+        self.writer.execute("INSERT INTO movies (id, title, path) VALUES ('vix_3', 'Outside', '/etc/hostname')")
+        self.writer.commit()
+        probes = []
+
+        def cdn(request):
+            probes.append((request.method, request.url.path))
+            return httpx.Response(200 if request.url.path == "/ok.mp4" else 404)
+
+        async def run():
+            resolver = StreamResolver(LibraryDB(self.path, size=1, cache_size=10, check_interval=0),
+                                      ttl=60, data_root=root, concurrency=2)
+            resolver.client = httpx.AsyncClient(transport=httpx.MockTransport(cdn))
+            await resolver.sweep()
+            checked = len(probes)
+            streams = {m_id: await resolver.streams(m_id) for m_id in ("vix_1", "vix_2", "vix_3")}
+            await resolver.client.aclose()
+            return resolver, checked, streams
+
+        resolver, checked, streams = asyncio.run(run())
+        self.assertEqual(checked, 2)
+        self.assertEqual(len(probes), 2) # Lookups are answered from the sweep's results
+        self.assertEqual([s["title"] for s in streams["vix_1"]], ["Local File via God Mode", "Stream via God Mode"])
+        self.assertTrue(streams["vix_1"][0]["url"].endswith("/bunny.mp4"))
+        self.assertEqual(streams["vix_2"], [])
+        self.assertEqual(streams["vix_3"], []) # Outside the data root
+        self.assertEqual(resolver.stats(), {"playable": 1, "unplayable": 2})
+
+class FakeIndex:
+    """Stands in for the worker's Chroma collection."""
+
+    def __init__(self):
+        self.vectors = {}
+        self.metadatas = {}
+
+    def upsert(self, ids, embeddings, metadatas, documents):
+        self.vectors.update(zip(ids, embeddings))
+        self.metadatas.update(zip(ids, metadatas))
+
+    def update(self, ids, metadatas):
+        self.metadatas.update(zip(ids, metadatas))
+
+    def get(self, ids, include):
+        return {"ids": [i for i in ids if i in self.vectors]}
+
+class TestMetadataWorker(unittest.TestCase):
+    """The worker's job queue and pipeline against a temporary database, with Ollama and Chroma stubbed."""
+
+    def setUp(self):
+        import metadata_worker
+        self.worker = metadata_worker
+        self.path = os.path.join(tempfile.mkdtemp(), "media_library.db")
+        self.index = FakeIndex()
+        self.llm_calls = []
+        self.llm = self.answer
+        self.get_embeddings = metadata_worker.get_embeddings
+        patches = [
+            mock.patch.object(metadata_worker, "DB_PATH", self.path),
+            mock.patch.object(metadata_worker, "ask_llm", lambda *args, **kwargs: self.llm(*args, **kwargs)),
+            mock.patch.object(metadata_worker, "get_embeddings", lambda texts, model=None: [[1.0, 0.0]] * len(texts)),
+            mock.patch.dict(metadata_worker.collections, {"movie_descriptions": self.index}, clear=True),
+            mock.patch.object(metadata_worker, "index_targets", list(metadata_worker.index_targets)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.conn = metadata_worker.open_db()
+        self.addCleanup(self.conn.close)
+
+    def answer(self, system_prompt, user_input, format=None):
+        self.llm_calls.append(user_input)
+        return json.dumps({"translation_it": f"IT: {user_input}", "animal_horror": "shark" in user_input, "phobias": []})
+
+    def add_movies(self, *movies):
+        with self.conn:
+            self.conn.executemany("INSERT INTO movies (id, title, description_en) VALUES (?, ?, ?)", movies)
+
+    def jobs(self):
+        return self.conn.execute("SELECT movie_id, task, state, attempts FROM jobs ORDER BY movie_id, task").fetchall()
+
+    def test_migrations_create_a_fresh_database_and_upgrade_a_baseline_one(self):
+        version = len(self.worker.MIGRATIONS)
+        self.assertEqual(self.conn.execute("PRAGMA user_version").fetchone()[0], version)
+        self.assertEqual(self.conn.execute("SELECT name, state FROM vector_collections").fetchall(),
+                         [(self.worker.INDEX_NAME, "active")])
+
+        # A library written by the original worker, before migrations existed
+        baseline = os.path.join(tempfile.mkdtemp(), "media_library.db")
+        with sqlite3.connect(baseline) as conn:
+            conn.execute('''CREATE TABLE movies (id TEXT PRIMARY KEY, title TEXT, description_en TEXT, year TEXT,
+                            poster TEXT, background TEXT, genres TEXT, description_it TEXT,
+                            ai_classified INTEGER DEFAULT 0, phobia_warnings TEXT)''')
+            conn.execute("INSERT INTO movies VALUES ('vix_1', 'Jaws', 'A great white shark', '1975', NULL, NULL, "
+                         "'Thriller, Animal Horror', 'Uno squalo', 1, 'blood')")
+        conn.close()
+        with mock.patch.object(self.worker, "DB_PATH", baseline):
+            conn = self.worker.open_db()
+            conn.close()
+            conn = self.worker.open_db() # Nothing left to apply
+        self.addCleanup(conn.close)
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], version)
+        self.assertLessEqual({"url", "path"}, {col[1] for col in conn.execute("PRAGMA table_info(movies)")})
+        self.assertEqual(conn.execute("SELECT title, ai_classified FROM movies").fetchall(), [("Jaws", 1)])
+        self.assertEqual(conn.execute("SELECT rowid FROM movies_fts WHERE movies_fts MATCH 'shark'").fetchall(), [(1,)])
+        self.assertEqual(conn.execute("SELECT genre FROM movie_genres ORDER BY genre").fetchall(),
+                         [("animal_horror",), ("thriller",)])
+        self.assertEqual(conn.execute("SELECT phobia, movie_id FROM movie_phobias").fetchall(), [("blood", "vix_1")])
+
+    def test_migration_drops_movies_without_an_id(self):
+        """The old TEXT PRIMARY KEY allowed NULL ids; the rebuilt table doesn't, so such rows are dropped."""
+        baseline = os.path.join(tempfile.mkdtemp(), "media_library.db")
+        with sqlite3.connect(baseline) as conn:
+            conn.execute('''CREATE TABLE movies (id TEXT PRIMARY KEY, title TEXT, description_en TEXT, year TEXT,
+                            poster TEXT, background TEXT, genres TEXT)''')
+            conn.executemany("INSERT INTO movies (id, title, description_en) VALUES (?, ?, ?)",
+                             [(None, "Nameless", "A ghost"), ("vix_1", "Jaws", "A great white shark")])
+        conn.close()
+        with mock.patch.object(self.worker, "DB_PATH", baseline):
+            conn = self.worker.open_db()
+        self.addCleanup(conn.close)
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], len(self.worker.MIGRATIONS))
+        self.assertEqual(conn.execute("SELECT id, title FROM movies").fetchall(), [("vix_1", "Jaws")])
+        self.assertEqual(conn.execute("SELECT m.id FROM movies_fts JOIN movies m ON m.rowid = movies_fts.rowid "
+                                      "WHERE movies_fts MATCH 'shark'").fetchall(), [("vix_1",)])
+
+    def test_keyword_index_survives_vacuum(self):
+        """movies has an explicit INTEGER PRIMARY KEY, which VACUUM keeps, so movies_fts still points at the right titles."""
+        self.assertIn(("seq", "INTEGER", 1), [(col[1], col[2], col[5]) for col in self.conn.execute("PRAGMA table_info(movies)")])
+        self.add_movies(*[(f"vix_{i}", f"Movie {i}", "A shark" if i == 9 else "A dog") for i in range(10)])
+        with self.conn:
+            self.conn.execute("DELETE FROM movies WHERE id IN ('vix_1', 'vix_2', 'vix_3')")
+        self.conn.execute("VACUUM")
+        match = """SELECT m.id FROM movies_fts JOIN movies m ON m.rowid = movies_fts.rowid
+                   WHERE movies_fts MATCH ?"""
+        self.assertEqual(self.conn.execute(match, ("shark",)).fetchall(), [("vix_9",)])
+        with self.conn:
+            self.conn.execute("UPDATE movies SET description_en = 'A wolf' WHERE id = 'vix_9'")
+        self.assertEqual(self.conn.execute(match, ("shark",)).fetchall(), [])
+        self.assertEqual(self.conn.execute(match, ("wolf",)).fetchall(), [("vix_9",)])
+        self.assertEqual(self.conn.execute("INSERT INTO movies_fts (movies_fts) VALUES ('integrity-check')").fetchall(), [])
+
+    def test_results_are_reused_by_input_hash_until_the_description_changes(self):
+        self.add_movies(("vix_1", "Jaws", "A shark"))
+        self.worker.enqueue_pending(self.conn)
+        self.worker.run_pipeline(self.conn)
+        self.assertEqual(self.llm_calls, ["A shark"])
+
+        # Same description under another id: the stored results are applied, only the embedding is queued
+        self.add_movies(("vix_2", "Jaws (Extended)", "A shark"))
+        self.worker.enqueue_pending(self.conn)
+        self.assertEqual([(task, state) for m_id, task, state, _ in self.jobs() if m_id == "vix_2"], [("embed", "pending")])
+        self.assertEqual(self.conn.execute("SELECT description_it FROM movies WHERE id = 'vix_2'").fetchone()[0], "IT: A shark")
+        self.worker.run_pipeline(self.conn)
+        self.assertEqual(self.llm_calls, ["A shark"])
+        self.assertEqual(set(self.index.vectors), {"vix_1", "vix_2"})
+
+        # Ingestion resets ai_classified when a description changes: every task runs again
+        with self.conn:
+            self.conn.execute("UPDATE movies SET description_en = 'A bigger shark', ai_classified = 0 WHERE id = 'vix_1'")
+        self.worker.enqueue_pending(self.conn)
+        self.assertEqual({(task, state) for m_id, task, state, _ in self.jobs() if m_id == "vix_1"},
+                         {(task, "pending") for task in self.worker.TASKS})
+        self.worker.run_pipeline(self.conn)
+        self.assertEqual(self.llm_calls, ["A shark", "A bigger shark"])
+        self.assertEqual(self.conn.execute("SELECT description_it, ai_classified FROM movies WHERE id = 'vix_1'").fetchone(),
+                         ("IT: A bigger shark", 1))
+
+    def test_fallback_results_are_not_reused_as_structured_ones(self):
+        worker = self.worker
+        separate = {worker.IT_PROMPT: "Uno squalo", worker.HORROR_PROMPT: "YES", worker.PHOBIA_PROMPT: "NONE"}
+        self.llm = lambda system_prompt, user_input, format=None: "not json" if format else separate[system_prompt]
+        self.add_movies(("vix_1", "Jaws", "A shark"))
+        worker.enqueue_pending(self.conn)
+        worker.run_pipeline(self.conn)
+        self.assertEqual(self.conn.execute("SELECT description_it, ai_classified FROM movies").fetchone(), ("Uno squalo", 1))
+        fallback = worker.task_versions(mode="separate")
+        self.assertEqual(set(self.conn.execute("SELECT task, input_hash FROM enrichment_results").fetchall()),
+                         {(task, worker.input_hash(fallback[task], "A shark")) for task in worker.LLM_TASKS})
+
+        # Another title with the same description asks the structured prompt again
+        self.add_movies(("vix_2", "Jaws (Extended)", "A shark"))
+        worker.enqueue_pending(self.conn)
+        self.assertEqual({task for m_id, task, state, _ in self.jobs() if m_id == "vix_2" and state == "pending"},
+                         set(worker.TASKS))
+
+    def test_a_rebuild_resumes_from_its_checkpoint_and_then_flips_the_pointer(self):
+        self.add_movies(*[(f"vix_{i}", f"Movie {i}", f"Plot {i}") for i in range(1, 6)])
+        indexes, calls = {}, []
+
+        def embeddings(texts, model=None):
+            calls.append(texts)
+            if len(calls) == 3:
+                raise self.worker.BackendUnavailable("Ollama http://gate: connection refused")
+            return [[1.0, 0.0]] * len(texts)
+
+        with mock.patch.object(self.worker, "get_embeddings", embeddings), \
+             mock.patch.object(self.worker, "get_collection", lambda name: indexes.setdefault(name, FakeIndex())), \
+             mock.patch.object(self.worker, "REBUILD_PAGE_SIZE", 2):
+            self.assertFalse(self.worker.rebuild_index(self.conn, "mxbai-embed-large"))
+            building = self.conn.execute(
+                "SELECT name, model, checkpoint, indexed FROM vector_collections WHERE state = 'building'").fetchone()
+            self.assertEqual(building[1:], ("mxbai-embed-large", "vix_4", 4))
+            self.assertEqual(self.conn.execute("SELECT name FROM vector_collections WHERE state = 'active'").fetchone()[0],
+                             self.worker.INDEX_NAME) # Search keeps the old index meanwhile
+
+            self.assertTrue(self.worker.rebuild_index(self.conn, "mxbai-embed-large"))
+        self.assertEqual(calls[3:], [["Plot 5"]]) # Resumed after the checkpoint
+        self.assertEqual(set(indexes[building[0]].vectors), {f"vix_{i}" for i in range(1, 6)})
+        self.assertEqual(self.conn.execute("SELECT name, state FROM vector_collections ORDER BY name").fetchall(),
+                         [(self.worker.INDEX_NAME, "retired"), (building[0], "active")])
+        self.assertEqual(self.worker.index_targets, [(building[0], "mxbai-embed-large")])
+        self.assertEqual(self.conn.execute("SELECT version FROM task_versions WHERE task = 'embed'").fetchone()[0],
+                         self.worker.task_versions("mxbai-embed-large")["embed"])
+
+    def test_ingestion_skips_unmodified_and_unchanged_pages(self):
+        catalog = {"etag": "v1", "metas": [{"id": "vix_1", "name": "Jaws", "description": "A shark", "poster": "p1"},
+                                           {"id": "vix_2", "name": "Sintel", "description": "A dragon", "poster": "p2"}]}
+        requests_seen = []
+
+        class Response:
+            def __init__(self, status_code, metas=None):
+                self.status_code = status_code
+                self.headers = {"ETag": catalog["etag"]}
+                self.metas = metas
+
+            def raise_for_status(self):
+                pass
+
+            def json(self):
+                return {"metas": self.metas}
+
+        def get(url, headers, timeout):
+            requests_seen.append(headers.get("If-None-Match"))
+            if "skip=" in url:
+                return Response(404)
+            if headers.get("If-None-Match") == catalog["etag"]:
+                return Response(304)
+            return Response(200, catalog["metas"])
+
+        def ingest():
+            with mock.patch.object(self.worker.catalog_session, "get", get):
+                self.worker.ingest_from_api(self.conn)
+            return self.conn.execute("SELECT id, description_en, poster, ai_classified FROM movies ORDER BY id").fetchall()
+
+        self.assertEqual(ingest(), [("vix_1", "A shark", "p1", 0), ("vix_2", "A dragon", "p2", 0)])
+        with self.conn: # Edits the next upsert would overwrite
+            self.conn.execute("UPDATE movies SET poster = 'local', ai_classified = 1")
+
+        self.assertEqual(ingest(), [("vix_1", "A shark", "local", 1), ("vix_2", "A dragon", "local", 1)])
+        self.assertEqual(requests_seen[-2], "v1") # Answered 304
+
+        catalog["etag"] = "v2" # Same content under a new ETag: only the validators are stored
+        self.assertEqual(ingest(), [("vix_1", "A shark", "local", 1), ("vix_2", "A dragon", "local", 1)])
+        self.assertEqual(self.conn.execute("SELECT etag FROM ingest_pages").fetchall(), [("v2",)])
+
+        catalog["etag"] = "v3"
+        catalog["metas"][1] = dict(catalog["metas"][1], description="A young dragon")
+        self.assertEqual(ingest(), [("vix_1", "A shark", "p1", 1), ("vix_2", "A young dragon", "p2", 0)])
+
+    def test_ingestion_skips_metas_without_an_id(self):
+        """An item without an id is left out instead of failing its page and the rest of the catalog."""
+        pages = {"": [{"id": "vix_1", "name": "Jaws"}, {"name": "Nameless"}, {"id": "vix_2", "name": "Sintel"}],
+                 "/skip=3": [{"id": "vix_3", "name": "Up"}]}
+
+        class Response:
+            def __init__(self, metas):
+                self.status_code = 200 if metas else 404
+                self.headers = {}
+                self.metas = metas
+
+            def raise_for_status(self):
+                pass
+
+            def json(self):
+                return {"metas": self.metas}
+
+        def get(url, headers, timeout):
+            return Response(pages.get(url[len("http://vixsrc"):-len(".json")]))
+
+        with mock.patch.dict(os.environ, {"VIXSRC_URL": "http://vixsrc"}), \
+             mock.patch.object(self.worker.catalog_session, "get", get):
+            self.worker.ingest_from_api(self.conn)
+        self.assertEqual(self.conn.execute("SELECT id FROM movies ORDER BY id").fetchall(),
+                         [("vix_1",), ("vix_2",), ("vix_3",)])
+
+    def test_invalid_structured_answers_fall_back_to_separate_prompts(self):
+        worker = self.worker
+        separate = {worker.IT_PROMPT: "Uno squalo", worker.HORROR_PROMPT: "YES", worker.PHOBIA_PROMPT: "blood"}
+        invalid = {
+            "malformed": '{"translation_it": "Uno squalo", ',
+            "not an object": '["Uno squalo"]',
+            "missing key": '{"translation_it": "Uno squalo", "animal_horror": true}',
+            "wrong type": '{"translation_it": "Uno squalo", "animal_horror": "yes", "phobias": []}',
+            "phobias not a list": '{"translation_it": "Uno squalo", "animal_horror": true, "phobias": "blood"}',
+            "empty translation": '{"translation_it": " ", "animal_horror": true, "phobias": []}',
+        }
+        for case, raw in invalid.items():
+            with self.subTest(case):
+                prompts = []
+
+                def llm(system_prompt, user_input, format=None):
+                    prompts.append(system_prompt)
+                    return raw if format is not None else separate[system_prompt]
+
+                self.llm = llm
+                self.assertEqual(worker.enrich("A shark"),
+                                 ({"translate": "Uno squalo", "classify": True, "phobia": ["blood"]}, "separate"))
+                self.assertEqual(prompts, [worker.ENRICH_PROMPT, worker.IT_PROMPT, worker.HORROR_PROMPT, worker.PHOBIA_PROMPT])
+
+        prompts = []
+
+        def valid(system_prompt, user_input, format=None):
+            prompts.append(system_prompt)
+            return '{"translation_it": "Uno squalo", "animal_horror": false, "phobias": ["Blood", "sharks"]}'
+
+        self.llm = valid
+        self.assertEqual(worker.enrich("A shark"),
+                         ({"translate": "Uno squalo", "classify": False, "phobia": ["blood"]}, "structured"))
+        self.assertEqual(prompts, [worker.ENRICH_PROMPT]) # One call, unknown phobias dropped
+
+    def test_failed_embedding_batch_is_retried_one_by_one(self):
+        """Ollama rejects the batch because of one bad item: the others are still indexed."""
+        calls = []
+
+        class Response:
+            def __init__(self, status_code, data):
+                self.status_code = status_code
+                self.data = data
+
+            def raise_for_status(self):
+                if self.status_code >= 400:
+                    raise ValueError(f"HTTP {self.status_code}")
+
+            def json(self):
+                return self.data
+
+        def post(path, payload, timeout):
+            calls.append(payload["input"])
+            if "bad" in payload["input"]:
+                return Response(400, {"error": "input too long"})
+            return Response(200, {"embeddings": [[0.5, 0.5]]})
+
+        items = [{"id": f"vix_{i}", "title": desc, "desc_en": desc, "genres": None, "year": None, "phobias": [],
+                  "results": {}} for i, desc in enumerate(["A shark", "bad", "A dragon"])]
+        with mock.patch.object(self.worker, "get_embeddings", self.get_embeddings), \
+             mock.patch.object(self.worker, "ollama_post", post):
+            errors = self.worker.embed_into("movie_descriptions", "nomic-embed-text", items)
+        self.assertEqual(calls, [["A shark", "bad", "A dragon"], "A shark", "bad", "A dragon"])
+        self.assertEqual(errors, {"vix_1": "embedding failed"})
+        self.assertEqual(self.index.vectors, {"vix_0": [0.5, 0.5], "vix_2": [0.5, 0.5]})
+
+    def test_an_outage_defers_jobs_without_using_attempts(self):
+        self.add_movies(("vix_1", "Jaws", "A shark"), ("vix_2", "Sintel", "A dragon"))
+        self.worker.enqueue_pending(self.conn)
+
+        def down(*args, **kwargs):
+            raise self.worker.BackendUnavailable("Ollama http://gate: connection refused")
+
+        self.llm = down
+        self.worker.run_pipeline(self.conn)
+        self.assertEqual({(state, attempts) for _, _, state, attempts in self.jobs()}, {("pending", 0)})
+        self.assertEqual(self.index.vectors, {}) # Embedding was deferred too, not attempted
+
+        # Ollama is back once the deferral delay has passed
+        with self.conn:
+            self.conn.execute("UPDATE jobs SET available_at = 0")
+        self.llm = self.answer
+        self.worker.run_pipeline(self.conn)
+        self.assertEqual({state for _, _, state, _ in self.jobs()}, {"done"})
+        self.assertEqual(self.conn.execute("SELECT SUM(ai_classified) FROM movies").fetchone()[0], 2)
+
+    def test_failed_jobs_back_off_and_are_dead_lettered(self):
+        self.add_movies(("vix_1", "Jaws", "A shark"))
+        self.worker.enqueue_pending(self.conn)
+
+        def broken(*args, **kwargs):
+            raise ValueError("model answered nonsense")
+
+        self.llm = broken
+        with mock.patch.object(self.worker, "JOB_MAX_ATTEMPTS", 3):
+            self.worker.run_pipeline(self.conn)
+            rows = self.conn.execute("SELECT state, attempts, available_at FROM jobs WHERE task != 'embed'").fetchall()
+            self.assertEqual({(state, attempts) for state, attempts, _ in rows}, {("pending", 1)})
+            self.assertTrue(all(available_at > time.time() + 20 for *_, available_at in rows)) # Backed off
+            self.assertEqual(self.worker.claim_jobs(self.conn, 10), [])
+
+            # Claimed again by a worker that dies: its lease expires and the next run takes the jobs over
+            with self.conn:
+                self.conn.execute("UPDATE jobs SET available_at = 0")
+            self.assertEqual(sorted(self.worker.claim_jobs(self.conn, 10)[0]["todo"]), sorted(self.worker.LLM_TASKS))
+            with self.conn:
+                self.conn.execute("UPDATE jobs SET lease_owner = 'gone', lease_until = 0 WHERE state = 'leased'")
+            self.worker.run_pipeline(self.conn) # Third and last attempt
+            self.assertEqual({(task, state, attempts) for _, task, state, attempts in self.jobs()},
+                             {("embed", "done", 1)} | {(task, "dead", 3) for task in self.worker.LLM_TASKS})
+
+            # An expired lease that used the last attempt is dead-lettered instead of claimed again
+            with self.conn:
+                self.conn.execute("UPDATE jobs SET state = 'leased', attempts = 3, lease_until = 0 WHERE task = 'embed'")
+            self.assertEqual(self.worker.claim_jobs(self.conn, 10), [])
+        self.assertEqual(self.conn.execute("SELECT state, last_error FROM jobs WHERE task = 'embed'").fetchone(),
+                         ("dead", "lease expired"))
+
+    def test_dead_jobs_can_be_requeued(self):
+        self.add_movies(("vix_1", "Jaws", "A shark"))
+        self.worker.enqueue_pending(self.conn)
+        with self.conn:
+            self.conn.execute("UPDATE jobs SET state = 'dead', attempts = 5 WHERE task = 'translate'")
+        self.assertEqual(self.worker.requeue_dead(self.conn, "classify"), 0)
+        self.assertEqual(self.worker.requeue_dead(self.conn), 1)
+        self.assertEqual(self.jobs()[-1][1:], ("translate", "pending", 0))
 
 if __name__ == '__main__':
     unittest.main()